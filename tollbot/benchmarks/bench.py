@@ -0,0 +1,188 @@
+"""Micro-benchmarks for tollbot hot paths.
+
+Run from the repository root (``make bench``) or directly:
+
+    PYTHONPATH=tollbot/src python3 tollbot/benchmarks/bench.py [name ...]
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+BENCHMARKS: Dict[str, Callable[[float], List[tuple]]] = {}
+
+
+def benchmark(fn):
+    """Register a benchmark under its function name."""
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def measure(fn: Callable[[], int], seconds: float) -> float:
+    """Get the throughput of fn, which returns how many operations it ran.
+
+    Args:
+        fn: Batch of operations to repeat
+        seconds: Minimum time to repeat it for
+
+    Returns:
+        float: Operations per second
+    """
+    fn()  # warm up
+    ops = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < seconds:
+        ops += fn()
+        elapsed = time.perf_counter() - start
+    return ops / elapsed
+
+
+@benchmark
+def verify(seconds: float) -> List[tuple]:
+    """Token signature checks: HMAC-SHA256 against Ed25519."""
+    from tollbot.payment.token import TokenManager
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hs256 = TokenManager(tmpdir)
+        hs256.generate_keypair()
+        eddsa = TokenManager(tmpdir)
+        eddsa.generate_ed25519_keypair()
+
+    def mint(manager):
+        return [manager.create_token("W", "USDC", 0.001, 100, "/api/") for _ in range(1000)]
+
+    hs256_tokens = mint(hs256)
+    eddsa_tokens = mint(eddsa)
+    # Unit tokens come back many times: ten presentations of each
+    repeated = [token for token in eddsa_tokens[:100] for _ in range(10)]
+
+    def each(manager, tokens):
+        def run():
+            for token in tokens:
+                manager.verify_signature(token)
+            return len(tokens)
+        return run
+
+    def batch(manager, tokens):
+        def run():
+            manager.verify_batch(tokens)
+            return len(tokens)
+        return run
+
+    return [
+        ("hmac-sha256", measure(each(hs256, hs256_tokens), seconds)),
+        ("ed25519", measure(each(eddsa, eddsa_tokens), seconds)),
+        ("ed25519 batch", measure(batch(eddsa, eddsa_tokens), seconds)),
+        ("ed25519 batch, 10x repeats", measure(batch(eddsa, repeated), seconds)),
+    ]
+
+
+def zipf_paths(distinct: int, count: int, s: float = 1.1, seed: int = 1) -> List[str]:
+    """Draw request paths whose popularity follows a Zipf law.
+
+    Args:
+        distinct: Number of different paths
+        count: Number of requests
+        s: Zipf exponent
+        seed: Random seed
+
+    Returns:
+        list: Request paths, the most popular ones repeated most
+    """
+    rng = random.Random(seed)
+    paths = [f"/section{i % 200}/item/{i}" for i in range(distinct)]
+    rng.shuffle(paths)
+    weights = [1 / rank ** s for rank in range(1, distinct + 1)]
+    return rng.choices(paths, weights, k=count)
+
+
+@benchmark
+def prices(seconds: float) -> List[tuple]:
+    """Price lookups on a Zipfian workload: normalizer and matcher alone, and cached."""
+    from tollbot.robots_parser import RobotsParser
+
+    robots = "\n".join(
+        f"Disallow: /section{i}/  # @price: 0.00{i % 9 + 1} @unit: 100" for i in range(200)
+    )
+    requests = zipf_paths(distinct=50000, count=100000)
+
+    def lookups(parser):
+        def run():
+            get_price = parser.get_price
+            for path in requests:
+                get_price(path)
+            return len(requests)
+        return run
+
+    uncached = RobotsParser(cache_size=0)
+    uncached.parse(robots)
+    cached = RobotsParser()
+    cached.parse(robots)
+    results = [
+        ("normalize + matcher", measure(lookups(uncached), seconds)),
+        ("clock cache (4096)", measure(lookups(cached), seconds)),
+    ]
+    print(f"  price cache hit ratio {cached.cache.hit_ratio:.1%}")
+    return results
+
+
+@benchmark
+def demand(seconds: float) -> List[tuple]:
+    """Priced lookups on a Zipfian workload, without and with demand counting."""
+    from tollbot.pricing import DemandPricing
+    from tollbot.robots_parser import RobotsParser
+
+    robots = "\n".join(
+        f"Disallow: /section{i}/  # @price: 0.00{i % 9 + 1} @unit: 100" for i in range(200)
+    )
+    requests = zipf_paths(distinct=50000, count=100000)
+    parser = RobotsParser()
+    parser.parse(robots)
+    pricing = DemandPricing(target_rate=100.0)
+
+    def fixed():
+        lookup = parser.lookup
+        for path in requests:
+            lookup(path)[2]["price"]
+        return len(requests)
+
+    # Checks count demand but use the robots.txt price; only mints scale it
+    def counted():
+        lookup = parser.lookup
+        record = pricing.record
+        for path in requests:
+            _, prefix, info = lookup(path)
+            record(prefix)
+            info["price"]
+        return len(requests)
+
+    return [
+        ("robots.txt price", measure(fixed, seconds)),
+        ("robots.txt price, demand counted", measure(counted, seconds)),
+    ]
+
+
+def main(argv=None):
+    """Run the named benchmarks, or all of them."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", metavar="name", help=", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--seconds", type=float, default=1.0, help="Time per measurement")
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.names) - set(BENCHMARKS))
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    for name in args.names or sorted(BENCHMARKS):
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        results = BENCHMARKS[name](args.seconds)
+        baseline = results[0][1]
+        for label, ops in results:
+            print(f"  {label:<32} {ops:>12,.0f} ops/s  {ops / baseline:>6.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,15 @@
 """Tollbot CLI entry point."""
 import sys
-from tollbot.cli.main import main
+
+
+def __getattr__(name):
+    """Import the CLI only when the entry point is looked up."""
+    if name == "main":
+        from tollbot.cli.main import main
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
+    from tollbot.cli.main import main
     sys.exit(main())
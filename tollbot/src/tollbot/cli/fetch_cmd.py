@@ -0,0 +1,54 @@
+"""Tollbot fetch command handler."""
+import os
+import sys
+import time
+from typing import List
+
+from tollbot.cli.init_cmd import is_url, read_manifest
+from tollbot.fetcher import FAILED, Origin, RobotsFetcher
+
+
+def handle_fetch(args):
+    """Handle tollbot fetch command."""
+    origins = read_origins(args)
+    if not origins:
+        print("Error: --url or a --manifest with robots.txt URLs is required")
+        sys.exit(2)
+
+    fetcher = RobotsFetcher(origins, max_workers=args.jobs)
+    try:
+        while True:
+            counts = fetcher.refresh_all()
+            summary = ", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items()))
+            print(f"Checked {len(origins)} origins: {summary}")
+            for origin in origins:
+                if origin.status == FAILED:
+                    print(f"  {origin.url}: {origin.error}")
+            if args.interval <= 0:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fetcher.close()
+
+    if args.interval <= 0 and any(origin.status == FAILED for origin in origins):
+        sys.exit(1)
+
+
+def read_origins(args) -> List[Origin]:
+    """Get the origins named by --url or --manifest.
+
+    Manifest domains are published in <config_dir>/<domain>, as by
+    ``tollbot init --manifest``; domains without a robots.txt URL are
+    skipped.
+    """
+    if args.url:
+        return [Origin(args.url, args.config_dir)]
+    if not args.manifest:
+        return []
+    return [
+        Origin(robots, os.path.join(args.config_dir, domain))
+        for domain, robots in read_manifest(args.manifest)
+        if robots and is_url(robots)
+    ]
@@ -1,6 +1,10 @@
 """Tollbot init command handler."""
+import json
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 
 from tollbot.robots_parser import RobotsParser
 from tollbot.payment.token import TokenManager
@@ -9,6 +13,13 @@ from tollbot.nginx.configurator import NginxConfigurator
 
 def handle_init(args):
     """Handle tollbot init command."""
+    if args.manifest:
+        handle_fleet_init(args)
+        return
+    if not args.domain:
+        print("Error: --domain or --manifest is required")
+        sys.exit(2)
+
     print(f"Initializing tollbot for domain: {args.domain}")
     print(f"Configuration directory: {args.config_dir}")
 
@@ -16,10 +27,9 @@ def handle_init(args):
     os.makedirs(args.config_dir, exist_ok=True)
 
     # Parse robots.txt if exists
-    robots_path = f"/var/www/{args.domain}/robots.txt"
-    if os.path.exists(robots_path):
-        parser = RobotsParser()
-        pricing = parser.parse_file(robots_path)
+    robots_path = args.robots_url or f"/var/www/{args.domain}/robots.txt"
+    pricing = load_pricing(robots_path, args.config_dir)
+    if pricing is not None:
         print(f"Found {len(pricing)} pricing directives in robots.txt")
         for path, info in pricing.items():
             print(f"  {path}: {info['price']} {info['currency']} per {info['unit']} requests")
@@ -28,24 +38,280 @@ def handle_init(args):
 
     # Generate wallet configuration
     if args.wallet:
-        token_manager = TokenManager()
-        wallet_config = {
-            "wallet_id": args.wallet,
-            "currency": "USDC",
-            "public_key": token_manager.generate_keypair(),
-        }
-        wallet_path = os.path.join(args.config_dir, "wallet.conf")
-        with open(wallet_path, "w") as f:
-            for k, v in wallet_config.items():
-                f.write(f"{k}={v}\n")
+        wallet_path = write_wallet(args.wallet, args.config_dir)
         print(f"Wallet configuration saved to {wallet_path}")
 
     # Generate nginx configuration
     if not args.dry_run:
         nginx_conf = NginxConfigurator(args.domain, args.config_dir)
-        nginx_conf.generate()
-        print("Nginx configuration generated")
+        if os.path.exists(os.path.join(args.nginx_root, "nginx.conf")):
+            try:
+                changed = nginx_conf.merge(args.nginx_root)
+            except ImportError:
+                print("certbot-nginx not installed - generating standalone configuration")
+                nginx_conf.generate()
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+            else:
+                print(f"Merged tollbot into nginx configuration ({len(changed)} files changed)")
+        else:
+            nginx_conf.generate()
+            print("Nginx configuration generated")
     else:
         print("Dry run mode - skipping nginx configuration")
 
     print("Tollbot initialized successfully")
+
+
+def handle_fleet_init(args):
+    """Initialize every domain in a manifest as a site of one configuration
+    directory, then merge them into nginx, test, reload and probe once."""
+    entries = read_manifest(args.manifest)
+    print(f"Initializing {len(entries)} domains from {args.manifest}")
+
+    results = init_fleet(entries, args.config_dir, args.wallet, args.dry_run, args.jobs)
+
+    width = max([len(r["domain"]) for r in results] + [6])
+    print(f"{'Domain':<{width}}  {'Status':<8}  {'Prices':>6}  {'Time':>6}  Detail")
+    for r in results:
+        print(
+            f"{r['domain']:<{width}}  {r['status']:<8}  {r['prices']:>6}  "
+            f"{r['seconds']:>5.2f}s  {r['detail']}"
+        )
+
+    failed = [r for r in results if r["status"] == "failed"]
+    print(f"{len(results) - len(failed)} domains configured, {len(failed)} failed")
+
+    nginx_ok = True
+    if args.dry_run:
+        print("Nginx: dry run - skipped")
+    elif len(failed) == len(results):
+        print("Nginx: no domain configured - skipped")
+    elif not os.path.exists(os.path.join(args.nginx_root, "nginx.conf")):
+        print(
+            f"Nginx: no nginx.conf in {args.nginx_root} - include "
+            f"{os.path.join(args.config_dir, 'nginx', 'tollbot-include.conf')} in the http "
+            f"block and {os.path.join(args.config_dir, '<domain>', 'nginx', 'tollbot-locations.conf')} "
+            "in each domain's server block"
+        )
+    else:
+        nginx_ok, detail = reload_fleet(results, args.config_dir, args.nginx_root)
+        print(f"Nginx: {detail}")
+
+    if failed or not nginx_ok:
+        sys.exit(1)
+
+
+def read_manifest(path: str) -> List[Tuple[str, Optional[str]]]:
+    """Read a domain manifest.
+
+    Each line holds a domain and, optionally, the path or http(s) URL of
+    its robots.txt (default /var/www/<domain>/robots.txt). Blank lines
+    and lines starting with # are ignored.
+
+    Args:
+        path: Manifest file
+
+    Returns:
+        list: (domain, robots.txt path or URL, or None) pairs
+    """
+    entries = []
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                entries.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return entries
+
+
+def init_fleet(
+    entries: List[Tuple[str, Optional[str]]],
+    config_dir: str,
+    wallet: Optional[str] = None,
+    dry_run: bool = False,
+    jobs: Optional[int] = None,
+) -> List[dict]:
+    """Initialize domains in parallel as sites of one configuration directory.
+
+    The wallet, signing key, Lua modules and http include are written
+    once to config_dir; each domain's price table, price map and
+    endpoint locations go to <config_dir>/<domain> in a worker process.
+    The domains configured are added to sites.json.
+
+    Args:
+        entries: (domain, robots.txt path or None) pairs
+        config_dir: Shared configuration directory
+        wallet: Circle wallet address for payments
+        dry_run: Skip nginx configuration
+        jobs: Worker processes (default: one per CPU)
+
+    Returns:
+        list: Per-domain results, in manifest order
+    """
+    os.makedirs(config_dir, exist_ok=True)
+    if wallet:
+        write_wallet(wallet, config_dir)
+    if not dry_run:
+        NginxConfigurator("", config_dir, site=True).write_shared()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(init_domain, domain, config_dir, robots_path, dry_run)
+            for domain, robots_path in entries
+        ]
+        results = [future.result() for future in futures]
+
+    write_sites(config_dir, [r["domain"] for r in results if r["status"] != "failed"])
+    return results
+
+
+def init_domain(
+    domain: str,
+    config_dir: str,
+    robots_path: Optional[str] = None,
+    dry_run: bool = False,
+) -> dict:
+    """Initialize one site of a fleet; runs in a worker process.
+
+    Args:
+        domain: Domain name
+        config_dir: Shared configuration directory
+        robots_path: robots.txt path or URL (default /var/www/<domain>/robots.txt)
+        dry_run: Skip nginx configuration
+
+    Returns:
+        dict: Summary with domain, config_dir, status, prices, seconds and detail
+    """
+    start = time.monotonic()
+    configurator = NginxConfigurator(domain, config_dir, site=True)
+    result = {"domain": domain, "config_dir": None, "status": "ok", "prices": 0, "detail": ""}
+    try:
+        site_dir = result["config_dir"] = configurator.site_dir
+        os.makedirs(site_dir, exist_ok=True)
+        robots_path = robots_path or f"/var/www/{domain}/robots.txt"
+        pricing = load_pricing(robots_path, site_dir)
+        if pricing is None:
+            result["status"] = "warning"
+            result["detail"] = f"robots.txt not found at {robots_path}"
+        else:
+            result["prices"] = len(pricing)
+
+        if not dry_run:
+            configurator.pricing = pricing or {}
+            configurator.write_site()
+    except Exception as e:
+        result["status"] = "failed"
+        result["detail"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def write_sites(config_dir: str, domains: List[str]):
+    """Add domains to the sites of a configuration directory (sites.json).
+
+    Args:
+        config_dir: Shared configuration directory
+        domains: Domains configured as sites
+    """
+    path = os.path.join(config_dir, "sites.json")
+    try:
+        with open(path, "r") as f:
+            sites = json.load(f).get("sites", [])
+    except FileNotFoundError:
+        sites = []
+    sites += [domain for domain in domains if domain not in sites]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"sites": sites}, f)
+    os.replace(tmp, path)
+
+
+def reload_fleet(
+    results: List[dict],
+    config_dir: str,
+    nginx_root: str,
+    nginx_bin: str = "nginx",
+    nginx_url: str = "http://127.0.0.1",
+) -> Tuple[bool, str]:
+    """Merge a fleet's sites into nginx, then test, reload and probe once.
+
+    Args:
+        results: init_fleet() results; failed domains are left out
+        config_dir: Shared configuration directory
+        nginx_root: Directory containing nginx.conf
+        nginx_bin: nginx executable
+        nginx_url: Local address nginx serves the sites on
+
+    Returns:
+        tuple: (True if nginx serves the new configuration, summary line)
+    """
+    sites = [
+        NginxConfigurator(r["domain"], config_dir, nginx_bin=nginx_bin, nginx_url=nginx_url, site=True)
+        for r in results
+        if r["status"] != "failed"
+    ]
+    first = sites[0]
+    try:
+        changed = first.merge(nginx_root, others=sites[1:])
+    except ImportError:
+        return False, "certbot-nginx not installed - include the generated files by hand"
+    except ValueError as e:
+        return False, str(e)
+
+    if not first.reload(test=False):
+        return False, f"{len(changed)} files merged and tested, reload failed: {first.last_error}"
+    return True, f"{len(changed)} files merged, tested and reloaded; serving {first.generation}"
+
+
+def load_pricing(robots_path: str, config_dir: str) -> Optional[dict]:
+    """Parse a robots.txt and save its price table to the config directory.
+
+    Args:
+        robots_path: robots.txt path or http(s) URL
+        config_dir: Configuration directory
+
+    Returns:
+        dict: Pricing directives, or None if robots.txt does not exist
+    """
+    if is_url(robots_path):
+        from tollbot.fetcher import fetch_pricing
+        return fetch_pricing(robots_path, config_dir)
+
+    if not os.path.exists(robots_path):
+        return None
+
+    parser = RobotsParser()
+    pricing = parser.parse_file(robots_path)
+    parser.save_cache(os.path.join(config_dir, "robots_cache.json"))
+    return pricing
+
+
+def is_url(robots_path: str) -> bool:
+    """Check whether a robots.txt location is a remote origin's URL."""
+    return robots_path.startswith(("http://", "https://"))
+
+
+def write_wallet(wallet: str, config_dir: str) -> str:
+    """Write the wallet configuration and a new signing key.
+
+    Args:
+        wallet: Circle wallet address
+        config_dir: Configuration directory
+
+    Returns:
+        str: Path of the wallet configuration
+    """
+    token_manager = TokenManager(config_dir)
+    wallet_config = {
+        "wallet_id": wallet,
+        "currency": "USDC",
+        "public_key": token_manager.generate_keypair(),
+    }
+    wallet_path = os.path.join(config_dir, "wallet.conf")
+    with open(wallet_path, "w") as f:
+        for k, v in wallet_config.items():
+            f.write(f"{k}={v}\n")
+    token_manager.save_signing_key()
+    return wallet_path
@@ -19,7 +19,21 @@ def main():
 
     # init command
     init_parser = subparsers.add_parser("init", help="Initialize tollbot for a domain")
-    init_parser.add_argument("--domain", required=True, help="Domain name to configure")
+    init_parser.add_argument("--domain", help="Domain name to configure")
+    init_parser.add_argument(
+        "--manifest",
+        help=(
+            "File listing domains to configure, one per line with an optional "
+            "robots.txt path or URL; the domains become sites of --config-dir, "
+            "merged into nginx and reloaded once"
+        ),
+    )
+    init_parser.add_argument(
+        "--robots-url", help="URL of the robots.txt of a reverse-proxied origin"
+    )
+    init_parser.add_argument(
+        "--jobs", type=int, help="Worker processes for --manifest (default: one per CPU)"
+    )
     init_parser.add_argument("--wallet", help="Circle wallet address for payments")
     init_parser.add_argument(
         "--dry-run", action="store_true", help="Test configuration without modifying nginx"
@@ -29,6 +43,11 @@ def main():
         default="/etc/tollbot",
         help="Configuration directory (default: /etc/tollbot)",
     )
+    init_parser.add_argument(
+        "--nginx-root",
+        default="/etc/nginx",
+        help="nginx configuration directory to merge into (default: /etc/nginx)",
+    )
 
     # run command
     run_parser = subparsers.add_parser("run", help="Start tollbot service")
@@ -41,15 +60,79 @@ def main():
         default="info",
         help="Set logging verbosity",
     )
+    run_parser.add_argument(
+        "--trace",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Keep per-stage timings of the last N validations (dump with SIGUSR1)",
+    )
 
     # status command
     status_parser = subparsers.add_parser("status", help="Show tollbot status")
+    status_parser.add_argument(
+        "--json", action="store_true", help="Print status and live counters as JSON"
+    )
+    status_parser.add_argument(
+        "--traces", action="store_true", help="Print the validation traces of the service"
+    )
 
     # renew command
     renew_parser = subparsers.add_parser("renew", help="Renew payment configuration")
     renew_parser.add_argument(
         "--force", action="store_true", help="Force renewal regardless of key age"
     )
+    renew_parser.add_argument(
+        "--ed25519",
+        action="store_true",
+        help="Sign new tokens with Ed25519; edge nodes then only need verify.pem",
+    )
+    renew_parser.add_argument(
+        "--config-dir",
+        default="/etc/tollbot",
+        help="Configuration directory (default: /etc/tollbot)",
+    )
+    renew_parser.add_argument(
+        "--nginx-root",
+        default="/etc/nginx",
+        help="nginx configuration directory (default: /etc/nginx)",
+    )
+
+    # revoke command
+    revoke_parser = subparsers.add_parser("revoke", help="Revoke prepaid tokens")
+    revoke_parser.add_argument(
+        "serials", type=int, nargs="*", metavar="SERIAL", help="Prepaid token serials to revoke"
+    )
+    revoke_parser.add_argument(
+        "--compact-below",
+        type=int,
+        metavar="SERIAL",
+        help="Drop serials below SERIAL, whose tokens have all expired",
+    )
+
+    # fetch command
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="Keep price tables of remote origins current"
+    )
+    fetch_parser.add_argument("--url", help="robots.txt URL of one origin")
+    fetch_parser.add_argument(
+        "--manifest", help="Domain manifest; domains with a robots.txt URL are fetched"
+    )
+    fetch_parser.add_argument(
+        "--config-dir",
+        default="/etc/tollbot",
+        help="Configuration directory, with one per domain for --manifest (default: /etc/tollbot)",
+    )
+    fetch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Check origins again every SECONDS until interrupted (default: check once)",
+    )
+    fetch_parser.add_argument(
+        "--jobs", type=int, default=8, help="Concurrent fetches (default: 8)"
+    )
 
     args = parser.parse_args()
 
@@ -69,5 +152,11 @@ def main():
     elif args.command == "renew":
         from tollbot.cli import renew_cmd
         renew_cmd.handle_renew(args)
+    elif args.command == "fetch":
+        from tollbot.cli import fetch_cmd
+        fetch_cmd.handle_fetch(args)
+    elif args.command == "revoke":
+        from tollbot.cli import revoke_cmd
+        revoke_cmd.handle_revoke(args)
 
     return 0
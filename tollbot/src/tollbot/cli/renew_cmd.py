@@ -2,25 +2,36 @@
 import os
 
 from tollbot.payment.token import TokenManager
-from tollbot.nginx.configurator import NginxConfigurator
 
 
 def handle_renew(args):
     """Handle tollbot renew command."""
-    config_dir = "/etc/tollbot"
+    config_dir = args.config_dir
 
     print("Tollbot renewal")
 
     # Renew payment keys
     token_manager = TokenManager()
     if os.path.exists(os.path.join(config_dir, "wallet.conf")):
-        token_manager.rotate_keys(config_dir)
+        token_manager.rotate_keys(config_dir, ed25519=args.ed25519)
         print("Payment keys rotated")
+        if args.ed25519:
+            print(
+                "Tokens are now signed with Ed25519; copy verify.pem to edge nodes "
+                "and remove their signing.key"
+            )
 
-    # Reload nginx
-    if os.path.exists("/etc/nginx/nginx.conf"):
-        nginx_conf = NginxConfigurator("default", config_dir)
-        nginx_conf.reload()
-        print("Nginx reloaded")
+    # Update nginx; workers pick up the new key without a reload
+    if os.path.exists(os.path.join(args.nginx_root, "nginx.conf")):
+        from tollbot.nginx.configurator import NginxConfigurator
+
+        configurators = NginxConfigurator.for_config_dir(config_dir)
+        if not configurators:
+            print(f"Nginx not updated: no domain configured in {config_dir}; run tollbot init")
+        for nginx_conf in configurators:
+            if nginx_conf.apply():
+                print(f"Nginx updated for {nginx_conf.domain}")
+            else:
+                print(f"Nginx update failed for {nginx_conf.domain}: {nginx_conf.last_error}")
 
     print("Renewal complete")
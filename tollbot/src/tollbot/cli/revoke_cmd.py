@@ -0,0 +1,19 @@
+"""Tollbot revoke command handler."""
+import os
+
+from tollbot.payment.revocation import RevocationList
+
+
+def handle_revoke(args):
+    """Handle tollbot revoke command."""
+    config_dir = "/etc/tollbot"
+    path = os.path.join(config_dir, "revoked.json")
+
+    revocations = RevocationList.load(path) or RevocationList()
+    revocations.revoke(args.serials)
+    if args.compact_below is not None:
+        revocations.compact(args.compact_below)
+    revocations.save(path)
+
+    print(f"Revoked {len(args.serials)} serial(s); published version {revocations.version}")
+    print(f"Revocation list: {path} ({len(revocations.bitmap)} bytes from serial {revocations.base})")
@@ -1,9 +1,10 @@
 """Tollbot run command handler."""
-import time
+import asyncio
 import logging
 
-from tollbot.robots_parser import RobotsParser
 from tollbot.payment.validator import PaymentValidator
+from tollbot.service import TollbotService
+from tollbot.tracing import Tracer
 
 
 def handle_run(args):
@@ -15,7 +16,6 @@ def handle_run(args):
     )
 
     config_dir = "/etc/tollbot"
-    robots_path = f"{config_dir}/robots_cache.json"
 
     print("Starting tollbot service...")
     print("Press Ctrl+C to stop")
@@ -26,11 +26,12 @@ def handle_run(args):
         print("Dry run mode - will validate but not block requests")
         validator.dry_run = True
 
+    if args.trace:
+        print(f"Tracing the last {args.trace} validations - send SIGUSR1 to dump them")
+        validator.set_tracer(Tracer(args.trace))
+
+    service = TollbotService(config_dir, replay=validator.manager.replay, validator=validator)
     try:
-        while True:
-            if os.path.exists(robots_path):
-                parser = RobotsParser()
-                parser.load_cache(robots_path)
-            time.sleep(1)
+        asyncio.run(service.serve_forever())
     except KeyboardInterrupt:
         print("\nStopping tollbot service...")
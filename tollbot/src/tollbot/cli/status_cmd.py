@@ -1,18 +1,46 @@
 """Tollbot status command handler."""
+import json
 import os
+import socket
+import sys
+from typing import Optional
 
-from tollbot.nginx.configurator import NginxConfigurator
+from tollbot.constants import SERVICE_HOST, SERVICE_PORT
 
 
 def handle_status(args):
     """Handle tollbot status command."""
     config_dir = "/etc/tollbot"
 
+    config_file = os.path.join(config_dir, "config.ini")
+    nginx_include = os.path.join(config_dir, "nginx", "tollbot-include.conf")
+    wallet_file = os.path.join(config_dir, "wallet.conf")
+
+    if args.traces:
+        traces = fetch_status("/__tollbot__/traces")
+        if traces is None:
+            print("Service not running or not tracing (start it with tollbot run --trace N)")
+            sys.exit(1)
+        print(json.dumps(traces, indent=2))
+        return
+
+    live = fetch_status("/__tollbot__/status")
+
+    if args.json:
+        print(json.dumps({
+            "config_file": config_file,
+            "configured": os.path.exists(config_file),
+            "nginx_include": nginx_include,
+            "nginx_configured": os.path.exists(nginx_include),
+            "wallet_configured": os.path.exists(wallet_file),
+            "service": live,
+        }, indent=2))
+        return
+
     print("Tollbot Status")
     print("=" * 40)
 
     # Check config
-    config_file = os.path.join(config_dir, "config.ini")
     if os.path.exists(config_file):
         print(f"Config file: {config_file}")
         print("Status: Configured")
@@ -21,7 +49,6 @@ def handle_status(args):
         print("Status: Not configured")
 
     # Check nginx config
-    nginx_include = os.path.join(config_dir, "nginx", "tollbot-include.conf")
     if os.path.exists(nginx_include):
         print(f"Nginx include: {nginx_include}")
         print("Nginx: Configured")
@@ -30,13 +57,61 @@ def handle_status(args):
         print("Nginx: Not configured")
 
     # Check wallet
-    wallet_file = os.path.join(config_dir, "wallet.conf")
     if os.path.exists(wallet_file):
         print("Wallet: Configured")
     else:
         print("Wallet: Not configured")
 
+    # Live counters from the service
+    if live is None:
+        print("Service: Not running")
+    else:
+        latency = live["validation_latency_ms"]
+        print("Service: Running")
+        print(f"  Validations: {live['validations_per_sec']}/s "
+              f"(p50 {latency['p50']} ms, p99 {latency['p99']} ms)")
+        print(f"  Nonce store: {live['nonce_store_size']} entries")
+        print(f"  Price table: version {live['price_table']['version']}, "
+              f"{live['price_table']['rules']} rules")
+        print(f"  Audit queue: {live['audit_queue_depth']}")
+        for stage, timing in (live.get("trace_stages") or {}).items():
+            print(f"  Stage {stage}: mean {timing['mean_ms']} ms, max {timing['max_ms']} ms")
+
     # Check payment endpoints
     print("Payment endpoints:")
     print(f"  /__tollbot__/validate - Validates payment tokens")
     print(f"  /__tollbot__/request-payment - Requests payment tokens")
+
+
+def fetch_status(
+    path: str, host: str = SERVICE_HOST, port: int = SERVICE_PORT, timeout: float = 2.0
+) -> Optional[dict]:
+    """Get a JSON document from the tollbot service.
+
+    Speaks HTTP/1.0 over a plain socket: urllib would pull ssl and the
+    email package into the startup of every status call.
+
+    Args:
+        path: Service endpoint
+        host: Service address
+        port: Service port
+        timeout: Seconds to wait for an answer
+
+    Returns:
+        dict: Decoded answer, or None if the service is not running
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        head, _, body = b"".join(chunks).partition(b"\r\n\r\n")
+        if head.split(b" ", 2)[1:2] != [b"200"]:
+            return None
+        return json.loads(body)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,5 @@
+"""Tollbot constants."""
+
+# Address of the tollbot service that nginx proxies token requests to
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8402
@@ -0,0 +1,230 @@
+"""Fetching of robots.txt from remote origins."""
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tollbot import __version__
+from tollbot.robots_parser import RobotsParser
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 300
+# Largest robots.txt read; longer bodies are refused, not truncated
+MAX_ROBOTS_SIZE = 512 * 1024
+
+# Outcomes of RobotsFetcher.check()
+PUBLISHED = "published"
+UNCHANGED = "unchanged"
+NOT_MODIFIED = "not_modified"
+FAILED = "failed"
+
+
+@dataclass
+class Origin:
+    """A remote robots.txt and the directory its price table is published in."""
+    url: str
+    config_dir: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # SHA-256 and pricing directives of the last published robots.txt
+    digest: Optional[str] = None
+    pricing: Optional[dict] = None
+    status: Optional[str] = None
+    error: Optional[str] = None
+    checked_at: float = 0.0
+
+
+class RobotsFetcher:
+    """Keep the price tables of remote origins current.
+
+    Each origin's robots.txt is fetched with a conditional GET over one
+    pooled session, so an unchanged file costs a 304 on a kept-alive
+    connection. A changed file is parsed on the worker thread that
+    fetched it and published as robots_cache.json in the origin's
+    config directory, which validators, the service and
+    payment_filter.lua reload when it changes. Bodies identical to the
+    last published one, from servers without validators, are not
+    republished. Failed fetches keep the last published table.
+    """
+
+    def __init__(
+        self,
+        origins: Iterable[Origin],
+        max_workers: int = 8,
+        timeout: float = 10.0,
+        max_size: int = MAX_ROBOTS_SIZE,
+    ):
+        """Initialize fetcher.
+
+        Args:
+            origins: Origins to keep current
+            max_workers: Concurrent fetches, and pooled connections per host
+            timeout: Request timeout in seconds
+            max_size: Largest robots.txt accepted, in bytes
+        """
+        self.origins: List[Origin] = list(origins)
+        self.timeout = timeout
+        self.max_size = max_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, len(self.origins)), pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = f"tollbot/{__version__}"
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="tollbot-fetch")
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> List[Future]:
+        """Check every origin in the background.
+
+        Returns:
+            list: Futures of each origin's check() outcome, in origin order
+        """
+        return [self._pool.submit(self.check, origin) for origin in self.origins]
+
+    def refresh_all(self) -> Dict[str, int]:
+        """Check every origin and wait for the outcomes.
+
+        Returns:
+            dict: Number of origins per outcome
+        """
+        futures = self.refresh()
+        wait(futures)
+        counts: Dict[str, int] = {}
+        for future in futures:
+            outcome = future.result()
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return counts
+
+    def check(self, origin: Origin) -> str:
+        """Fetch an origin's robots.txt and publish its price table if it changed.
+
+        Args:
+            origin: Origin to check
+
+        Returns:
+            str: PUBLISHED, UNCHANGED, NOT_MODIFIED or FAILED
+        """
+        headers = {}
+        if origin.etag:
+            headers["If-None-Match"] = origin.etag
+        if origin.last_modified:
+            headers["If-Modified-Since"] = origin.last_modified
+
+        origin.checked_at = time.time()
+        try:
+            response = self.session.get(
+                origin.url, headers=headers, timeout=self.timeout, stream=True
+            )
+            with response:
+                if response.status_code == 304:
+                    # Drain the empty body so the connection goes back to the pool
+                    response.content
+                    origin.status, origin.error = NOT_MODIFIED, None
+                    return origin.status
+                response.raise_for_status()
+                content = self._read(response)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Could not fetch %s: %s", origin.url, e)
+            origin.status, origin.error = FAILED, str(e)
+            return origin.status
+
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        if digest != origin.digest:
+            try:
+                origin.pricing = self.publish(origin, content)
+            except OSError as e:
+                logger.warning("Could not publish prices of %s: %s", origin.url, e)
+                origin.status, origin.error = FAILED, str(e)
+                return origin.status
+            origin.digest = digest
+            origin.status = PUBLISHED
+        else:
+            origin.status = UNCHANGED
+        origin.etag, origin.last_modified, origin.error = etag, last_modified, None
+        return origin.status
+
+    def _read(self, response: requests.Response) -> str:
+        """Read a robots.txt body, refusing it past max_size bytes."""
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > self.max_size:
+            raise ValueError(f"robots.txt is {length} bytes, over {self.max_size}")
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=16384):
+            body += chunk
+            if len(body) > self.max_size:
+                raise ValueError(f"robots.txt is over {self.max_size} bytes")
+        return body.decode(response.encoding or "utf-8", errors="replace")
+
+    def publish(self, origin: Origin, content: str) -> dict:
+        """Parse a robots.txt and publish its price table.
+
+        Args:
+            origin: Origin the robots.txt came from
+            content: robots.txt content
+
+        Returns:
+            dict: Pricing directives
+        """
+        parser = RobotsParser(cache_size=0)
+        pricing = parser.parse(content)
+        os.makedirs(origin.config_dir, exist_ok=True)
+        parser.save_cache(os.path.join(origin.config_dir, "robots_cache.json"))
+        logger.info("Published %d prices from %s", len(pricing), origin.url)
+        return pricing
+
+    def start(self, interval: float = DEFAULT_INTERVAL):
+        """Check every origin now and then every interval seconds, in a thread.
+
+        Args:
+            interval: Seconds between checks of an origin
+        """
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="tollbot-robots", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop checking and close pooled connections."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pool.shutdown(wait=True)
+        self.session.close()
+
+    def _run(self, interval: float):
+        """Check every origin every interval seconds until closed."""
+        while not self._stopped.is_set():
+            wait(self.refresh())
+            self._stopped.wait(interval)
+
+
+def fetch_pricing(url: str, config_dir: str, timeout: float = 10.0) -> Optional[dict]:
+    """Fetch a remote robots.txt once and publish its price table.
+
+    Args:
+        url: robots.txt URL
+        config_dir: Configuration directory to publish in
+        timeout: Request timeout in seconds
+
+    Returns:
+        dict: Pricing directives, or None if robots.txt could not be fetched
+    """
+    origin = Origin(url, config_dir)
+    fetcher = RobotsFetcher([origin], max_workers=1, timeout=timeout)
+    try:
+        fetcher.check(origin)
+        return origin.pricing
+    finally:
+        fetcher.close()
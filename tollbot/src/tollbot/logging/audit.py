@@ -2,20 +2,35 @@
 import os
 import json
 import logging
+import threading
+import time
 from datetime import datetime, timezone
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 from tollbot.logging.formatters import JsonFormatter
+from tollbot.metrics import Metrics
 
 
 class AuditLogger:
-    """Audit logger for payment validation events."""
+    """Audit logger for payment validation events.
+
+    In aggregate mode, payment requests and failed validations are
+    counted per (event, path prefix, client, window) and written as one
+    summary record when the window closes; one in every ``sample_rate``
+    is also written raw. Successful validations are always written in
+    full.
+    """
 
     def __init__(
         self,
         log_dir: str = "/var/log/tollbot",
         log_format: str = "json",
         retention_days: int = 30,
+        aggregate: bool = False,
+        window: int = 60,
+        sample_rate: int = 0,
+        prefixes: Optional[List[str]] = None,
+        metrics: Optional[Metrics] = None,
     ):
         """Initialize audit logger.
 
@@ -23,10 +38,28 @@ class AuditLogger:
             log_dir: Directory for log files
             log_format: Log format (json, csv, or combined)
             retention_days: Number of days to retain logs
+            aggregate: Summarize rejections instead of logging each one
+            window: Aggregation window in seconds
+            sample_rate: Also log one counted rejection in this many raw
+                (0 for none)
+            prefixes: Path prefixes to aggregate by, e.g. the priced ones;
+                other paths are grouped by their first segment
+            metrics: Metrics to count flushes in
         """
         self.log_dir = log_dir
         self.log_format = log_format
         self.retention_days = retention_days
+        self.aggregate = aggregate
+        self.window = window
+        self.sample_rate = sample_rate
+        self.prefixes = sorted(prefixes or [], key=len, reverse=True)
+        self.metrics = metrics
+
+        # (event, prefix, client_ip, window start) -> [count, amount]
+        self._counts: Dict[Tuple[str, str, Optional[str], int], List[float]] = {}
+        self._window_start = 0
+        self._seen = 0
+        self._lock = threading.Lock()
 
         os.makedirs(log_dir, exist_ok=True)
 
@@ -65,6 +98,11 @@ class AuditLogger:
             client_ip: Client IP address
             error: Error message (if validation failed)
         """
+        if not is_valid and self.aggregate:
+            self._count("validation", path, client_ip, amount)
+            if not self._sample():
+                return
+
         event = {
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "path": path,
@@ -96,6 +134,11 @@ class AuditLogger:
             amount_due: Amount due
             client_ip: Client IP address
         """
+        if self.aggregate:
+            self._count("payment_request", path, client_ip, amount_due)
+            if not self._sample():
+                return
+
         event = {
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "event_type": "payment_request",
@@ -111,6 +154,87 @@ class AuditLogger:
                 f"payment_request path={path} amount_due={amount_due} ip={client_ip}"
             )
 
+    def flush(self, now: Optional[float] = None):
+        """Write summaries for closed windows.
+
+        Args:
+            now: Current time; None writes every pending summary
+        """
+        with self._lock:
+            if now is None:
+                due, self._counts = self._counts, {}
+            else:
+                current = int(now) // self.window * self.window
+                due = {k: v for k, v in self._counts.items() if k[3] < current}
+                for key in due:
+                    del self._counts[key]
+
+        if due and self.metrics is not None:
+            self.metrics.inc("audit_flushes")
+            self.metrics.inc("audit_summaries", len(due))
+
+        for (event_type, prefix, client_ip, start), (count, amount) in sorted(
+            due.items(), key=lambda item: item[0][3]
+        ):
+            summary = {
+                "timestamp": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                "event_type": "summary",
+                "event": event_type,
+                "path_prefix": prefix,
+                "client_ip": client_ip,
+                "window": self.window,
+                "count": int(count),
+                "amount": round(amount, 9),
+            }
+            if self.log_format == "json":
+                self.logger.info(json.dumps(summary))
+            else:
+                self.logger.info(
+                    f"summary event={event_type} prefix={prefix} ip={client_ip} "
+                    f"window={self.window} count={int(count)} amount={summary['amount']}"
+                )
+
+    def close(self):
+        """Write pending summaries."""
+        self.flush()
+
+    @property
+    def pending(self) -> int:
+        """Number of summaries waiting for their window to close."""
+        return len(self._counts)
+
+    def _sample(self) -> bool:
+        """Check whether this rejection should also be logged raw."""
+        if not self.sample_rate:
+            return False
+        with self._lock:
+            self._seen += 1
+            return self._seen % self.sample_rate == 0
+
+    def _count(self, event_type: str, path: str, client_ip: Optional[str], amount: float):
+        """Add a rejection to its window, flushing windows that closed."""
+        now = time.time()
+        start = int(now) // self.window * self.window
+        key = (event_type, self._prefix(path), client_ip, start)
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None:
+                entry = self._counts[key] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += amount or 0.0
+            rolled = start > self._window_start
+            self._window_start = max(start, self._window_start)
+        if rolled:
+            self.flush(now)
+
+    def _prefix(self, path: str) -> str:
+        """Get the prefix a path is aggregated under."""
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return prefix
+        segment = path.split("/", 2)
+        return f"/{segment[1]}/" if len(segment) > 2 else "/"
+
     def export_to_csv(self, output_file: str, start_date: Optional[str] = None):
         """Export logs to CSV format.
 
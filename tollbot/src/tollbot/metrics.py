@@ -0,0 +1,208 @@
+"""Runtime metrics: counters and latency histograms."""
+import bisect
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+
+class _Shard:
+    """Metrics recorded by one thread."""
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters: Dict[tuple, float] = {}
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms: Dict[tuple, list] = {}
+
+
+class Metrics:
+    """Counters and histograms kept per thread and merged when read.
+
+    Each thread records into its own shard without locking, so
+    recording never contends with other threads or with readers.
+    Readers copy every shard and add them up.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS, window: int = 10):
+        """Initialize metrics.
+
+        Args:
+            buckets: Histogram bucket upper bounds in seconds
+            window: Number of tick() samples rates are computed over
+        """
+        self.buckets = buckets
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window + 1)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add to a counter.
+
+        Args:
+            name: Counter name
+            value: Amount to add
+            **labels: Label values
+        """
+        key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a duration in a histogram.
+
+        Args:
+            name: Histogram name
+            seconds: Observed duration
+            **labels: Label values
+        """
+        key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+        histograms = self._shard().histograms
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def counters(self) -> Dict[tuple, float]:
+        """Get all counters, summed over threads."""
+        merged: Dict[tuple, float] = {}
+        for shard in self._all_shards():
+            for key, value in list(shard.counters.items()):
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def histograms(self) -> Dict[tuple, list]:
+        """Get all histograms, summed over threads."""
+        merged: Dict[tuple, list] = {}
+        for shard in self._all_shards():
+            for key, histogram in list(shard.histograms.items()):
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = list(histogram)
+                else:
+                    for i, value in enumerate(histogram):
+                        total[i] += value
+        return merged
+
+    def total(self, name: str) -> float:
+        """Get a counter summed over threads and labels."""
+        return sum(value for (n, _), value in self.counters().items() if n == name)
+
+    def quantile(self, name: str, q: float) -> Optional[float]:
+        """Estimate a quantile of a histogram, summed over labels.
+
+        Args:
+            name: Histogram name
+            q: Quantile between 0 and 1
+
+        Returns:
+            float: Estimated value in seconds, or None if nothing was observed
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        for (n, _), histogram in self.histograms().items():
+            if n == name:
+                for i in range(len(counts)):
+                    counts[i] += histogram[i]
+
+        count = sum(counts)
+        if not count:
+            return None
+
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def tick(self, now: Optional[float] = None):
+        """Sample counter totals for rate(); call about once a second."""
+        totals: Dict[str, float] = {}
+        for (name, _), value in self.counters().items():
+            totals[name] = totals.get(name, 0) + value
+        self._samples.append((time.time() if now is None else now, totals))
+
+    def rate(self, name: str) -> float:
+        """Get the per-second rate of a counter over the sampled window."""
+        if len(self._samples) < 2:
+            return 0.0
+        (start, first), (end, last) = self._samples[0], self._samples[-1]
+        if end <= start:
+            return 0.0
+        return (last.get(name, 0) - first.get(name, 0)) / (end - start)
+
+    def prometheus(self, namespace: str = "tollbot") -> str:
+        """Render metrics in the Prometheus text exposition format.
+
+        Counters get a ``_total`` suffix. Histograms get cumulative
+        ``_bucket`` series plus ``_sum`` and ``_count``, like those the
+        nginx filter renders from its ``tollbot_metrics`` shared dict.
+
+        Args:
+            namespace: Prefix of every metric name
+
+        Returns:
+            str: Exposition text
+        """
+        lines = []
+        family = None
+        for (name, labels), value in sorted(self.counters().items(), key=_series_order):
+            if family != f"{namespace}_{name}_total":
+                family = f"{namespace}_{name}_total"
+                lines.append(f"# TYPE {family} counter")
+            lines.append(f"{family}{_labels(labels)} {value!r}")
+
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for (name, labels), histogram in sorted(self.histograms().items(), key=_series_order):
+            if family != f"{namespace}_{name}":
+                family = f"{namespace}_{name}"
+                lines.append(f"# TYPE {family} histogram")
+            count = 0
+            for bound, bucket_count in zip(bounds, histogram):
+                count += bucket_count
+                lines.append(f"{family}_bucket{_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{family}_sum{_labels(labels)} {histogram[-1]!r}")
+            lines.append(f"{family}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def _shard(self) -> _Shard:
+        """Get the calling thread's shard."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _all_shards(self) -> List[_Shard]:
+        """Get every thread's shard."""
+        with self._lock:
+            return list(self._shards)
+
+
+def _series_order(item) -> tuple:
+    """Sort key grouping the series of a metric together."""
+    (name, labels), _ = item
+    return name, str(labels)
+
+
+def _labels(labels: tuple) -> str:
+    """Render a label set."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
@@ -1,67 +1,454 @@
 """Nginx configuration generator for tollbot."""
+import hashlib
+import logging
+import json
 import os
+import re
+import subprocess
+import time
+from typing import Dict, List, Optional, Sequence
+
+from tollbot.constants import SERVICE_HOST, SERVICE_PORT
+from tollbot.robots_parser import RobotsParser, is_safe_prefix
+
+logger = logging.getLogger(__name__)
+
+LUA_MODULES = (
+    "payment_filter.lua",
+    "tollbot_access.lua",
+    "tollbot_prices.lua",
+    "tollbot_metrics.lua",
+)
+
+# File in the nginx snippet directory naming the domain a directory serves
+DOMAIN_FILE = "domain"
+
+# Domains that can name a site's directory and nginx variables
+_DOMAIN = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)*$")
 
 
 class NginxConfigurator:
-    """Generate nginx configuration for tollbot."""
+    """Generate nginx configuration for tollbot.
+
+    The generated http include holds the shared dicts and worker init
+    of one configuration directory, and the tollbot service answers on
+    one fixed port, so each nginx instance serves a single configuration
+    directory. merge() refuses to add a second one.
 
-    def __init__(self, domain: str, config_dir: str = "/etc/tollbot"):
+    A directory serves one domain, with its price map in the http
+    include, or with ``site`` a fleet of sites sharing the wallet, keys,
+    Lua modules and include. Each site keeps its price table, price map
+    and endpoint locations in ``<config_dir>/<domain>``; the locations
+    set ``$tollbot_site``, which selects the site's prices in the filter
+    and the service, and sites.json lists the sites.
+    """
+
+    def __init__(
+        self,
+        domain: str,
+        config_dir: str = "/etc/tollbot",
+        pricing: Optional[Dict[str, dict]] = None,
+        nginx_bin: str = "nginx",
+        nginx_url: str = "http://127.0.0.1",
+        site: bool = False,
+    ):
         """Initialize configurator.
 
         Args:
             domain: Domain name
             config_dir: Tollbot configuration directory
+            pricing: Price table; defaults to the robots.txt cache
+            nginx_bin: nginx executable
+            nginx_url: Local address nginx serves the domain on
+            site: Configure the domain as one site of config_dir
         """
         self.domain = domain
+        self.site = site
         self.config_dir = config_dir
+        self.pricing = pricing
+        self.nginx_bin = nginx_bin
+        self.nginx_url = nginx_url.rstrip("/")
+        # Hash of the generated configuration, reported by the status endpoint
+        self.generation = ""
+        self.last_error = None
+
+    @classmethod
+    def for_config_dir(cls, config_dir: str, **kwargs) -> List["NginxConfigurator"]:
+        """Get configurators for the domains a configuration directory serves.
+
+        Args:
+            config_dir: Tollbot configuration directory
+            **kwargs: Further constructor arguments
+
+        Returns:
+            list: One configurator per site in sites.json, else one for
+                the domain recorded when nginx was configured, else none
+        """
+        try:
+            with open(os.path.join(config_dir, "sites.json"), "r") as f:
+                sites = json.load(f)["sites"]
+        except (OSError, ValueError, KeyError, TypeError):
+            sites = None
+        if sites:
+            return [cls(domain, config_dir, site=True, **kwargs) for domain in sites]
+
+        try:
+            with open(os.path.join(config_dir, "nginx", DOMAIN_FILE), "r") as f:
+                domain = f.read().strip()
+        except OSError:
+            return []
+        return [cls(domain, config_dir, **kwargs)] if domain else []
+
+    def _get_pricing(self) -> Dict[str, dict]:
+        """Get the price table, loading the robots.txt cache if needed."""
+        if self.pricing is None:
+            parser = RobotsParser()
+            parser.load_cache(os.path.join(self.site_dir, "robots_cache.json"))
+            self.pricing = parser.pricing
+        return self.pricing
+
+    @property
+    def nginx_dir(self) -> str:
+        """Directory holding the generated nginx snippets."""
+        return os.path.join(self.config_dir, "nginx")
+
+    @property
+    def site_dir(self) -> str:
+        """Directory holding the domain's price table.
+
+        Raises:
+            ValueError: If the domain of a site is not a valid domain name
+        """
+        if not self.site:
+            return self.config_dir
+        if not _DOMAIN.match(self.domain):
+            raise ValueError(f"Invalid site domain {self.domain!r}")
+        return os.path.join(self.config_dir, self.domain)
+
+    @property
+    def site_nginx_dir(self) -> str:
+        """Directory holding the domain's price map and endpoint locations."""
+        return os.path.join(self.site_dir, "nginx")
+
+    @property
+    def locations_file(self) -> str:
+        """Endpoint locations included in the domain's server blocks."""
+        return os.path.join(self.site_nginx_dir, "tollbot-locations.conf")
+
+    @property
+    def lua_dir(self) -> str:
+        """Directory holding the installed Lua modules."""
+        return os.path.join(self.config_dir, "lua")
 
     def generate(self):
         """Generate nginx configuration files."""
-        nginx_dir = os.path.join(self.config_dir, "nginx")
-        os.makedirs(nginx_dir, exist_ok=True)
-
-        # Generate include file
-        include_path = os.path.join(nginx_dir, "tollbot-include.conf")
-        with open(include_path, "w") as f:
-            f.write(self._get_include_config())
+        self.write_snippets()
 
         # Generate domain-specific config
-        domain_path = os.path.join(nginx_dir, f"{self.domain}.conf")
+        domain_path = os.path.join(self.nginx_dir, f"{self.domain}.conf")
         with open(domain_path, "w") as f:
             f.write(self._get_domain_config())
 
+    def merge(
+        self, nginx_root: str = "/etc/nginx", others: Sequence["NginxConfigurator"] = ()
+    ) -> List[str]:
+        """Add tollbot to the live nginx configuration.
+
+        The http block gets the tollbot include, server blocks for this
+        domain get the tollbot endpoints, and the locations serving a
+        priced prefix get the access handler. The result is checked with
+        ``nginx -t`` and the changed files restored if it fails. Requires
+        certbot-nginx.
+
+        Args:
+            nginx_root: Directory containing nginx.conf
+            others: Further sites of this configuration directory, with
+                their snippets written, to merge in the same pass
+
+        Returns:
+            list: Files that were modified
+
+        Raises:
+            ValueError: If the merge was refused or rolled back
+        """
+        from tollbot.nginx.merge import ConfigMerger
+
+        self.write_snippets()
+        merger = ConfigMerger(
+            nginx_root, cache_file=os.path.join(self.config_dir, "cache", "nginx-parse.json")
+        )
+        return merger.merge_sites(
+            [
+                (site.domain, site._get_pricing(), site.locations_file)
+                for site in [self, *others]
+            ],
+            include=os.path.join(self.nginx_dir, "tollbot-include.conf"),
+            access=os.path.join(self.lua_dir, "tollbot_access.lua"),
+            test=lambda: self._test_merged(nginx_root),
+        )
+
+    def _test_merged(self, nginx_root: str) -> bool:
+        """Test the nginx configuration under nginx_root."""
+        if not self.test_config(os.path.join(nginx_root, "nginx.conf")):
+            logger.error("nginx configuration test failed: %s", self.last_error)
+            return False
+        return True
+
+    def write_snippets(self) -> bool:
+        """Install the Lua modules and write the tollbot include files.
+
+        Files are only rewritten when their content changes. Prices are
+        not part of the generated configuration, so a price change alone
+        changes nothing here.
+
+        Returns:
+            bool: True if nginx needs a reload to see the changes
+        """
+        changed = self.write_shared()
+        changed |= self.write_site()
+        return changed
+
+    def write_shared(self) -> bool:
+        """Install the Lua modules and write the http include.
+
+        Returns:
+            bool: True if any file changed
+        """
+        os.makedirs(self.nginx_dir, exist_ok=True)
+        changed = self.install_lua()
+        # Generate include file (http context)
+        changed |= _write_if_changed(
+            os.path.join(self.nginx_dir, "tollbot-include.conf"), self._get_include_config()
+        )
+        return changed
+
+    def write_site(self) -> bool:
+        """Write the domain's endpoint locations and, for a site, price map.
+
+        Returns:
+            bool: True if any file changed
+        """
+        site_files = {}
+        if self.site:
+            site_files["tollbot-map.conf"] = self._get_price_map()
+
+        self.generation = ""
+        digest = hashlib.sha256()
+        for content in [self._get_include_config(), self._get_locations_config()] + sorted(
+            list(self._get_lua_files().values()) + list(site_files.values())
+        ):
+            digest.update(content.encode())
+        self.generation = digest.hexdigest()[:16]
+        # Generate endpoint locations (server context)
+        site_files["tollbot-locations.conf"] = self._get_locations_config()
+
+        os.makedirs(self.site_nginx_dir, exist_ok=True)
+        changed = False
+        for name, content in site_files.items():
+            changed |= _write_if_changed(os.path.join(self.site_nginx_dir, name), content)
+        if not self.site:
+            # Lets later commands address nginx by the served domain
+            _write_if_changed(os.path.join(self.nginx_dir, DOMAIN_FILE), self.domain + "\n")
+        return changed
+
+    def install_lua(self, lua: Optional[Dict[str, str]] = None) -> bool:
+        """Copy the Lua modules into the tollbot configuration directory.
+
+        Args:
+            lua: Lua file contents by name; defaults to the packaged modules
+
+        Returns:
+            bool: True if any module changed
+        """
+        os.makedirs(self.lua_dir, exist_ok=True)
+        changed = False
+        for name, content in (lua or self._get_lua_files()).items():
+            changed |= _write_if_changed(os.path.join(self.lua_dir, name), content)
+        return changed
+
+    def _get_lua_files(self) -> Dict[str, str]:
+        """Get the Lua files to install, by name."""
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        files = {}
+        for name in LUA_MODULES:
+            with open(os.path.join(src_dir, name), "r") as f:
+                files[name] = f.read()
+
+        # Worker init entry point, bound to this configuration directory
+        files["tollbot_init.lua"] = f'require("payment_filter").init_worker("{self.config_dir}")\n'
+        return files
+
+    def apply(self) -> bool:
+        """Bring the running nginx up to date with the configuration.
+
+        Structural changes (priced prefixes, endpoints, Lua modules) are
+        tested and reloaded. A price-only change is pushed to the running
+        workers instead, which keeps them and their caches warm.
+
+        Returns:
+            bool: True if nginx is serving the new configuration
+        """
+        if self.write_snippets():
+            return self.reload()
+        return self.publish_prices()
+
+    def publish_prices(self) -> bool:
+        """Push the cached price table to the running nginx workers.
+
+        Workers also load robots_cache.json from their refresh timer, so
+        prices still arrive within a few seconds if the push fails.
+
+        Returns:
+            bool: True if nginx accepted the table
+        """
+        # Deferred: requests is slow to import and only needed here
+        import requests
+
+        cache_file = os.path.join(self.site_dir, "robots_cache.json")
+        try:
+            with open(cache_file, "rb") as f:
+                body = f.read()
+            response = requests.post(
+                f"{self.nginx_url}/__tollbot__/prices",
+                data=body,
+                headers={"Host": self.domain, "Content-Type": "application/json"},
+                timeout=5,
+            )
+            response.close()
+        except (OSError, requests.RequestException) as e:
+            self.last_error = str(e)
+            logger.warning("Could not push prices to nginx: %s", e)
+            return False
+
+        if response.status_code != 200:
+            self.last_error = f"HTTP {response.status_code}"
+            logger.warning("nginx rejected the price table: %s", self.last_error)
+            return False
+        return True
+
     def _get_include_config(self) -> str:
-        """Get nginx include configuration."""
-        return """# Tollbot payment validation configuration
+        """Get nginx include configuration (http context)."""
+        return f"""# Tollbot payment validation configuration
 # Generated by tollbot - do not edit manually
 
+lua_package_path "{self.lua_dir}/?.lua;;";
+
+# Remaining requests per unit token, shared by all workers
+lua_shared_dict tollbot_units 10m;
+lua_shared_dict tollbot_limits 10m;
+# Price table pushed by tollbot, so price changes need no reload
+lua_shared_dict tollbot_config 1m;
+# Validation counters and latency histogram for /__tollbot__/metrics
+lua_shared_dict tollbot_metrics 1m;
+
+# Load wallet and price table once per worker; a timer reloads them when
+# the files change so requests never read from disk.
+init_worker_by_lua_file {os.path.join(self.lua_dir, "tollbot_init.lua")};
+
+{self._get_site_maps() if self.site else self._get_price_map()}"""
+
+    def _get_site_maps(self) -> str:
+        """Get the include of every site's price map (http context)."""
+        return (
+            "# Price map of each site, compiled from its robots.txt\n"
+            f"include {os.path.join(self.config_dir, '*', 'nginx', 'tollbot-map.conf')};\n"
+        )
+
+    def _get_price_map(self) -> str:
+        """Get the map block classifying request paths by price.
+
+        Free paths map to an empty string and are passed through by the
+        filter before any token handling; priced paths map to their
+        prefix, whose price the filter looks up in its live table.
+        Regexes are matched in order, so longer (more specific) prefixes
+        come first.
+        """
+        lines = [
+            "# Priced prefix per path, compiled from robots.txt",
+            f"map $uri ${self._prefix_variable} {{",
+            '    default "";',
+        ]
+        pricing = self._get_pricing()
+        for prefix in sorted(pricing, key=len, reverse=True):
+            if not is_safe_prefix(prefix):
+                logger.warning("Not mapping unsafe price prefix %r", prefix)
+                continue
+            lines.append(f"    {_quote('~^' + re.escape(prefix))} {_quote(prefix)};")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    @property
+    def _prefix_variable(self) -> str:
+        """nginx variable the price map sets."""
+        if not self.site:
+            return "tollbot_prefix"
+        return "tollbot_prefix_" + re.sub(r"[^A-Za-z0-9]", "_", self.domain)
+
+    def _get_locations_config(self) -> str:
+        """Get tollbot endpoint locations (server context)."""
+        site = ""
+        if self.site:
+            site = f"""
+# Site of a shared configuration directory: its prices and price map
+set $tollbot_site {self.domain};
+set $tollbot_prefix ${self._prefix_variable};
+"""
+        # A merged server block may carry the access handler itself;
+        # every endpoint here turns it off, as they are never priced
+        return f"""# Tollbot payment endpoints
+# Generated by tollbot - do not edit manually
+{site}
 # Payment validation location
-location /__tollbot__/validate {
+location /__tollbot__/validate {{
+    access_by_lua_block {{ return }}
     default_type application/json;
-    content_by_lua_file /etc/tollbot/lua/payment_filter.lua;
-}
+    content_by_lua_file {os.path.join(self.lua_dir, "tollbot_access.lua")};
+}}
 
-# Payment request endpoint
-location /__tollbot__/request-payment {
+# Payment request endpoint, served by the tollbot service
+location /__tollbot__/request-payment {{
+    access_by_lua_block {{ return }}
+    proxy_set_header X-Tollbot-Site "{self.domain if self.site else ""}";
+    proxy_pass http://{SERVICE_HOST}:{SERVICE_PORT};
+}}
+
+# Price table updates from the local tollbot service
+location = /__tollbot__/prices {{
+    access_by_lua_block {{ return }}
+    allow 127.0.0.1;
+    deny all;
+    client_body_buffer_size 1m;
+    client_max_body_size 1m;
     default_type application/json;
-    content_by_lua_file /etc/tollbot/lua/request_payment.lua;
-}
+    content_by_lua_file {os.path.join(self.lua_dir, "tollbot_prices.lua")};
+}}
+
+# Prometheus metrics
+location = /__tollbot__/metrics {{
+    access_by_lua_block {{ return }}
+    allow 127.0.0.1;
+    deny all;
+    content_by_lua_file {os.path.join(self.lua_dir, "tollbot_metrics.lua")};
+}}
 
 # Payment status endpoint
-location /__tollbot__/status {
+location /__tollbot__/status {{
+    access_by_lua_block {{ return }}
     default_type application/json;
-    return 200 '{"status": "ok"}';
-}
+    return 200 '{{"status": "ok", "generation": "{self.generation}"}}';
+}}
 """
 
     def _get_domain_config(self) -> str:
         """Get domain-specific nginx configuration."""
+        nginx_dir = self.nginx_dir
+        access = os.path.join(self.lua_dir, "tollbot_access.lua")
         return f"""# Tollbot configuration for {self.domain}
 # Include tollbot payment validation
 
 http {{
     # Include tollbot payment validation
-    include {os.path.join(self.config_dir, "nginx", "tollbot-include.conf")};
+    include {os.path.join(nginx_dir, "tollbot-include.conf")};
 }}
 
 server {{
@@ -73,38 +460,136 @@ server {{
     ssl_certificate /etc/ssl/certs/{self.domain}.crt;
     ssl_certificate_key /etc/ssl/private/{self.domain}.key;
 
+    # Tollbot payment endpoints
+    include {self.locations_file};
+
     # Protect API endpoints
     location /api/ {{
         # Check payment token
-        access_by_lua_block {{
-            tollbot.payment_filter.validate()
-        }}
+        access_by_lua_file {access};
 
         proxy_pass http://localhost:8080;
     }}
 
     # Serve static content
     location / {{
+        # Priced paths only; $tollbot_prefix is empty for free paths
+        access_by_lua_file {access};
+
         root /var/www/{self.domain}/html;
         index index.html;
     }}
 }}
 """
 
-    def reload(self):
-        """Reload nginx configuration."""
-        # Check if nginx is running
-        if os.path.exists("/var/run/nginx.pid"):
-            os.system("nginx -s reload")
-            print("Nginx reloaded successfully")
-        else:
-            print("Nginx is not running")
+    def reload(self, test: bool = True) -> bool:
+        """Test the configuration, reload nginx and check it is serving.
 
-    def test_config(self) -> bool:
+        Args:
+            test: Run ``nginx -t`` first; off when the caller just did
+
+        Returns:
+            bool: True if the new configuration is live
+        """
+        if test and not self.test_config():
+            logger.error("nginx configuration test failed: %s", self.last_error)
+            return False
+
+        if self._run("-s", "reload") is None:
+            logger.error("nginx reload failed: %s", self.last_error)
+            return False
+
+        return self.probe()
+
+    def test_config(self, conf_file: Optional[str] = None) -> bool:
         """Test nginx configuration syntax.
 
+        Args:
+            conf_file: Configuration to test instead of nginx's default
+
         Returns:
             bool: True if configuration is valid
         """
-        result = os.system("nginx -t 2>/dev/null")
-        return result == 0
+        args = ("-t",) if conf_file is None else ("-t", "-c", conf_file)
+        return self._run(*args) is not None
+
+    def probe(self, timeout: float = 10.0, interval: float = 0.2) -> bool:
+        """Wait for nginx to answer the status endpoint after a reload.
+
+        When the configuration was generated in this process, the status
+        must also report its generation, which only new workers do.
+
+        Args:
+            timeout: Seconds to keep trying
+            interval: Seconds between attempts
+
+        Returns:
+            bool: True if the status endpoint answered in time
+        """
+        import requests
+
+        url = f"{self.nginx_url}/__tollbot__/status"
+        deadline = time.monotonic() + timeout
+        with requests.Session() as session:
+            while True:
+                try:
+                    response = session.get(url, headers={"Host": self.domain}, timeout=interval * 5)
+                    status = response.json() if response.status_code == 200 else {}
+                    if status.get("status") == "ok" and (
+                        not self.generation or status.get("generation") == self.generation
+                    ):
+                        return True
+                    self.last_error = f"status endpoint answered {response.status_code}"
+                except (requests.RequestException, ValueError) as e:
+                    self.last_error = str(e)
+
+                if time.monotonic() >= deadline:
+                    logger.error("nginx health probe failed: %s", self.last_error)
+                    return False
+                time.sleep(interval)
+
+    def _run(self, *args: str) -> Optional[str]:
+        """Run nginx with arguments.
+
+        Returns:
+            str: Combined output, or None if it failed (see last_error)
+        """
+        try:
+            result = subprocess.run(
+                [self.nginx_bin, *args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                timeout=60,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.last_error = str(e)
+            return None
+
+        if result.returncode != 0:
+            self.last_error = result.stdout.strip()
+            return None
+        return result.stdout
+
+
+def _write_if_changed(path: str, content: str) -> bool:
+    """Write a file unless it already has this content.
+
+    Returns:
+        bool: True if the file was written
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+
+def _quote(value: str) -> str:
+    """Quote a string for nginx configuration."""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
@@ -0,0 +1,326 @@
+"""Merge tollbot into an existing nginx configuration.
+
+Uses the nginx parser from certbot-nginx, which is an optional
+dependency; import this module only when merging. certbot-nginx has no
+public parser API, so the supported versions are pinned in the ``nginx``
+extra and checked here on import.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import pyparsing
+from certbot_nginx._internal import nginxparser
+from certbot_nginx._internal.parser import NginxParser, get_best_match
+
+logger = logging.getLogger(__name__)
+
+if not callable(getattr(NginxParser, "_parse_files", None)):
+    raise ImportError("unsupported certbot-nginx version: NginxParser._parse_files is missing")
+
+ACCESS_DIRECTIVES = ("access_by_lua", "access_by_lua_block", "access_by_lua_file")
+INCLUDE_NAME = "tollbot-include.conf"
+# Suffix of the copies kept of files merge() rewrites
+BACKUP_EXT = ".tollbot.bak"
+MARKER = ["#", " managed by tollbot"]
+
+
+class CachedNginxParser(NginxParser):
+    """NginxParser that reuses the parse trees of unchanged files.
+
+    Raw trees are kept in a JSON cache keyed by path, mtime and size, so
+    a repeated run only parses the files changed since the last one.
+    """
+
+    def __init__(self, root: str, cache_file: Optional[str] = None):
+        """Initialize parser and load the configuration.
+
+        Args:
+            root: Directory containing nginx.conf
+            cache_file: Parse cache path; None disables caching
+        """
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._cache: Dict[str, dict] = self._load_cache()
+        super().__init__(root)
+        self.save_cache()
+
+    def _parse_files(self, filepath: str, override: bool = False) -> dict:
+        """Parse files from a glob, answering from the cache when possible."""
+        trees = {}
+        for filename in glob.glob(filepath):
+            if filename in self.parsed and not override:
+                continue
+            try:
+                stamp = self._stamp(filename)
+                entry = self._cache.get(filename)
+                if entry is not None and entry["stamp"] == stamp:
+                    raw = entry["tree"]
+                    self.hits += 1
+                else:
+                    with open(filename, "r", encoding="utf-8") as f:
+                        raw = nginxparser.RawNginxParser(f.read()).as_list()
+                    self._cache[filename] = {"stamp": stamp, "tree": raw}
+                    self.misses += 1
+            except OSError:
+                logger.warning("Could not open file: %s", filename)
+                continue
+            except UnicodeDecodeError:
+                logger.warning("Could not read file: %s", filename)
+                continue
+            except pyparsing.ParseException:
+                logger.warning("Could not parse file: %s", filename)
+                continue
+
+            tree = nginxparser.UnspacedList(raw)
+            self.parsed[filename] = tree
+            trees[filename] = tree
+        return trees
+
+    def refresh_cache(self, filenames: List[str]):
+        """Store the current trees of files that were just written."""
+        for filename in filenames:
+            self._cache[filename] = {
+                "stamp": self._stamp(filename),
+                "tree": self.parsed[filename].spaced,
+            }
+        self.save_cache()
+
+    def save_cache(self):
+        """Write the parse cache, dropping files no longer in the tree."""
+        if not self.cache_file:
+            return
+        cache = {name: entry for name, entry in self._cache.items() if name in self.parsed}
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, self.cache_file)
+
+    def _load_cache(self) -> Dict[str, dict]:
+        """Read the parse cache."""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _stamp(filename: str) -> List[int]:
+        """Get the cache stamp of a file."""
+        st = os.stat(filename)
+        return [st.st_mtime_ns, st.st_size]
+
+
+class ConfigMerger:
+    """Add tollbot directives to the server blocks of a live nginx tree."""
+
+    def __init__(self, nginx_root: str = "/etc/nginx", cache_file: Optional[str] = None):
+        """Initialize merger.
+
+        Args:
+            nginx_root: Directory containing nginx.conf
+            cache_file: Parse cache path
+        """
+        self.parser = CachedNginxParser(nginx_root, cache_file)
+
+    def merge(
+        self,
+        domain: str,
+        pricing: Dict[str, dict],
+        include: str,
+        locations: str,
+        access: str,
+        test: Optional[Callable[[], bool]] = None,
+    ) -> List[str]:
+        """Add tollbot to the configuration and write the changed files.
+
+        The http block gets ``include``. Each server block serving
+        ``domain`` gets ``locations``, and every location in it covering
+        a priced prefix gets ``access_by_lua_file``. Prefixes no location
+        covers are protected at the server level. Directives already in
+        place are left alone, so merging again changes nothing.
+
+        The http include declares the shared dicts, price map and worker
+        init of one configuration directory, so an nginx instance serves
+        one; more domains can share it, but not a second directory.
+
+        Each file is copied to ``<file>.tollbot.bak`` before it is
+        rewritten. If ``test`` then rejects the configuration, the copies
+        are put back.
+
+        Args:
+            domain: Server name to configure
+            pricing: Price table by path prefix
+            include: Tollbot http-context include file
+            locations: Tollbot endpoint locations file
+            access: Lua access handler file
+            test: Configuration test run on the written files, e.g.
+                ``nginx -t``; returns False to roll the merge back
+
+        Returns:
+            list: Files that were modified
+
+        Raises:
+            ValueError: If nginx already includes another configuration
+                directory's tollbot include, or ``test`` failed
+        """
+        return self.merge_sites([(domain, pricing, locations)], include, access, test)
+
+    def merge_sites(
+        self,
+        sites: Iterable[Tuple[str, Dict[str, dict], str]],
+        include: str,
+        access: str,
+        test: Optional[Callable[[], bool]] = None,
+    ) -> List[str]:
+        """Add several domains of one configuration directory in one pass.
+
+        Same as merge(), with the files written and tested once.
+
+        Args:
+            sites: (domain, price table, endpoint locations file) per domain
+            include: Tollbot http-context include file
+            access: Lua access handler file
+            test: Configuration test run on the written files
+
+        Returns:
+            list: Files that were modified
+
+        Raises:
+            ValueError: If nginx already includes another configuration
+                directory's tollbot include, or ``test`` failed
+        """
+        others = self._tollbot_includes() - {include}
+        if others:
+            raise ValueError(
+                f"nginx already includes {sorted(others)[0]}; "
+                "tollbot supports one configuration directory per nginx instance"
+            )
+
+        self._add_directive(self._http_block(), ["include", include])
+
+        vhosts = self.parser.get_vhosts()
+        for domain, pricing, locations in sites:
+            prefixes = list(pricing)
+            for vhost in vhosts:
+                if get_best_match(domain, vhost.names)[0] is None:
+                    continue
+                server = self._server_block(vhost)
+                self._add_directive(server, ["include", locations])
+                if prefixes:
+                    self._protect(server, prefixes, access)
+
+        changed = [name for name, tree in self.parser.parsed.items() if tree.is_dirty()]
+        if not changed:
+            return changed
+        for filename in changed:
+            shutil.copy2(filename, filename + BACKUP_EXT)
+        self.parser.filedump(ext="")
+
+        if test is not None and not test():
+            for filename in changed:
+                os.replace(filename + BACKUP_EXT, filename)
+            raise ValueError("nginx rejected the merged configuration; original files restored")
+        self.parser.refresh_cache(changed)
+        return changed
+
+    def _http_block(self):
+        """Get the http block of the configuration."""
+        for entry in self.parser.parsed[self.parser.http_path]:
+            if entry and entry[0] == ["http"]:
+                return entry[1]
+        raise ValueError("No nginx http block found")
+
+    def _tollbot_includes(self) -> set:
+        """Get the tollbot http includes anywhere in the configuration."""
+        found = set()
+        blocks = list(self.parser.parsed.values())
+        while blocks:
+            for entry in blocks.pop():
+                if not entry:
+                    continue
+                if isinstance(entry[0], list):
+                    blocks.extend(item for item in entry[1:] if isinstance(item, list))
+                elif (
+                    entry[0] == "include"
+                    and len(entry) > 1
+                    and os.path.basename(entry[1]) == INCLUDE_NAME
+                ):
+                    found.add(entry[1])
+        return found
+
+    def _server_block(self, vhost):
+        """Get the parsed contents of a vhost's server block."""
+        entry = self.parser.parsed[vhost.filep]
+        for index in vhost.path:
+            entry = entry[index]
+        return entry[1]
+
+    def _protect(self, server, prefixes: List[str], access: str):
+        """Add the access handler to the locations covering priced prefixes."""
+        uncovered = set(prefixes)
+        for entry in server:
+            if not entry or not isinstance(entry[0], list) or entry[0][0] != "location":
+                continue
+            args = [arg.strip("\"'") for arg in entry[0][1:]]
+            modifier, uri = (args[0], args[1]) if len(args) > 1 else (None, args[0])
+            if not _covers(modifier, uri, prefixes):
+                continue
+            self._add_access(entry[1], access, " ".join(entry[0]))
+            if modifier in (None, "^~"):
+                uncovered -= {prefix for prefix in prefixes if prefix.startswith(uri)}
+
+        if uncovered:
+            self._add_access(server, access, "server")
+
+    def _add_access(self, block, access: str, name: str):
+        """Add the access handler to a block unless it has one."""
+        for directive in block:
+            if directive and directive[0] in ACCESS_DIRECTIVES:
+                if directive != ["access_by_lua_file", access]:
+                    logger.warning("Skipping %s: it already has %s", name, directive[0])
+                return
+        self._add_directive(block, ["access_by_lua_file", access])
+
+    @staticmethod
+    def _add_directive(block, directive: List[str]):
+        """Insert a directive at the top of a block unless it is there."""
+        if directive in block:
+            return
+
+        indent = "\n    "
+        for item in block.spaced:
+            first = item[0] if isinstance(item, list) and item else None
+            if isinstance(first, list):
+                first = first[0] if first else None
+            if isinstance(first, str) and "\n" in first and first.isspace():
+                indent = first[first.rindex("\n"):]
+                break
+
+        spaced = [indent]
+        for i, arg in enumerate(directive):
+            spaced.extend([" ", arg] if i else [arg])
+        block.insert(0, spaced)
+        block.insert(1, [" "] + MARKER)
+
+
+def _covers(modifier: Optional[str], uri: str, prefixes: List[str]) -> bool:
+    """Check whether a location can serve a priced path.
+
+    Regex locations can match anywhere, so they are always covered;
+    named locations never are.
+    """
+    if uri.startswith("@"):
+        return False
+    if modifier in ("~", "~*"):
+        return True
+    if modifier == "=":
+        return any(uri.startswith(prefix) for prefix in prefixes)
+    return any(prefix.startswith(uri) or uri.startswith(prefix) for prefix in prefixes)
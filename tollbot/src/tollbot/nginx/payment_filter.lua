@@ -1,24 +1,171 @@
 -- Tollbot payment validation filter for nginx/luajit
 local cjson = require "cjson"
+local bit = require "bit"
 local hmac = require "resty.hmac"
-local sha256 = require "resty.sha256"
 local lrucache = require "resty.lrucache"
+local b64 = require "ngx.base64"
 
--- Cache for payment tokens
-local cache, err = lrucache.new(1000)
+local decode_base64url = b64.decode_base64url
+
+local DEFAULT_PRICE = 0.001
+local REFRESH_INTERVAL = 5
+local TOKEN_TTL = 3600
+local TOKEN_CACHE_SIZE = 10000
+local PRICE_CACHE_SIZE = 4096
+
+-- Defaults of config.ini's rate_limit, the rejections per second
+-- refilled into each client's bucket, and rate_burst, the bucket size
+-- (see tollbot.payment.ratelimit.RateLimiter)
+local RATE_LIMIT = 1
+local RATE_BURST = 20
+
+-- Rejection bodies are encoded once, not per request
+local BODY_PAYMENT_REQUIRED = cjson.encode({error = "Payment required"}) .. "\n"
+local BODY_EXHAUSTED = cjson.encode({error = "Payment token exhausted"}) .. "\n"
+local BODY_INVALID = cjson.encode({error = "Invalid payment token"}) .. "\n"
+local BODY_THROTTLED = cjson.encode({error = "Too many unpaid requests"}) .. "\n"
+local BODY_MISDIRECTED = cjson.encode({error = "Token belongs to another shard"}) .. "\n"
+local BODY_UNAVAILABLE = cjson.encode({error = "Token store unavailable"}) .. "\n"
+
+-- Not among the ngx.HTTP_* constants of older lua-nginx-module releases
+local HTTP_MISDIRECTED_REQUEST = 421
+
+-- Encoded headers written by TokenManager.encode_token, {"alg": ...,
+-- "typ": "tollbot"} or "tollbot-prepaid" (PrepaidToken); compared as
+-- strings, never decoded.
+local TOKEN_HEADERS = {
+    ["eyJhbGciOiAiSFMyNTYiLCAidHlwIjogInRvbGxib3QifQ"] = {eddsa = false, prepaid = false},
+    ["eyJhbGciOiAiSFMyNTYiLCAidHlwIjogInRvbGxib3QtcHJlcGFpZCJ9"] = {eddsa = false, prepaid = true},
+    ["eyJhbGciOiAiRWREU0EiLCAidHlwIjogInRvbGxib3QifQ"] = {eddsa = true, prepaid = false},
+    ["eyJhbGciOiAiRWREU0EiLCAidHlwIjogInRvbGxib3QtcHJlcGFpZCJ9"] = {eddsa = true, prepaid = true},
+}
+
+-- lfs is optional; without it the refresh timer compares file contents
+local has_lfs, lfs = pcall(require, "lfs")
+
+-- lua-resty-openssl is optional; it is needed to verify Ed25519 (EdDSA)
+-- tokens, for which this node only holds the public key (verify.pem).
+-- While verify.pem exists HS256 tokens are refused, even if signing.key
+-- is still around.
+local has_pkey, pkey = pcall(require, "resty.openssl.pkey")
+
+-- resty.redis is needed with a redis:// store_url in config.ini: a
+-- token's count is read from the store shared with other nodes the
+-- first time this node sees it, and spends are pushed back to it (see
+-- tollbot.payment.store.RedisUnitMeter). Without resty.redis such
+-- tokens are refused rather than counted on this node alone.
+local has_redis, redis = pcall(require, "resty.redis")
+local STORE_FLUSH_INTERVAL = 0.05
+local STORE_UNITS_PREFIX = "tollbot:u:"
+local STORE_TIMEOUT_MS = 1000
+
+-- Verified tokens by their encoded form, so repeat presentations of a
+-- unit token skip decoding and signature checks on this worker
+local cache, err = lrucache.new(TOKEN_CACHE_SIZE)
 if not cache then
     ngx.log(ngx.ERR, "failed to create cache: ", err)
 end
 
--- Load wallet configuration
-local function load_wallet_config()
-    local f = io.open("/etc/tollbot/wallet.conf", "r")
+-- Normalized path and minimum price by request URI for the installed
+-- price table (see tollbot.price_cache.PriceCache), emptied when a new
+-- table arrives
+local price_cache = lrucache.new(PRICE_CACHE_SIZE)
+
+-- Remaining requests per token nonce, shared by all workers
+local units = ngx.shared.tollbot_units
+if not units then
+    ngx.log(ngx.ERR, "lua_shared_dict tollbot_units is not configured")
+end
+
+-- Theoretical arrival time per client, shared by all workers
+local limits = ngx.shared.tollbot_limits
+
+-- Latest price table pushed by tollbot ("prices") and its version
+-- ("prices_version"), picked up by every worker's refresh timer
+local config = ngx.shared.tollbot_config
+
+-- Prometheus series by their full name, shared by all workers. Latency
+-- buckets are counted per bucket and made cumulative when rendered.
+local metrics = ngx.shared.tollbot_metrics
+
+-- Same bounds as tollbot.metrics.LATENCY_BUCKETS, in seconds
+local LATENCY_BUCKETS = {
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+}
+local LATENCY_HISTOGRAM = "tollbot_validation_seconds"
+local LATENCY_BUCKET_KEYS = {}
+for i, bound in ipairs(LATENCY_BUCKETS) do
+    LATENCY_BUCKET_KEYS[i] = string.format('%s_bucket{le="%g"}', LATENCY_HISTOGRAM, bound)
+end
+LATENCY_BUCKET_KEYS[#LATENCY_BUCKETS + 1] = LATENCY_HISTOGRAM .. '_bucket{le="+Inf"}'
+
+-- Per-worker state, populated by init_worker() and the refresh timer so
+-- that the request path never touches the disk.
+local state = {
+    config_dir = "/etc/tollbot",
+    wallet = nil,
+    signer = nil,
+    prices = {by_prefix = {}, version = 0},
+    -- Price tables of the sites sharing the configuration directory, by
+    -- domain; a site's server block sets $tollbot_site to its domain
+    sites = {},
+}
+local loaded = {}
+local NO_PRICES = {by_prefix = {}, version = 0}
+
+-- Spends not yet pushed to the shared store, by unit key. Per worker:
+-- the flush timer runs in the worker that recorded them.
+local pending_spends = {}
+local flush_scheduled = false
+
+local function count(series, value)
+    if metrics then
+        metrics:incr(series, value or 1, 0)
+    end
+end
+
+local function observe_latency(seconds)
+    if not metrics then
+        return
+    end
+    local i = 1
+    while i <= #LATENCY_BUCKETS and seconds > LATENCY_BUCKETS[i] do
+        i = i + 1
+    end
+    metrics:incr(LATENCY_BUCKET_KEYS[i], 1, 0)
+    metrics:incr(LATENCY_HISTOGRAM .. "_sum", seconds, 0)
+    metrics:incr(LATENCY_HISTOGRAM .. "_count", 1, 0)
+end
+
+local function read_file(path)
+    local f = io.open(path, "r")
     if not f then
         return nil
     end
     local content = f:read("*a")
     f:close()
+    return content
+end
+
+local function file_exists(path)
+    local f = io.open(path, "rb")
+    if not f then
+        return false
+    end
+    f:close()
+    return true
+end
+
+local function file_mtime(path)
+    if not has_lfs then
+        return nil
+    end
+    return lfs.attributes(path, "modification")
+end
 
+-- Parse wallet configuration
+local function parse_wallet_config(content)
     local config = {}
     for line in content:gmatch("[^\r\n]+") do
         local key, value = line:match("^([^=]+)=(.*)$")
@@ -29,115 +176,754 @@ local function load_wallet_config()
     return config
 end
 
--- Validate payment token
-local function validate_token(token, path)
-    -- Parse token (JWT format)
-    local parts = {}
-    for part in token:gmatch("[^%.]+") do
-        table.insert(parts, part)
+-- Build the HMAC context once so requests only hash the payload
+local function parse_signing_key(content)
+    local key = content:match("^%s*(.-)%s*$")
+    if key == "" then
+        return nil
     end
+    return hmac:new(key, hmac.ALGOS.SHA256)
+end
 
-    if #parts ~= 3 then
-        ngx.log(ngx.WARN, "Invalid token format")
+-- Load the Ed25519 public key that EdDSA tokens are verified with
+local function parse_verify_key(content)
+    if not has_pkey then
+        error("lua-resty-openssl is required for Ed25519 tokens")
+    end
+    local key, err = pkey.new(content)
+    if not key then
+        error(err)
+    end
+    return key
+end
+
+-- Compile robots_cache.json into a list ordered by prefix length, so the
+-- first match is also the most specific one, plus an index by prefix
+-- for the prefix matched by the generated map.
+local function parse_price_table(content)
+    local cache = cjson.decode(content)
+    local prices = {by_prefix = {}, version = tonumber(cache.version) or 0}
+    for prefix, info in pairs(cache.pricing or {}) do
+        local rule = {prefix = prefix, price = info.price, unit = info.unit}
+        prices[#prices + 1] = rule
+        prices.by_prefix[prefix] = rule
+    end
+    table.sort(prices, function(a, b) return #a.prefix > #b.prefix end)
+    return prices
+end
+
+-- GCRA parameters of a rate limit, or false if limiting is off
+local function rate_settings(limit, burst)
+    limit = tonumber(limit) or RATE_LIMIT
+    burst = math.floor(tonumber(burst) or RATE_BURST)
+    if limit <= 0 then
         return false
     end
+    local interval = 1 / limit
+    return {interval = interval, tolerance = burst * interval}
+end
 
-    -- Decode header
-    local header_b64 = parts[1]
-    local header = cjson.decode(base64_decode(header_b64))
+local DEFAULT_RATE = rate_settings()
+
+-- Read this node's shard, rate limit and the shared store address out
+-- of config.ini (JSON). Only redis://[:password@]host[:port][/db]
+-- stores are understood here.
+local function parse_settings(content)
+    local config = cjson.decode(content)
+    if type(config) ~= "table" then
+        return {rate = DEFAULT_RATE}
+    end
+    local settings = {
+        shard = tonumber(config.shard_id),
+        rate = rate_settings(config.rate_limit, config.rate_burst),
+    }
+    local url = config.store_url
+    local rest = type(url) == "string" and url:match("^redis://(.*)$")
+    if not rest then
+        return settings
+    end
+    local password
+    local at = rest:find("@", 1, true)
+    if at then
+        password = rest:sub(1, at - 1):gsub("^:", "")
+        rest = rest:sub(at + 1)
+    end
+    local host, port, db = rest:match("^([^:/]+):?(%d*)/?(%d*)$")
+    if not host then
+        error("invalid store_url " .. url)
+    end
+    settings.store = {
+        host = host,
+        port = tonumber(port) or 6379,
+        db = tonumber(db) or 0,
+        password = password ~= "" and password or nil,
+    }
+    return settings
+end
 
-    -- Decode payload
-    local payload_b64 = parts[2]
-    local payload = cjson.decode(base64_decode(payload_b64))
+-- Decode sites.json, the domains whose price tables are in
+-- <config_dir>/<domain>/robots_cache.json (see tollbot init --manifest)
+local function parse_sites(content)
+    local data = cjson.decode(content)
+    local sites = {}
+    for _, site in ipairs(type(data) == "table" and data.sites or {}) do
+        if type(site) == "string" and site:match("^[%w%.%-]+$") and not site:find("..", 1, true) then
+            sites[#sites + 1] = site
+        else
+            ngx.log(ngx.ERR, "ignoring invalid site ", tostring(site))
+        end
+    end
+    return sites
+end
 
-    -- Verify signature
-    local signature_b64 = parts[3]
-    local wallet_config = load_wallet_config()
-    if not wallet_config then
-        ngx.log(ngx.ERR, "Failed to load wallet config")
-        return false
+-- Decode revoked.json (see tollbot.payment.revocation.RevocationList)
+local function parse_revocations(content)
+    local data = cjson.decode(content)
+    local bitmap = ngx.decode_base64(data.bitmap or "")
+    if not bitmap then
+        error("invalid bitmap")
     end
+    return {base = tonumber(data.base) or 0, bitmap = bitmap, version = data.version}
+end
 
-    -- TODO: Implement signature verification
-    -- For now, just check if token exists in cache
-    local cache_key = "token:" .. payload.nonce
-    if cache:get(cache_key) then
-        ngx.log(ngx.WARN, "Token already used (replay attack)")
+-- Check a prepaid token serial against the revocation bitmap
+local function is_revoked(serial)
+    local revoked = state.revoked
+    if not revoked then
         return false
     end
+    local index = serial - revoked.base
+    if index < 0 then
+        return false
+    end
+    local byte = revoked.bitmap:byte(math.floor(index / 8) + 1)
+    return byte ~= nil and bit.band(byte, bit.lshift(1, index % 8)) ~= 0
+end
+
+-- Price table of a site, or of the configuration directory for nil
+local function site_prices(site)
+    if not site then
+        return state.prices
+    end
+    local entry = state.sites[site]
+    return entry and entry.prices or NO_PRICES
+end
 
-    -- Mark token as used
-    cache:set(cache_key, true, 3600)  -- 1 hour TTL
+-- Install a price table unless a newer one is already in place, since
+-- tables arrive both from robots_cache.json and from pushes
+local function set_prices(prices, site)
+    local target = state
+    if site then
+        target = state.sites[site]
+        if not target then
+            target = {prices = NO_PRICES}
+            state.sites[site] = target
+        end
+    end
+    if prices.version >= target.prices.version then
+        target.prices = prices
+        price_cache:flush_all()
+    end
+end
+
+-- Keys of a site's pushed price table in the tollbot_config dict
+local function pushed_keys(site)
+    if not site then
+        return "prices", "prices_version"
+    end
+    return "prices:" .. site, "prices_version:" .. site
+end
+
+-- Reload a file into state[name] if it changed since the last load
+local function refresh_file(name, path, parse, apply)
+    local mtime = file_mtime(path)
+    local last = loaded[name]
+    if mtime and last and last.mtime == mtime then
+        return
+    end
+
+    local content = read_file(path)
+    if not content then
+        return
+    end
+    if last and last.content == content then
+        return
+    end
+
+    local ok, value = pcall(parse, content)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to load ", path, ": ", value)
+        return
+    end
+
+    if apply then
+        apply(value)
+    else
+        state[name] = value
+    end
+    loaded[name] = {mtime = mtime, content = (not mtime) and content or nil}
+end
+
+-- Reload the price table of a site, or of the configuration directory
+-- for nil, from its robots_cache.json or a newer pushed table
+local function refresh_prices(site)
+    local dir, name = state.config_dir, "prices"
+    if site then
+        dir, name = dir .. "/" .. site, "prices:" .. site
+    end
+    refresh_file(name, dir .. "/robots_cache.json", parse_price_table, function(prices)
+        set_prices(prices, site)
+    end)
+
+    -- Pick up a pushed price table
+    local prices_key, version_key = pushed_keys(site)
+    local version = config and config:get(version_key)
+    if version and version > site_prices(site).version then
+        local ok, prices = pcall(parse_price_table, config:get(prices_key))
+        if ok then
+            set_prices(prices, site)
+        else
+            ngx.log(ngx.ERR, "failed to load pushed prices: ", prices)
+        end
+    end
+end
+
+local function refresh(premature)
+    if premature then
+        return
+    end
+    refresh_file("settings", state.config_dir .. "/config.ini", parse_settings)
+    refresh_file("wallet", state.config_dir .. "/wallet.conf", parse_wallet_config)
+    refresh_file("signer", state.config_dir .. "/signing.key", parse_signing_key)
+    refresh_file("verifier", state.config_dir .. "/verify.pem", parse_verify_key)
+    local eddsa_only = state.verifier ~= nil or file_exists(state.config_dir .. "/verify.pem")
+    if eddsa_only and not state.eddsa_only then
+        -- Drop HS256 tokens verified before the switch
+        cache:flush_all()
+    end
+    state.eddsa_only = eddsa_only
+    refresh_file("revoked", state.config_dir .. "/revoked.json", parse_revocations)
+
+    refresh_prices(nil)
+    refresh_file("site_names", state.config_dir .. "/sites.json", parse_sites)
+    local listed = {}
+    for _, site in ipairs(state.site_names or {}) do
+        listed[site] = true
+        refresh_prices(site)
+    end
+    for site in pairs(state.sites) do
+        if not listed[site] then
+            state.sites[site] = nil
+        end
+    end
+end
+
+-- Load configuration once per worker and keep it fresh from a timer
+local function init_worker(config_dir, interval)
+    state.config_dir = config_dir or state.config_dir
+    refresh()
+
+    local ok, err = ngx.timer.every(interval or REFRESH_INTERVAL, refresh)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to create refresh timer: ", err)
+    end
+end
+
+-- Canonical form of a request URI: no query or fragment, percent-decoded,
+-- repeated slashes collapsed and dot segments removed, keeping a trailing
+-- slash. Same steps as tollbot.uri.normalize_path; keep them in step
+-- (tests/uri_vectors.json holds the cases both must agree on).
+local function normalize_path(uri)
+    local path = uri
+    local stop = path:find("[?#]")
+    if stop then
+        path = path:sub(1, stop - 1)
+    end
+    local encoded = path:find("%", 1, true)
+    if path:byte(1) == 47 and not encoded and not path:find("//", 1, true)
+            and not path:find("/.", 1, true) then
+        return path
+    end
+
+    if encoded then
+        -- ngx.unescape_uri decodes "+" as a space, as in query strings;
+        -- in a path it is a literal "+", as Python's unquote keeps it
+        path = ngx.unescape_uri((path:gsub("%+", "%%2B")))
+    end
+    if path:byte(1) ~= 47 then
+        path = "/" .. path
+    end
+    local segments = {}
+    for segment in path:gmatch("/([^/]*)") do
+        segments[#segments + 1] = segment
+    end
+    local out, n = {}, 0
+    local last = #segments
+    for i = 1, last do
+        local segment = segments[i]
+        if segment ~= ".." and segment ~= "." and segment ~= "" then
+            n = n + 1
+            out[n] = segment
+        else
+            if segment == ".." and n > 0 then
+                out[n] = nil
+                n = n - 1
+            end
+            if i == last then
+                n = n + 1
+                out[n] = ""
+            end
+        end
+    end
+    return "/" .. table.concat(out, "/")
+end
+
+-- Get the normalized path and minimum price of a request URI on a
+-- site, or on the configuration directory's own domain for nil
+local function lookup(uri, site)
+    -- Request URIs never contain spaces, so site keys cannot collide
+    local key = site and site .. " " .. uri or uri
+    local entry = price_cache:get(key)
+    if entry then
+        count("tollbot_price_cache_hits_total")
+        return entry[1], entry[2]
+    end
+    count("tollbot_price_cache_misses_total")
+
+    local path = normalize_path(uri)
+    local price = DEFAULT_PRICE
+    local prices = site_prices(site)
+    for i = 1, #prices do
+        local rule = prices[i]
+        if path:sub(1, #rule.prefix) == rule.prefix then
+            price = rule.price
+            break
+        end
+    end
+    price_cache:set(key, {path, price})
+    return path, price
+end
+
+-- Get minimum price for path
+local function get_min_price(path, site)
+    local _, price = lookup(path, site)
+    return price
+end
 
-    -- Check path matches
-    if payload.path ~= path then
-        ngx.log(ngx.WARN, "Path mismatch: expected ", path, " got ", payload.path)
+-- Verify the Ed25519 signature over the raw payload bytes
+local function verify_eddsa(payload_json, signature)
+    local verifier = state.verifier
+    if not verifier then
+        ngx.log(ngx.ERR, "Ed25519 verify key not loaded")
         return false
     end
+    return verifier:verify(signature, payload_json) == true
+end
 
-    -- Check amount
-    local min_amount = get_min_price(path)
-    if payload.amount < min_amount then
-        ngx.log(ngx.WARN, "Insufficient payment: ", payload.amount, " < ", min_amount)
+-- Verify the signature over the raw payload bytes
+local function verify_signature(payload_json, signature_b64, eddsa)
+    if eddsa then
+        local signature = decode_base64url(signature_b64)
+        return signature ~= nil and verify_eddsa(payload_json, signature)
+    end
+
+    if state.eddsa_only then
+        ngx.log(ngx.WARN, "HS256 token refused: tokens are signed with Ed25519")
+        return false
+    end
+    local signer = state.signer
+    if not signer then
+        ngx.log(ngx.ERR, "Signing key not loaded")
         return false
     end
 
-    return true
+    local signature = decode_base64url(signature_b64)
+    local expected = signer:final(payload_json)
+    signer:reset()
+
+    -- Lua strings are interned, so equality is a pointer comparison
+    return signature ~= nil and signature == expected
 end
 
--- Get minimum price for path
-local function get_min_price(path)
-    -- Load from robots_cache.json
-    local f = io.open("/etc/tollbot/robots_cache.json", "r")
-    if not f then
-        return 0.001  -- Default price
+-- Decode and verify a token (header.payload.signature, see
+-- TokenManager.encode_token). Returns the cache entry or nil.
+local function verify_token(token)
+    local dot1 = token:find(".", 1, true)
+    local dot2 = dot1 and token:find(".", dot1 + 1, true)
+    local kind = dot2 and TOKEN_HEADERS[token:sub(1, dot1 - 1)]
+    if not kind then
+        ngx.log(ngx.WARN, "Invalid token format")
+        return nil
     end
 
-    local content = f:read("*a")
-    f:close()
+    local payload_json = decode_base64url(token:sub(dot1 + 1, dot2 - 1))
+    if not payload_json or not verify_signature(payload_json, token:sub(dot2 + 1), kind.eddsa) then
+        ngx.log(ngx.WARN, "Invalid token signature")
+        return nil
+    end
 
-    local cache = cjson.decode(content)
-    local pricing = cache.pricing
+    local ok, payload = pcall(cjson.decode, payload_json)
+    if not ok or type(payload) ~= "table" then
+        ngx.log(ngx.WARN, "Invalid token payload")
+        return nil
+    end
+
+    -- Prepaid tokens carry their own window and quota and are counted
+    -- on this node only
+    if kind.prepaid then
+        return {
+            path = payload.path,
+            amount = payload.amount,
+            unit = math.max(tonumber(payload.quota) or 1, 1),
+            not_before = payload.not_before,
+            expires = payload.not_after,
+            key = "p:" .. payload.serial,
+            serial = payload.serial,
+        }
+    end
 
-    for prefix, info in pairs(pricing) do
-        if path:sub(1, #prefix) == prefix then
-            return info.price
+    return {
+        path = payload.path,
+        amount = payload.amount,
+        unit = math.max(tonumber(payload.unit) or 1, 1),
+        expires = payload.timestamp + TOKEN_TTL,
+        key = "u:" .. payload.nonce,
+        nonce = payload.nonce,
+        shard = payload.shard,
+    }
+end
+
+local flush_spends
+
+-- Put spends back after a failed push, to go out with the next one
+local function requeue_spends(spends)
+    for key, spend in pairs(spends) do
+        local queued = pending_spends[key]
+        if queued then
+            queued.spent = queued.spent + spend.spent
+        else
+            pending_spends[key] = spend
         end
     end
+end
 
-    return 0.001  -- Default price
+local function schedule_flush()
+    if flush_scheduled or next(pending_spends) == nil then
+        return
+    end
+    local ok, err = ngx.timer.at(STORE_FLUSH_INTERVAL, flush_spends)
+    if ok then
+        flush_scheduled = true
+    else
+        ngx.log(ngx.ERR, "failed to schedule store flush: ", err)
+    end
 end
 
--- Base64 decode
-local function base64_decode(str)
-    local chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
-    local result = ""
-    local padding = ""
+-- Connect to the shared store. Returns the connection, or nil and an
+-- error.
+local function connect_store(store)
+    local red = redis:new()
+    red:set_timeouts(STORE_TIMEOUT_MS, STORE_TIMEOUT_MS, STORE_TIMEOUT_MS)
+    local ok, err = red:connect(store.host, store.port)
+    if ok and store.password then
+        ok, err = red:auth(store.password)
+    end
+    if ok and store.db ~= 0 then
+        ok, err = red:select(store.db)
+    end
+    if not ok then
+        red:close()
+        return nil, err
+    end
+    return red
+end
 
-    for i = 1, #str, 3 do
-        local a = str:sub(i, i):byte() or 0
-        local b = str:sub(i + 1, i + 1):byte() or 0
-        local c = str:sub(i + 2, i + 2):byte() or 0
+-- Push pending spends in one pipeline: SET NX starts a counter at the
+-- token's unit, DECRBY takes this worker's spends off it. The shared
+-- count comes back with each reply and lowers the local one, so spends
+-- on other nodes are seen here within a flush interval.
+flush_spends = function(premature)
+    flush_scheduled = false
+    local spends = pending_spends
+    pending_spends = {}
+    local store = state.settings and state.settings.store
+    if premature or not store or next(spends) == nil then
+        return
+    end
 
-        result = result .. chars:sub(math.floor(a / 4) + 1, math.floor(a / 4) + 1)
-        result = result .. chars:sub(math.floor(a % 4 * 16 + b / 16) + 1, math.floor(a % 4 * 16 + b / 16) + 1)
-        result = result .. chars:sub(math.floor(b % 16 * 4 + c / 64) + 1, math.floor(b % 16 * 4 + c / 64) + 1)
-        result = result .. chars:sub(c % 64 + 1, c % 64 + 1)
+    local red, err = connect_store(store)
+    if not red then
+        ngx.log(ngx.ERR, "failed to reach unit store: ", err)
+        requeue_spends(spends)
+        return schedule_flush()
     end
 
-    local mod = #str % 3
-    if mod == 1 then
-        result = result:sub(1, -2) .. "=="
-    elseif mod == 2 then
-        result = result:sub(1, -1) .. "="
+    local now = ngx.time()
+    local keys = {}
+    red:init_pipeline()
+    for key, spend in pairs(spends) do
+        local entry = spend.entry
+        -- SET EXAT in the past would leave a counter that never expires
+        if entry.expires > now then
+            local store_key = STORE_UNITS_PREFIX .. entry.nonce
+            red:set(store_key, entry.unit, "EXAT", entry.expires, "NX")
+            red:decrby(store_key, spend.spent)
+            keys[#keys + 1] = key
+        end
+    end
+    local results
+    results, err = red:commit_pipeline()
+    if not results then
+        ngx.log(ngx.ERR, "failed to push token units: ", err)
+        red:close()
+        requeue_spends(spends)
+        return schedule_flush()
     end
+    red:set_keepalive(10000, 16)
 
-    return result
+    for i, key in ipairs(keys) do
+        local shared = results[2 * i]
+        local current = units:get(key)
+        if type(shared) == "number" and current and shared < current then
+            -- A relative step keeps spends made since the push
+            units:incr(key, shared - current)
+        end
+    end
 end
 
--- Main validation function
-local function validate()
-    local auth_header = ngx.req.get_headers()["Authorization"]
+-- Spend a token's first request on this node in the shared store, the
+-- way RedisUnitMeter._load does: SET NX starts the counter at the
+-- token's unit and DECRBY takes the spend off it, so the local counter
+-- starts from what other nodes left rather than from the full unit.
+-- Returns the remaining count, or nil and an error.
+local function load_units(entry, store, now)
+    local red, err = connect_store(store)
+    if not red then
+        return nil, err
+    end
+
+    local store_key = STORE_UNITS_PREFIX .. entry.nonce
+    red:init_pipeline()
+    red:set(store_key, entry.unit, "EXAT", entry.expires, "NX")
+    red:decrby(store_key, 1)
+    local results
+    results, err = red:commit_pipeline()
+    local shared = results and results[2]
+    if type(shared) ~= "number" then
+        red:close()
+        return nil, err or tostring(shared)
+    end
+    red:set_keepalive(10000, 16)
+
+    local ok
+    ok, err = units:add(entry.key, shared, entry.expires - now)
+    if not ok and err == "exists" then
+        -- Another worker loaded it meanwhile; the store has this spend
+        return units:incr(entry.key, -1)
+    elseif not ok then
+        return nil, err
+    end
+    return shared
+end
+
+-- Queue one spend for the shared store, if there is one
+local function record_spend(entry)
+    local spend = pending_spends[entry.key]
+    if spend then
+        spend.spent = spend.spent + 1
+    else
+        pending_spends[entry.key] = {spent = 1, entry = entry}
+    end
+    schedule_flush()
+end
+
+-- Validate payment token for a normalized path. Returns true, or false
+-- and a reason.
+local function validate_token(token, path, min_amount)
+    local now = ngx.time()
+    local entry = cache:get(token)
+    if entry then
+        count("tollbot_token_cache_hits_total")
+    else
+        count("tollbot_token_cache_misses_total")
+        entry = verify_token(token)
+        if not entry then
+            return false, "invalid"
+        end
+        if entry.expires > now then
+            cache:set(token, entry, entry.expires - now)
+        end
+    end
+
+    -- Check expiry
+    if entry.expires <= now then
+        ngx.log(ngx.WARN, "Token expired")
+        return false, "expired"
+    end
+
+    if entry.serial then
+        if now < entry.not_before then
+            ngx.log(ngx.WARN, "Prepaid token not valid yet")
+            return false, "invalid"
+        end
+        if is_revoked(entry.serial) then
+            ngx.log(ngx.WARN, "Prepaid token ", entry.serial, " revoked")
+            return false, "revoked"
+        end
+    end
+
+    -- Tokens minted by another shard are counted there, not here
+    local shard = state.settings and state.settings.shard
+    if shard and entry.shard and entry.shard ~= shard then
+        ngx.log(ngx.INFO, "Token of shard ", entry.shard, " sent to shard ", shard)
+        return false, "shard"
+    end
+
+    -- Check path is within the token scope
+    if path:sub(1, #entry.path) ~= entry.path then
+        ngx.log(ngx.WARN, "Path mismatch: expected ", path, " got ", entry.path)
+        return false, "path"
+    end
+
+    -- Check amount
+    min_amount = min_amount or get_min_price(path)
+    if entry.amount < min_amount then
+        ngx.log(ngx.WARN, "Insufficient payment: ", entry.amount, " < ", min_amount)
+        return false, "amount"
+    end
+
+    -- Spend one request; the counter starts at unit, or at the shared
+    -- count with a store, and expires with the token
+    if not units then
+        return false, "config"
+    end
+    local store = entry.nonce and state.settings and state.settings.store
+    local remaining, err
+    if store and not units:get(entry.key) then
+        if not has_redis then
+            ngx.log(ngx.ERR, "store_url is set but resty.redis is not installed")
+            return false, "store"
+        end
+        remaining, err = load_units(entry, store, now)
+        if not remaining then
+            ngx.log(ngx.ERR, "failed to load token units: ", err)
+            return false, "store"
+        end
+    else
+        remaining, err = units:incr(entry.key, -1, entry.unit, entry.expires - now)
+        if not remaining then
+            ngx.log(ngx.ERR, "failed to update token units: ", err)
+            return false, "config"
+        end
+        if store and remaining >= 0 then
+            record_spend(entry)
+        end
+    end
+    if remaining < 0 then
+        ngx.log(ngx.INFO, "Token units exhausted")
+        return false, "exhausted"
+    end
+
+    return true
+end
+
+-- Bucket key for the client: address plus a hash of its user agent
+local function client_key()
+    return ngx.var.remote_addr .. ":" .. ngx.crc32_long(ngx.var.http_user_agent or "")
+end
+
+-- Rate limit from config.ini, the default until it is loaded
+local function current_rate()
+    local settings = state.settings
+    if settings and settings.rate ~= nil then
+        return settings.rate
+    end
+    return DEFAULT_RATE
+end
+
+-- Check whether a client's bucket is empty, without draining it
+local function throttled(key, now, rate)
+    local tat = limits:get(key)
+    return tat ~= nil and math.max(tat, now) + rate.interval - now > rate.tolerance
+end
+
+-- Take one token from a client's bucket (GCRA). Workers race between
+-- get and set, which can only let a client slightly over its burst.
+local function charge(key, now, rate)
+    local tat = math.max(limits:get(key) or now, now) + rate.interval
+    if tat - now > rate.tolerance then
+        return false
+    end
+    limits:set(key, tat, math.ceil(tat - now))
+    return true
+end
+
+local function reject(status, body)
+    ngx.status = status
+    if status == ngx.HTTP_TOO_MANY_REQUESTS then
+        local rate = current_rate()
+        ngx.header["Retry-After"] = math.ceil(rate and rate.interval or 1)
+    end
+    ngx.print(body)
+    ngx.exit(status)
+end
+
+-- Site of the current request: $tollbot_site, set by the server blocks
+-- of sites sharing a configuration directory, else nil
+local function current_site()
+    local site = ngx.var.tollbot_site
+    if site == "" then
+        return nil
+    end
+    return site
+end
+
+-- Accept a price table pushed by tollbot (POST /__tollbot__/prices) and
+-- share it with every worker without an nginx reload
+local function publish_prices()
+    ngx.req.read_body()
+    local body = ngx.req.get_body_data()
+    local ok, prices = pcall(parse_price_table, body or "")
+    if not ok or not config then
+        ngx.status = ok and ngx.HTTP_INTERNAL_SERVER_ERROR or ngx.HTTP_BAD_REQUEST
+        ngx.say(cjson.encode({error = ok and "Price dict not configured" or "Invalid price table"}))
+        return ngx.exit(ngx.status)
+    end
+
+    -- The content goes in first, so a worker seeing the new version
+    -- always reads a table at least that new
+    local site = current_site()
+    local prices_key, version_key = pushed_keys(site)
+    config:set(prices_key, body)
+    config:set(version_key, prices.version)
+    set_prices(prices, site)
+    ngx.say(cjson.encode({version = prices.version}))
+end
+
+-- Decide a priced request. Returns nothing if it may proceed, else the
+-- status, body and reason to reject it with.
+local function check(prefix, site)
+    -- Prices are looked up in the live table so that price changes need
+    -- no reload
+    local rule = prefix and site_prices(site).by_prefix[prefix]
+    local path, price = lookup(ngx.var.request_uri or ngx.var.uri, site)
+    local min_amount = rule and rule.price or price
+    count(rule and 'tollbot_price_lookups_total{result="hit"}'
+        or 'tollbot_price_lookups_total{result="miss"}')
+
+    -- Clients whose rejections emptied their bucket get a 429 without
+    -- their token being looked at until it refills
+    local rate = current_rate()
+    local client, now
+    if limits and rate then
+        client = client_key()
+        now = ngx.now()
+        if throttled(client, now, rate) then
+            return ngx.HTTP_TOO_MANY_REQUESTS, BODY_THROTTLED, "throttled"
+        end
+    end
+
+    local auth_header = ngx.var.http_authorization
     local token = nil
 
     if auth_header and auth_header:sub(1, 7) == "Bearer " then
@@ -146,25 +932,98 @@ local function validate()
         token = ngx.var.arg_token
     end
 
+    local ok, reason = false, nil
+    if token then
+        ok, reason = validate_token(token, path, min_amount)
+        if ok then
+            return
+        end
+    end
+
+    if client and not charge(client, now, rate) then
+        return ngx.HTTP_TOO_MANY_REQUESTS, BODY_THROTTLED, "throttled"
+    end
     if not token then
-        ngx.status = ngx.HTTP_PAYMENT_REQUIRED
-        ngx.say(cjson.encode({error = "Payment required"}))
-        ngx.exit(ngx.HTTP_PAYMENT_REQUIRED)
+        return ngx.HTTP_PAYMENT_REQUIRED, BODY_PAYMENT_REQUIRED, "missing"
+    elseif reason == "exhausted" then
+        return ngx.HTTP_PAYMENT_REQUIRED, BODY_EXHAUSTED, reason
+    elseif reason == "shard" then
+        return HTTP_MISDIRECTED_REQUEST, BODY_MISDIRECTED, reason
+    elseif reason == "store" then
+        return ngx.HTTP_SERVICE_UNAVAILABLE, BODY_UNAVAILABLE, reason
+    end
+    return ngx.HTTP_FORBIDDEN, BODY_INVALID, reason
+end
+
+-- Main validation function
+local function validate()
+    -- $tollbot_prefix comes from the generated map: empty for free paths,
+    -- otherwise the priced prefix matching this URI
+    local prefix = ngx.var.tollbot_prefix
+    if prefix == "" then
+        return
     end
 
-    local path = ngx.var.uri
-    if validate_token(token, path) then
+    -- os.clock() is process CPU time; check() yields only to load a
+    -- token's count from the shared store on first sight, so the
+    -- difference is nearly always this request's validation cost at
+    -- microsecond resolution, unlike the cached ngx.now()
+    local start = os.clock()
+    local status, body, reason = check(prefix, current_site())
+    observe_latency(os.clock() - start)
+
+    if not status then
+        count('tollbot_validations_total{status="200"}')
         return
-    else
-        ngx.status = ngx.HTTP_FORBIDDEN
-        ngx.say(cjson.encode({error = "Invalid payment token"}))
-        ngx.exit(ngx.HTTP_FORBIDDEN)
     end
+    count('tollbot_validations_total{status="' .. status .. '"}')
+    count('tollbot_rejections_total{reason="' .. reason .. '"}')
+    return reject(status, body)
+end
+
+-- Serve every series in the Prometheus text format
+local function render_metrics()
+    if not metrics then
+        ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
+        ngx.say(cjson.encode({error = "Metrics dict not configured"}))
+        return ngx.exit(ngx.status)
+    end
+
+    local lines, family = {}, nil
+    local keys = metrics:get_keys(0)
+    table.sort(keys)
+    for _, key in ipairs(keys) do
+        if key:sub(1, #LATENCY_HISTOGRAM) ~= LATENCY_HISTOGRAM then
+            local name = key:match("^[^{]+")
+            if name ~= family then
+                family = name
+                lines[#lines + 1] = "# TYPE " .. name .. " counter"
+            end
+            lines[#lines + 1] = key .. " " .. string.format("%.17g", metrics:get(key) or 0)
+        end
+    end
+
+    lines[#lines + 1] = "# TYPE " .. LATENCY_HISTOGRAM .. " histogram"
+    local cumulative = 0
+    for _, key in ipairs(LATENCY_BUCKET_KEYS) do
+        cumulative = cumulative + (metrics:get(key) or 0)
+        lines[#lines + 1] = key .. " " .. cumulative
+    end
+    lines[#lines + 1] = LATENCY_HISTOGRAM .. "_sum "
+        .. string.format("%.17g", metrics:get(LATENCY_HISTOGRAM .. "_sum") or 0)
+    lines[#lines + 1] = LATENCY_HISTOGRAM .. "_count " .. cumulative
+
+    ngx.header["Content-Type"] = "text/plain; version=0.0.4"
+    ngx.print(table.concat(lines, "\n"), "\n")
 end
 
 -- Export functions
 return {
+    init_worker = init_worker,
     validate = validate,
+    publish_prices = publish_prices,
+    render_metrics = render_metrics,
     validate_token = validate_token,
     get_min_price = get_min_price,
+    normalize_path = normalize_path,
 }
@@ -0,0 +1,2 @@
+-- Tollbot access handler: access_by_lua_file and content_by_lua_file entry point
+require("payment_filter").validate()
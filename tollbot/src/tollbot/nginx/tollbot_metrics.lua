@@ -0,0 +1,2 @@
+-- Tollbot metrics handler: content_by_lua_file entry point
+require("payment_filter").render_metrics()
@@ -0,0 +1,2 @@
+-- Tollbot price push handler: content_by_lua_file entry point
+require("payment_filter").publish_prices()
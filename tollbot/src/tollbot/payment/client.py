@@ -0,0 +1,154 @@
+"""HTTP client for payment backends."""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class _Flight:
+    """A request in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BackendClient:
+    """JSON-over-HTTP client with pooling, retries and request coalescing.
+
+    Connections are kept in a persistent pool, and at most
+    ``max_concurrency`` requests are in flight at once. Requests that
+    fail with a connection error or a retryable status are retried with
+    exponential backoff, or after the server's Retry-After delay. Callers
+    that ask for the same path concurrently share one upstream request.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str] = None,
+        timeout: float = 5.0,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        backoff: float = 0.25,
+        max_backoff: float = 10.0,
+    ):
+        """Initialize client.
+
+        Args:
+            base_url: API base URL
+            api_key: Bearer token for the API
+            timeout: Request timeout in seconds
+            max_concurrency: Maximum concurrent upstream requests
+            max_retries: Retries after the first attempt
+            backoff: Initial backoff in seconds, doubled on each retry
+            max_backoff: Upper bound on any single wait
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def get_json(self, path: str) -> Optional[dict]:
+        """GET a JSON document, sharing the request with concurrent callers.
+
+        Args:
+            path: Path relative to the base URL
+
+        Returns:
+            dict: Response body, or None if the server answered 404
+
+        Raises:
+            requests.RequestException: If the request failed after retries
+        """
+        with self._lock:
+            flight = self._flights.get(path)
+            leader = flight is None
+            if leader:
+                flight = self._flights[path] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._request(path)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[path]
+            flight.done.set()
+
+    def close(self):
+        """Close pooled connections."""
+        self.session.close()
+
+    def _request(self, path: str) -> Optional[dict]:
+        """GET a path, retrying transient failures."""
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                with self._slots:
+                    response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code == 404:
+                    return None
+                if last or response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                response.close()
+
+            time.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        """Get the jittered exponential backoff for a retry."""
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        """Get the wait requested by a Retry-After header, if any."""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+
+        return min(self.max_backoff, max(0.0, delay))
@@ -0,0 +1,110 @@
+"""Metered unit accounting for @unit pricing."""
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class UnitMeter:
+    """Count the requests remaining on each token.
+
+    A token pays for ``unit`` requests. Every request spends one unit
+    with a single locked dictionary update, and counters are dropped
+    once their token expires. Expiry is tracked in time buckets, so the
+    cost per request stays O(1) amortized no matter how many tokens are
+    live.
+
+    In nginx the same counters live in the ``tollbot_units`` shared
+    dict (see payment_filter.lua); this meter is shared by all threads
+    of a Python process.
+    """
+
+    def __init__(self, granularity: int = 60):
+        """Initialize meter.
+
+        Args:
+            granularity: Width of an expiry bucket in seconds
+        """
+        self.granularity = granularity
+        # key -> [remaining, expires]
+        self._counters: Dict[str, List[int]] = {}
+        # bucket number -> keys expiring within it
+        self._buckets: Dict[int, List[str]] = {}
+        self._swept = int(time.time()) // granularity
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, unit: int, expires: int, now: Optional[int] = None) -> int:
+        """Spend one unit of a token.
+
+        Args:
+            key: Token identifier (its nonce)
+            unit: Requests the token pays for
+            expires: Unix time the token expires
+            now: Current time, for testing
+
+        Returns:
+            int: Units left after this request, or -1 if none were left
+        """
+        if now is None:
+            now = int(time.time())
+
+        with self._lock:
+            self._expire(now)
+
+            entry = self._counters.get(key)
+            if entry is None:
+                if expires <= now:
+                    return -1
+                entry = self._counters[key] = [max(unit, 1), expires]
+                self._buckets.setdefault(expires // self.granularity, []).append(key)
+
+            if entry[0] <= 0 or entry[1] <= now:
+                return -1
+
+            entry[0] -= 1
+            return entry[0]
+
+    def remaining(self, key: str) -> Optional[int]:
+        """Get the units left on a token.
+
+        Args:
+            key: Token identifier
+
+        Returns:
+            int: Units left, or None if the token has not been used
+        """
+        entry = self._counters.get(key)
+        return None if entry is None else entry[0]
+
+    def exhausted(self, key: str) -> bool:
+        """Check whether a token has spent all of its units.
+
+        Args:
+            key: Token identifier
+
+        Returns:
+            bool: True if the token was used and has no units left
+        """
+        entry = self._counters.get(key)
+        return entry is not None and entry[0] <= 0
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    def _expire(self, now: int):
+        """Drop counters whose bucket has fully elapsed."""
+        current = now // self.granularity
+        if current <= self._swept:
+            return
+
+        if current - self._swept > len(self._buckets):
+            # Long idle gap: visit the populated buckets, not every step
+            due = [b for b in self._buckets if b < current]
+        else:
+            due = range(self._swept, current)
+
+        for bucket in due:
+            for key in self._buckets.pop(bucket, ()):
+                entry = self._counters.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self._counters[key]
+        self._swept = current
@@ -0,0 +1,85 @@
+"""Per-client rate limiting of unpaid requests."""
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+
+class RateLimiter:
+    """Token bucket per client, kept as a theoretical arrival time.
+
+    This is the GCRA form of a token bucket: each client costs one
+    float, and a request is checked with one lookup. Only rejected
+    requests drain the bucket, so clients that pay are never limited.
+    It mirrors the ``tollbot_limits`` shared dict in payment_filter.lua.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 20, purge_interval: int = 60):
+        """Initialize limiter.
+
+        Args:
+            rate: Rejections per second refilled into each bucket
+            burst: Bucket size
+            purge_interval: Seconds between sweeps of idle clients
+        """
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+        self.purge_interval = purge_interval
+        self._tat: Dict[str, float] = {}
+        self._next_purge = time.time() + purge_interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def client_key(client_ip: str, user_agent: Optional[str] = None) -> str:
+        """Build the bucket key for a client.
+
+        Args:
+            client_ip: Client IP address
+            user_agent: Client User-Agent header
+
+        Returns:
+            str: Bucket key
+        """
+        return f"{client_ip}:{zlib.crc32((user_agent or '').encode())}"
+
+    def limited(self, key: str, now: Optional[float] = None) -> bool:
+        """Check whether a client's bucket is empty, without draining it.
+
+        Args:
+            key: Bucket key
+            now: Current time, for testing
+
+        Returns:
+            bool: True if the client is over its limit
+        """
+        if now is None:
+            now = time.time()
+        tat = self._tat.get(key)
+        return tat is not None and max(tat, now) + self.interval - now > self.tolerance
+
+    def charge(self, key: str, now: Optional[float] = None) -> bool:
+        """Take one token from a client's bucket.
+
+        Args:
+            key: Bucket key
+            now: Current time, for testing
+
+        Returns:
+            bool: True if a token was available
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if now >= self._next_purge:
+                self._tat = {k: t for k, t in self._tat.items() if t > now}
+                self._next_purge = now + self.purge_interval
+
+            tat = max(self._tat.get(key, now), now) + self.interval
+            if tat - now > self.tolerance:
+                return False
+            self._tat[key] = tat
+            return True
+
+    def __len__(self) -> int:
+        return len(self._tat)
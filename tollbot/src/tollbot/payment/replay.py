@@ -0,0 +1,103 @@
+"""Record of issued token nonces."""
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+
+class ReplayStore:
+    """Interface for the record of issued token nonces.
+
+    The minting service records each token's nonce and expiry in
+    batches; validators only accept tokens whose nonce was recorded.
+    """
+
+    # Whether add_many may block on I/O and must run off the event loop
+    blocking = True
+
+    def add_many(self, entries: Iterable[Tuple[str, int]]):
+        """Record issued nonces.
+
+        Args:
+            entries: (nonce, expires) pairs
+        """
+        raise NotImplementedError
+
+    def issued(self, nonce: str) -> bool:
+        """Check whether a nonce was issued and has not expired.
+
+        Args:
+            nonce: Token nonce
+
+        Returns:
+            bool: True if the nonce is live
+        """
+        raise NotImplementedError
+
+    def claim(self, key: str, expires: int) -> bool:
+        """Record a key unless it is live, atomically across its users.
+
+        Args:
+            key: Key, such as a payment that may pay for one token only
+            expires: Unix time the key expires at
+
+        Returns:
+            bool: True if this call recorded the key
+        """
+        raise NotImplementedError
+
+    def release(self, key: str):
+        """Drop a claimed key, so that it can be claimed again.
+
+        Args:
+            key: Claimed key
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release store resources."""
+
+
+class MemoryReplayStore(ReplayStore):
+    """In-process replay store."""
+
+    blocking = False
+
+    def __init__(self, purge_interval: int = 60):
+        """Initialize store.
+
+        Args:
+            purge_interval: Seconds between sweeps of expired nonces
+        """
+        self.purge_interval = purge_interval
+        self._expires: Dict[str, int] = {}
+        self._next_purge = int(time.time()) + purge_interval
+        self._lock = threading.Lock()
+
+    def add_many(self, entries: Iterable[Tuple[str, int]]):
+        """Record issued nonces."""
+        now = int(time.time())
+        with self._lock:
+            self._expires.update(entries)
+            if now >= self._next_purge:
+                self._expires = {n: e for n, e in self._expires.items() if e > now}
+                self._next_purge = now + self.purge_interval
+
+    def issued(self, nonce: str) -> bool:
+        """Check whether a nonce was issued and has not expired."""
+        return self._expires.get(nonce, 0) > time.time()
+
+    def claim(self, key: str, expires: int) -> bool:
+        """Record a key unless it is live."""
+        with self._lock:
+            if self._expires.get(key, 0) > time.time():
+                return False
+            self._expires[key] = expires
+            return True
+
+    def release(self, key: str):
+        """Drop a claimed key."""
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._expires)
@@ -0,0 +1,156 @@
+"""Minimal Redis protocol (RESP2) client."""
+import socket
+import threading
+from typing import Optional, Sequence
+
+
+class RespError(Exception):
+    """Error reply from a RESP server."""
+
+
+class RespClient:
+    """Pipelining client for Redis-compatible servers.
+
+    Every call sends its commands in one write and then reads one reply
+    per command, so a batch costs one round trip. The connection is
+    opened lazily and reopened once if it drops.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[str] = None,
+        timeout: float = 2.0,
+    ):
+        """Initialize client.
+
+        Args:
+            host: Server address
+            port: Server port
+            db: Database number
+            password: Password for AUTH
+            timeout: Socket timeout in seconds
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def execute(self, *args):
+        """Run one command.
+
+        Returns:
+            Reply: int, bytes, list or None
+
+        Raises:
+            RespError: If the server answered with an error
+            OSError: If the server could not be reached
+        """
+        reply = self.pipeline([args])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands: Sequence[Sequence]) -> list:
+        """Run commands in one round trip.
+
+        Args:
+            commands: Commands, each a sequence of arguments
+
+        Returns:
+            list: One reply per command; error replies are RespError
+            instances rather than raised
+
+        Raises:
+            OSError: If the server could not be reached
+        """
+        if not commands:
+            return []
+        payload = b"".join(_encode(command) for command in commands)
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(payload)
+                    return [self._read() for _ in commands]
+                except OSError:
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    def close(self):
+        """Close the connection."""
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self):
+        """Open the connection and select the database."""
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._sock.sendall(b"".join(_encode(command) for command in setup))
+            for _ in setup:
+                reply = self._read()
+                if isinstance(reply, RespError):
+                    raise OSError(f"RESP setup failed: {reply}")
+
+    def _disconnect(self):
+        """Drop the connection."""
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+    def _read(self):
+        """Read one reply."""
+        return _read_reply(self._file)
+
+
+def _encode(args: Sequence) -> bytes:
+    """Encode a command as a RESP array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(f):
+    """Read one RESP reply from a binary file."""
+    line = f.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by RESP server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = f.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Connection closed by RESP server")
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        return None if count < 0 else [_read_reply(f) for _ in range(count)]
+    raise ConnectionError(f"Invalid RESP reply: {line!r}")
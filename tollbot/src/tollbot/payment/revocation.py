@@ -0,0 +1,162 @@
+"""Serials and revocation of prepaid tokens."""
+import base64
+import json
+import os
+import threading
+from typing import Iterable, Optional
+
+from tollbot.payment.resp import RespClient
+from tollbot.payment.store import SERIAL_KEY
+
+
+class RevocationList:
+    """Bitmap of revoked prepaid token serials.
+
+    Serials are allocated in order, so the list is one bit per serial
+    from ``base`` on: a million serials take 125 KB. Serials below
+    ``base`` belong to tokens that have expired and are dropped by
+    compact(). The list is published as revoked.json, which validators
+    and payment_filter.lua reload when it changes.
+    """
+
+    def __init__(self, base: int = 0, bitmap: bytes = b"", version: int = 0):
+        """Initialize list.
+
+        Args:
+            base: First serial covered by the bitmap, a multiple of 8
+            bitmap: Bit ``serial - base`` set for revoked serials
+            version: Publication number, raised by every save
+        """
+        self.base = base
+        self.bitmap = bytearray(bitmap)
+        self.version = version
+        self._lock = threading.Lock()
+
+    def revoke(self, serials: Iterable[int]):
+        """Revoke serials.
+
+        Args:
+            serials: Prepaid token serials
+        """
+        with self._lock:
+            for serial in serials:
+                index = serial - self.base
+                if index < 0:
+                    continue
+                if index // 8 >= len(self.bitmap):
+                    self.bitmap.extend(bytes(index // 8 + 1 - len(self.bitmap)))
+                self.bitmap[index // 8] |= 1 << (index % 8)
+
+    def is_revoked(self, serial: int) -> bool:
+        """Check whether a serial is revoked.
+
+        Args:
+            serial: Prepaid token serial
+
+        Returns:
+            bool: True if revoked
+        """
+        index = serial - self.base
+        if index < 0 or index // 8 >= len(self.bitmap):
+            return False
+        return bool(self.bitmap[index // 8] >> (index % 8) & 1)
+
+    def compact(self, base: int):
+        """Drop the serials below base, whose tokens have all expired.
+
+        Args:
+            base: Lowest serial of a token that may still be live
+        """
+        with self._lock:
+            drop = max(0, base - self.base) // 8
+            del self.bitmap[:drop]
+            self.base += drop * 8
+
+    def save(self, path: str):
+        """Publish the list atomically as the next version.
+
+        Args:
+            path: revoked.json to write
+        """
+        with self._lock:
+            self.version += 1
+            data = {
+                "version": self.version,
+                "base": self.base,
+                "bitmap": base64.b64encode(bytes(self.bitmap)).decode(),
+            }
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["RevocationList"]:
+        """Load a published list.
+
+        Args:
+            path: revoked.json to read
+
+        Returns:
+            RevocationList: The list, or None if there is none
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls(data["base"], base64.b64decode(data["bitmap"]), data["version"])
+
+
+class SerialAllocator:
+    """Allocate increasing prepaid token serials that survive restarts.
+
+    Serials are reserved a block at a time, so allocation costs one
+    write per block. A restart skips the rest of the block. Nodes
+    sharing a store reserve their blocks from it, with one INCRBY, so
+    serials are unique across the deployment and one revocation list
+    covers them all; a single node reserves them from a file.
+    """
+
+    def __init__(self, path: str, block: int = 1024, client: Optional[RespClient] = None):
+        """Initialize allocator.
+
+        Args:
+            path: File holding the next unreserved serial
+            block: Serials reserved per write
+            client: Shared store to reserve blocks from instead of path
+        """
+        self.path = path
+        self.block = block
+        self.client = client
+        self._next = 0
+        self._limit = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> int:
+        """Get the next serial."""
+        with self._lock:
+            if self._next >= self._limit:
+                self._reserve()
+            serial = self._next
+            self._next += 1
+            return serial
+
+    def _reserve(self):
+        """Reserve the next block in the store or the file."""
+        if self.client is not None:
+            limit = int(self.client.execute("INCRBY", SERIAL_KEY, self.block))
+            self._next, self._limit = limit - self.block, limit
+            return
+
+        try:
+            with open(self.path, "r") as f:
+                start = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            start = 0
+        start = max(start, self._limit)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{start + self.block}\n")
+        os.replace(tmp, self.path)
+        self._next, self._limit = start, start + self.block
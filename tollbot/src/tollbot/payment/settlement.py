@@ -0,0 +1,290 @@
+"""USDC settlement verification for payment tokens."""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import requests
+
+from tollbot.payment.client import BackendClient
+
+logger = logging.getLogger(__name__)
+
+SETTLED = "complete"
+PENDING = "pending"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+# Transfers API currency codes by token currency
+API_CURRENCIES = {"USDC": "USD"}
+# USDC amounts have six decimal places
+AMOUNT_PLACES = 6
+# Payments kept in the index; the oldest are evicted and checked again
+# if they are used after that
+MAX_RECORDS = 100000
+
+
+@dataclass
+class SettlementRecord:
+    """Settlement state of one payment."""
+    payment_id: str
+    status: str
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+    # Wallet ID or address the payment was sent to
+    destination: Optional[str] = None
+    checked_at: int = 0
+
+    @property
+    def settled(self) -> bool:
+        """Whether the payment has settled."""
+        return self.status == SETTLED
+
+    def covers(self, amount: float, currency: str, recipient: str) -> bool:
+        """Check that the payment settled enough, in a currency, to a wallet.
+
+        Args:
+            amount: Least amount the payment must be for
+            currency: Token currency code (e.g., USDC)
+            recipient: Wallet ID or address the payment must have gone to
+
+        Returns:
+            bool: True if the settled payment pays for the amount
+        """
+        return (
+            self.settled
+            and self.amount is not None
+            and round(self.amount, AMOUNT_PLACES) >= round(amount, AMOUNT_PLACES)
+            and self.currency == API_CURRENCIES.get(currency, currency)
+            and bool(recipient)
+            and self.destination == recipient
+        )
+
+
+class SettlementBackend:
+    """Interface for looking up payment settlement."""
+
+    def lookup(self, payment_id: str) -> SettlementRecord:
+        """Look up the settlement state of a payment.
+
+        Args:
+            payment_id: Payment (transfer) identifier
+
+        Returns:
+            SettlementRecord: Current settlement state
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release backend resources."""
+
+
+class MemorySettlementBackend(SettlementBackend):
+    """Offline backend answering from an in-memory table."""
+
+    def __init__(self, transfers: Optional[Dict[str, dict]] = None):
+        """Initialize backend.
+
+        Args:
+            transfers: Transfer data by payment ID, as returned by the API
+        """
+        self.transfers = transfers if transfers is not None else {}
+
+    def lookup(self, payment_id: str) -> SettlementRecord:
+        """Look up a payment in the in-memory table."""
+        return _parse_transfer(payment_id, self.transfers.get(payment_id))
+
+
+class HttpSettlementBackend(SettlementBackend):
+    """Backend for a Circle-style transfers API."""
+
+    def __init__(self, base_url: str, api_key: Optional[str] = None, **client_options):
+        """Initialize backend.
+
+        Args:
+            base_url: API base URL
+            api_key: Bearer token for the API
+            **client_options: Options for BackendClient
+        """
+        self.client = BackendClient(base_url, api_key, **client_options)
+
+    def lookup(self, payment_id: str) -> SettlementRecord:
+        """Fetch a transfer from the API."""
+        body = self.client.get_json(f"/v1/transfers/{payment_id}")
+        return _parse_transfer(payment_id, body and body.get("data"))
+
+    def close(self):
+        """Close the HTTP client."""
+        self.client.close()
+
+
+def _parse_transfer(payment_id: str, transfer: Optional[dict]) -> SettlementRecord:
+    """Build a SettlementRecord from API transfer data.
+
+    Args:
+        payment_id: Payment identifier
+        transfer: Transfer data, or None if the payment is unknown
+
+    Returns:
+        SettlementRecord: Parsed record
+    """
+    if not transfer:
+        return SettlementRecord(payment_id, UNKNOWN, checked_at=int(time.time()))
+
+    amount = transfer.get("amount") or {}
+    destination = transfer.get("destination") or {}
+    return SettlementRecord(
+        payment_id=payment_id,
+        status=transfer.get("status", UNKNOWN),
+        amount=float(amount["amount"]) if "amount" in amount else None,
+        currency=amount.get("currency"),
+        destination=destination.get("id") or destination.get("address"),
+        checked_at=int(time.time()),
+    )
+
+
+class SettlementVerifier:
+    """Verify payments in the background and index the results.
+
+    Payments are submitted when a token is minted and checked on a
+    worker thread. The request path only reads the settled-payment
+    index, so it never waits on the network; a payment it has not seen,
+    such as one minted by another node, is submitted on first use and
+    accepted once its check lands. One still pending or unknown is
+    submitted again on use once ``retry_interval`` has passed since its
+    last check.
+    """
+
+    def __init__(
+        self,
+        backend: SettlementBackend,
+        max_workers: int = 4,
+        retry_interval: float = 5.0,
+        max_attempts: int = 12,
+        max_records: int = MAX_RECORDS,
+    ):
+        """Initialize verifier.
+
+        Args:
+            backend: Settlement backend to query
+            max_workers: Concurrent backend lookups
+            retry_interval: Seconds between checks of a pending payment
+            max_attempts: Checks of a pending payment before giving up
+            max_records: Payments kept in the index
+        """
+        self.backend = backend
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.max_records = max_records
+        # Least recently checked first
+        self.index: "OrderedDict[str, SettlementRecord]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tollbot-settlement"
+        )
+
+    def submit(self, payment_id: str) -> Future:
+        """Queue a payment for verification.
+
+        Args:
+            payment_id: Payment identifier
+
+        Returns:
+            Future: Resolves to the final SettlementRecord
+        """
+        with self._lock:
+            future = self._inflight.get(payment_id)
+            if future is None:
+                future = self._executor.submit(self._verify, payment_id)
+                self._inflight[payment_id] = future
+            return future
+
+    def is_settled(self, payment_id: str) -> bool:
+        """Check the index for a settled payment.
+
+        Args:
+            payment_id: Payment identifier
+
+        Returns:
+            bool: True if the payment is known to have settled
+        """
+        record = self.index.get(payment_id)
+        return record is not None and record.settled
+
+    def covers(
+        self, payment_id: Optional[str], amount: float, currency: str, recipient: str
+    ) -> bool:
+        """Check the index for a settled payment that pays for a token.
+
+        A payment missing from the index, or still pending or unknown
+        ``retry_interval`` after its last check, is submitted for
+        verification.
+
+        Args:
+            payment_id: Payment identifier
+            amount: Token amount
+            currency: Token currency code
+            recipient: Token wallet ID
+
+        Returns:
+            bool: True if the payment is known to cover the token
+        """
+        if not payment_id:
+            return False
+        record = self.index.get(payment_id)
+        if record is None:
+            self.submit(payment_id)
+            return False
+        if (
+            record.status not in (SETTLED, FAILED)
+            and time.time() - record.checked_at >= self.retry_interval
+        ):
+            self.submit(payment_id)
+        return record.covers(amount, currency, recipient)
+
+    def get(self, payment_id: str) -> Optional[SettlementRecord]:
+        """Get the indexed record for a payment."""
+        return self.index.get(payment_id)
+
+    def shutdown(self, wait: bool = True):
+        """Stop verification and release the backend."""
+        self._stopped.set()
+        self._executor.shutdown(wait=wait)
+        self.backend.close()
+
+    def _index(self, record: SettlementRecord):
+        """Index a check result, evicting the least recently checked."""
+        with self._lock:
+            self.index[record.payment_id] = record
+            self.index.move_to_end(record.payment_id)
+            while len(self.index) > self.max_records:
+                self.index.popitem(last=False)
+
+    def _verify(self, payment_id: str) -> SettlementRecord:
+        """Check a payment until it settles, fails or runs out of attempts."""
+        try:
+            record = SettlementRecord(payment_id, UNKNOWN)
+            for attempt in range(self.max_attempts):
+                try:
+                    record = self.backend.lookup(payment_id)
+                except requests.RequestException:
+                    record = SettlementRecord(payment_id, UNKNOWN, checked_at=int(time.time()))
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    # A malformed transfer will not parse on the next try either
+                    logger.warning("Unreadable transfer for payment %s: %s", payment_id, e)
+                    record = SettlementRecord(payment_id, FAILED, checked_at=int(time.time()))
+                self._index(record)
+
+                if record.status in (SETTLED, FAILED) or attempt + 1 == self.max_attempts:
+                    break
+                if self._stopped.wait(self.retry_interval):
+                    break
+            return record
+        finally:
+            with self._lock:
+                self._inflight.pop(payment_id, None)
@@ -0,0 +1,130 @@
+"""Shard and epoch stamping of tokens for multi-node deployments."""
+import logging
+import time
+from typing import Dict, Optional
+
+from tollbot.payment.resp import RespClient, RespError
+from tollbot.payment.store import EPOCH_PREFIX
+from tollbot.payment.token import TOKEN_TTL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EPOCH_LENGTH = 600
+
+
+class EpochShard:
+    """Shard identity and epoch clock of a node.
+
+    Tokens minted on a node carry its shard ID and current epoch, and
+    the load balancer routes them back to it, so each node only records
+    the nonces and unit counters of its own tokens. Tokens of another
+    shard, or of an epoch outside the window that can still hold live
+    tokens, are rejected from their signed fields alone.
+
+    Epochs are ``time // epoch_length`` and never go backwards. Once per
+    epoch, nodes sharing a store publish their epoch and adopt the
+    highest one seen, so a node whose clock lags does not reject fresh
+    tokens minted elsewhere nor stamp stale epochs on its own.
+    """
+
+    def __init__(
+        self,
+        shard_id: int,
+        shard_count: int,
+        epoch_length: int = DEFAULT_EPOCH_LENGTH,
+        client: Optional[RespClient] = None,
+    ):
+        """Initialize shard.
+
+        Args:
+            shard_id: This node's shard, from 0 to shard_count - 1
+            shard_count: Number of shards in the deployment
+            epoch_length: Seconds per epoch
+            client: Store connection to exchange epochs over
+        """
+        if not 0 <= shard_id < shard_count:
+            raise ValueError(f"Shard {shard_id} outside 0..{shard_count - 1}")
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.epoch_length = epoch_length
+        self.client = client
+        # Epochs a token can be minted in and still be live
+        self.span = -(-TOKEN_TTL // epoch_length)
+        # Last epoch published by each shard
+        self.peers: Dict[int, int] = {}
+        self._epoch = 0
+        self._synced = None
+
+    def epoch(self, now: Optional[float] = None) -> int:
+        """Get the current epoch.
+
+        Args:
+            now: Current time
+
+        Returns:
+            int: Epoch, never lower than a previous answer
+        """
+        if now is None:
+            now = time.time()
+        self._epoch = max(self._epoch, int(now) // self.epoch_length)
+        return self._epoch
+
+    def watermark(self, now: Optional[float] = None) -> int:
+        """Get the oldest epoch that can still hold a live token."""
+        return self.epoch(now) - self.span
+
+    def check(self, token, now: Optional[float] = None) -> Optional[str]:
+        """Check a token's shard and epoch without touching any store.
+
+        Tokens minted before sharding was enabled carry neither and pass.
+
+        Args:
+            token: Verified PaymentToken
+            now: Current time
+
+        Returns:
+            str: "shard" or "epoch" if the token must be rejected, else None
+        """
+        if token.shard is None:
+            return None
+        if token.shard != self.shard_id:
+            return "shard"
+        # One epoch of slack for peers whose clocks run ahead
+        if not self.watermark(now) <= token.epoch <= self._epoch + 1:
+            return "epoch"
+        return None
+
+    def due(self, now: Optional[float] = None) -> bool:
+        """Check whether this epoch's exchange is still to be done."""
+        return self.client is not None and self._synced != self.epoch(now)
+
+    def sync(self, now: Optional[float] = None):
+        """Publish this node's epoch and adopt the highest one published.
+
+        One pipeline: a SET of this shard's epoch, expiring after two
+        epochs, and a GET per shard.
+
+        Args:
+            now: Current time
+        """
+        epoch = self.epoch(now)
+        keys = [EPOCH_PREFIX + str(shard) for shard in range(self.shard_count)]
+        commands = [("SET", keys[self.shard_id], epoch, "EX", 2 * self.epoch_length)]
+        commands.extend(("GET", key) for key in keys)
+        try:
+            replies = self.client.pipeline(commands)
+        except OSError as e:
+            logger.warning("Could not exchange epochs: %s", e)
+            return
+
+        for shard, reply in enumerate(replies[1:]):
+            if reply is not None and not isinstance(reply, RespError):
+                self.peers[shard] = int(reply)
+        self._epoch = max([epoch] + list(self.peers.values()))
+        self._synced = self._epoch
+
+    def close(self):
+        """Close the store connection."""
+        if self.client is not None:
+            self.client.close()
+
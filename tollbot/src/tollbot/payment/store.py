@@ -0,0 +1,524 @@
+"""Shared nonce and unit counter stores for multi-process and multi-node use.
+
+Each store pairs a ReplayStore (issued nonces) with a meter that has the
+interface of UnitMeter (consume, remaining, exhausted):
+
+- ``memory://``: MemoryReplayStore and UnitMeter, private to a process
+- ``mmap:///var/lib/tollbot``: tables in memory-mapped files, shared by
+  every process on a node
+- ``redis://[:password@]host:port/db``: a Redis-compatible server shared
+  by every node
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from tollbot.payment.meter import UnitMeter
+from tollbot.payment.replay import MemoryReplayStore, ReplayStore
+from tollbot.payment.resp import RespClient, RespError
+
+logger = logging.getLogger(__name__)
+
+# Key prefixes in a shared Redis store; payment_filter.lua uses the same
+REPLAY_PREFIX = "tollbot:n:"
+UNITS_PREFIX = "tollbot:u:"
+EPOCH_PREFIX = "tollbot:e:"
+# Next unreserved prepaid token serial (see SerialAllocator)
+SERIAL_KEY = "tollbot:serial"
+
+MMAP_MAGIC = b"TOLLBOT1"
+# Header: magic, slot count
+MMAP_HEADER = struct.Struct("<8sq")
+# Slot: key digest, expires (0 for never used), value
+MMAP_SLOT = struct.Struct("<16sqq")
+# Slots probed before the entry expiring soonest is evicted
+MMAP_PROBES = 32
+
+
+class MmapTable:
+    """Fixed-size hash table of expiring integers in a memory-mapped file.
+
+    Keys are stored as 16-byte digests with linear probing. Writers
+    serialize on an flock of the file; readers take no lock. Expired
+    slots are reused, and when a probe run is full the entry expiring
+    soonest is evicted, so the table never grows.
+    """
+
+    def __init__(self, path: str, slots: int = 1 << 20):
+        """Open or create a table.
+
+        Args:
+            path: Table file; created sparse if missing
+            slots: Slot count of a new table
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < MMAP_HEADER.size:
+                os.ftruncate(self._fd, MMAP_HEADER.size + slots * MMAP_SLOT.size)
+                os.pwrite(self._fd, MMAP_HEADER.pack(MMAP_MAGIC, slots), 0)
+            magic, self.slots = MMAP_HEADER.unpack(os.pread(self._fd, MMAP_HEADER.size, 0))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if magic != MMAP_MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"{path} is not a tollbot table")
+        self._mm = mmap.mmap(self._fd, MMAP_HEADER.size + self.slots * MMAP_SLOT.size)
+        self._lock = threading.Lock()
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[int]:
+        """Get the live value of a key.
+
+        Args:
+            key: Key
+            now: Current time, for testing
+
+        Returns:
+            int: Value, or None if missing or expired
+        """
+        if now is None:
+            now = time.time()
+        digest = _digest(key)
+        for offset in self._probe(digest):
+            slot_key, expires, value = MMAP_SLOT.unpack_from(self._mm, offset)
+            if expires == 0:
+                return None
+            if slot_key == digest:
+                return value if expires > now else None
+        return None
+
+    def update(
+        self,
+        key: str,
+        expires: int,
+        update: Callable[[Optional[int]], int],
+        now: Optional[float] = None,
+    ) -> Tuple[Optional[int], int]:
+        """Replace a key's value with ``update(old value or None)``.
+
+        A new entry gets ``expires``; an existing one keeps its own.
+
+        Returns:
+            tuple: (old value or None, new value)
+        """
+        with self.locked():
+            return self._update(key, expires, update, time.time() if now is None else now)
+
+    def discard(self, key: str, now: Optional[float] = None):
+        """Expire a key now."""
+        if now is None:
+            now = time.time()
+        digest = _digest(key)
+        with self.locked():
+            for offset in self._probe(digest):
+                slot_key, expires, value = MMAP_SLOT.unpack_from(self._mm, offset)
+                if expires == 0:
+                    return
+                if slot_key == digest and expires > now:
+                    # Expired rather than never used, so probe runs stay intact
+                    MMAP_SLOT.pack_into(self._mm, offset, digest, 1, value)
+                    return
+
+    def locked(self):
+        """Hold the write lock of the table, for a batch of updates."""
+        return _FileLock(self._fd, self._lock)
+
+    def close(self):
+        """Unmap and close the table."""
+        self._mm.close()
+        os.close(self._fd)
+
+    def _update(self, key: str, expires: int, update, now: float) -> Tuple[Optional[int], int]:
+        """Update a key with the write lock held."""
+        digest = _digest(key)
+        free = None
+        oldest = None
+        for offset in self._probe(digest):
+            slot_key, slot_expires, value = MMAP_SLOT.unpack_from(self._mm, offset)
+            if slot_key == digest and slot_expires > now:
+                new = update(value)
+                MMAP_SLOT.pack_into(self._mm, offset, digest, slot_expires, new)
+                return value, new
+            if slot_expires <= now and free is None:
+                free = offset
+            if slot_expires == 0:
+                break
+            if oldest is None or slot_expires < oldest[0]:
+                oldest = (slot_expires, offset)
+
+        new = update(None)
+        MMAP_SLOT.pack_into(self._mm, free if free is not None else oldest[1], digest, expires, new)
+        return None, new
+
+    def _probe(self, digest: bytes) -> Iterable[int]:
+        """Get the slot offsets to probe for a digest."""
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        for i in range(min(MMAP_PROBES, self.slots)):
+            yield MMAP_HEADER.size + (start + i) % self.slots * MMAP_SLOT.size
+
+
+class _FileLock:
+    """Exclusive lock across threads (mutex) and processes (flock)."""
+
+    def __init__(self, fd: int, lock: threading.Lock):
+        self._fd = fd
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+def _digest(key: str) -> bytes:
+    """Hash a key to its 16-byte table form."""
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+class MmapReplayStore(ReplayStore):
+    """Replay store shared by the processes of a node through a file."""
+
+    blocking = False
+
+    def __init__(self, path: str, slots: int = 1 << 20):
+        """Initialize store.
+
+        Args:
+            path: Table file
+            slots: Slot count of a new table
+        """
+        self.table = MmapTable(path, slots)
+
+    def add_many(self, entries: Iterable[Tuple[str, int]]):
+        """Record issued nonces."""
+        now = time.time()
+        with self.table.locked():
+            for nonce, expires in entries:
+                self.table._update(nonce, expires, lambda _: 1, now)
+
+    def issued(self, nonce: str) -> bool:
+        """Check whether a nonce was issued and has not expired."""
+        return self.table.get(nonce) is not None
+
+    def claim(self, key: str, expires: int) -> bool:
+        """Record a key unless it is live."""
+        old, _ = self.table.update(key, expires, lambda _: 1)
+        return old is None
+
+    def release(self, key: str):
+        """Drop a claimed key."""
+        self.table.discard(key)
+
+    def close(self):
+        """Close the table."""
+        self.table.close()
+
+
+class MmapUnitMeter:
+    """UnitMeter whose counters are shared by the processes of a node."""
+
+    def __init__(self, path: str, slots: int = 1 << 20):
+        """Initialize meter.
+
+        Args:
+            path: Table file
+            slots: Slot count of a new table
+        """
+        self.table = MmapTable(path, slots)
+
+    def consume(self, key: str, unit: int, expires: int, now: Optional[int] = None) -> int:
+        """Spend one unit of a token; see UnitMeter.consume()."""
+        if now is None:
+            now = int(time.time())
+        if expires <= now:
+            return -1
+
+        def spend(value):
+            value = max(unit, 1) if value is None else value
+            return value - 1 if value > 0 else value
+
+        old, new = self.table.update(key, expires, spend, now)
+        return new if old is None or old > 0 else -1
+
+    def remaining(self, key: str) -> Optional[int]:
+        """Get the units left on a token, or None if it was not used."""
+        return self.table.get(key)
+
+    def exhausted(self, key: str) -> bool:
+        """Check whether a token has spent all of its units."""
+        remaining = self.table.get(key)
+        return remaining is not None and remaining <= 0
+
+    def close(self):
+        """Close the table."""
+        self.table.close()
+
+
+class RedisReplayStore(ReplayStore):
+    """Replay store shared by all nodes through a Redis-compatible server.
+
+    Nonces are written with one pipelined SET per batch. Lookups that
+    find a nonce are cached, since an issued nonce stays issued until
+    it expires.
+    """
+
+    def __init__(self, client: RespClient, cache_size: int = 100000):
+        """Initialize store.
+
+        Args:
+            client: Connection to the server
+            cache_size: Issued nonces remembered locally
+        """
+        self.client = client
+        self.cache_size = cache_size
+        self._cache: Dict[str, int] = {}
+
+    def add_many(self, entries: Iterable[Tuple[str, int]]):
+        """Record issued nonces."""
+        entries = list(entries)
+        replies = self.client.pipeline([
+            ("SET", REPLAY_PREFIX + nonce, expires, "EXAT", expires) for nonce, expires in entries
+        ])
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        for nonce, expires in entries:
+            self._remember(nonce, expires)
+
+    def issued(self, nonce: str) -> bool:
+        """Check whether a nonce was issued and has not expired."""
+        now = time.time()
+        expires = self._cache.get(nonce)
+        if expires is not None:
+            return expires > now
+
+        value = self.client.execute("GET", REPLAY_PREFIX + nonce)
+        if value is None:
+            return False
+        expires = int(value)
+        self._remember(nonce, expires)
+        return expires > now
+
+    def claim(self, key: str, expires: int) -> bool:
+        """Record a key unless it is live, with SET NX."""
+        reply = self.client.execute("SET", REPLAY_PREFIX + key, expires, "EXAT", expires, "NX")
+        if reply is None:
+            return False
+        self._remember(key, expires)
+        return True
+
+    def release(self, key: str):
+        """Drop a claimed key."""
+        self._cache.pop(key, None)
+        self.client.execute("DEL", REPLAY_PREFIX + key)
+
+    def close(self):
+        """Close the connection."""
+        self.client.close()
+
+    def _remember(self, nonce: str, expires: int):
+        """Cache an issued nonce, evicting the oldest when full."""
+        if len(self._cache) >= self.cache_size:
+            del self._cache[next(iter(self._cache))]
+        self._cache[nonce] = expires
+
+
+class RedisUnitMeter:
+    """UnitMeter whose counters are shared by all nodes, written behind.
+
+    Spends are taken from a local copy of each counter at once and
+    pushed to the server by a background thread as pipelined DECRBYs,
+    every ``flush_interval`` seconds or when ``max_pending`` tokens have
+    unpushed spends. Each push brings back the shared count, which
+    lowers the local one. A token can therefore be overspent by what
+    other nodes spent since their last push, in exchange for never
+    waiting on the network after a token's first use on a node.
+
+    If the server cannot be reached, counting goes on locally and the
+    spends are pushed once it is back.
+    """
+
+    def __init__(
+        self,
+        client: RespClient,
+        flush_interval: float = 0.05,
+        max_pending: int = 1024,
+    ):
+        """Initialize meter and start its flush thread.
+
+        Args:
+            client: Connection to the server
+            flush_interval: Seconds between pushes
+            max_pending: Tokens with unpushed spends that trigger a push
+        """
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # key -> [remaining, unit, expires]
+        self._counters: Dict[str, List[int]] = {}
+        # key -> spends not pushed yet
+        self._pending: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def consume(self, key: str, unit: int, expires: int, now: Optional[int] = None) -> int:
+        """Spend one unit of a token; see UnitMeter.consume()."""
+        if now is None:
+            now = int(time.time())
+        if expires <= now:
+            return -1
+
+        entry = self._counters.get(key)
+        if entry is None:
+            entry = self._load(key, max(unit, 1), expires)
+
+        with self._lock:
+            if entry[0] <= 0:
+                return -1
+            entry[0] -= 1
+            self._pending[key] = self._pending.get(key, 0) + 1
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+            return entry[0]
+
+    def remaining(self, key: str) -> Optional[int]:
+        """Get the units left on a token, or None if it was not used here."""
+        entry = self._counters.get(key)
+        return None if entry is None else entry[0]
+
+    def exhausted(self, key: str) -> bool:
+        """Check whether a token has spent all of its units."""
+        entry = self._counters.get(key)
+        return entry is not None and entry[0] <= 0
+
+    def flush(self):
+        """Push unpushed spends and refresh the local counts."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        now = int(time.time())
+        keys = [key for key in pending if self._counters[key][2] > now]
+        commands = []
+        for key in keys:
+            _, unit, expires = self._counters[key]
+            # Recreate counters that expired or were evicted on the server
+            commands.append(("SET", UNITS_PREFIX + key, unit, "EXAT", expires, "NX"))
+            commands.append(("DECRBY", UNITS_PREFIX + key, pending[key]))
+        try:
+            replies = self.client.pipeline(commands)
+        except OSError as e:
+            logger.warning("Could not push unit counters: %s", e)
+            with self._lock:
+                for key, spent in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + spent
+            return
+
+        with self._lock:
+            for key, remaining in zip(keys, replies[1::2]):
+                if isinstance(remaining, int):
+                    entry = self._counters[key]
+                    entry[0] = min(entry[0], remaining)
+            self._expire(now)
+
+    def close(self):
+        """Stop the flush thread and push what is left."""
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self.client.close()
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    def _load(self, key: str, unit: int, expires: int) -> List[int]:
+        """Start tracking a token, from the shared count if it has one."""
+        try:
+            _, value = self.client.pipeline([
+                ("SET", UNITS_PREFIX + key, unit, "EXAT", expires, "NX"),
+                ("GET", UNITS_PREFIX + key),
+            ])
+            remaining = int(value) if value is not None else unit
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read unit counter, counting locally: %s", e)
+            remaining = unit
+        with self._lock:
+            return self._counters.setdefault(key, [remaining, unit, expires])
+
+    def _expire(self, now: int):
+        """Drop counters of expired tokens with nothing left to push."""
+        for key in [k for k, entry in self._counters.items() if entry[2] <= now]:
+            if key not in self._pending:
+                del self._counters[key]
+
+    def _run(self):
+        """Push spends until closed."""
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+def open_store(url: str) -> Tuple[ReplayStore, object]:
+    """Open the replay store and unit meter for a store URL.
+
+    Args:
+        url: ``memory://``, ``mmap:///dir`` or ``redis://[:password@]host:port/db``
+
+    Returns:
+        tuple: (ReplayStore, meter)
+
+    Raises:
+        ValueError: If the URL scheme is not supported
+    """
+    parts = urlsplit(url)
+    if parts.scheme == "memory":
+        return MemoryReplayStore(), UnitMeter()
+    if parts.scheme == "mmap":
+        return (
+            MmapReplayStore(os.path.join(parts.path, "replay.tbl")),
+            MmapUnitMeter(os.path.join(parts.path, "units.tbl")),
+        )
+    if parts.scheme == "redis":
+        return RedisReplayStore(open_client(url)), RedisUnitMeter(open_client(url))
+    raise ValueError(f"Unsupported store URL: {url}")
+
+
+def open_client(url: str) -> RespClient:
+    """Open a client for a ``redis://[:password@]host:port/db`` URL.
+
+    Args:
+        url: Store URL
+
+    Returns:
+        RespClient: Client, connected on first use
+
+    Raises:
+        ValueError: If the URL is not a redis:// URL
+    """
+    parts = urlsplit(url)
+    if parts.scheme != "redis":
+        raise ValueError(f"Not a redis:// URL: {url}")
+    return RespClient(
+        host=parts.hostname or "127.0.0.1",
+        port=parts.port or 6379,
+        db=int(parts.path.strip("/") or 0),
+        password=parts.password,
+    )
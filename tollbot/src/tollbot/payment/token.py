@@ -6,8 +6,57 @@ import base64
 import hashlib
 import hmac
 import json
+import logging
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Sequence, Union
+
+from tollbot.payment.meter import UnitMeter
+from tollbot.uri import normalize_path
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = {"alg": "HS256", "typ": "tollbot"}
+PREPAID_HEADER = {"alg": "HS256", "typ": "tollbot-prepaid"}
+TOKEN_TTL = 3600
+# Signature algorithms: HMAC-SHA256 with a shared secret, or Ed25519
+ALGORITHMS = ("HS256", "EdDSA")
+
+
+def _b64url_encode(data: bytes) -> str:
+    """Encode bytes as unpadded URL-safe base64."""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_decode(data: str) -> bytes:
+    """Decode unpadded URL-safe base64."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _header_segment(header: dict, algorithm: str) -> str:
+    """Encode a token header for an algorithm."""
+    return _b64url_encode(json.dumps(dict(header, alg=algorithm), sort_keys=True).encode())
+
+
+# (algorithm, prepaid) by encoded header, and back
+_HEADERS = {
+    _header_segment(header, algorithm): (algorithm, header is PREPAID_HEADER)
+    for algorithm in ALGORITHMS
+    for header in (TOKEN_HEADER, PREPAID_HEADER)
+}
+_SEGMENTS = {kind: segment for segment, kind in _HEADERS.items()}
+
+
+def _load_ed25519():
+    """Import the Ed25519 primitives of the optional cryptography package."""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.exceptions import InvalidSignature
+    except ImportError:
+        raise RuntimeError(
+            "Ed25519 signing requires the cryptography package (pip install tollbot[ed25519])"
+        )
+    return ed25519, serialization, InvalidSignature
 
 
 @dataclass
@@ -21,6 +70,30 @@ class PaymentToken:
     timestamp: int
     nonce: str
     signature: Optional[str] = None
+    payment_id: Optional[str] = None
+    shard: Optional[int] = None
+    epoch: Optional[int] = None
+    algorithm: str = "HS256"
+
+
+@dataclass
+class PrepaidToken:
+    """Stateless prepaid token.
+
+    Everything needed to accept it is signed into it: the validity
+    window, path scope and request quota. It has no nonce to record;
+    a serial identifies it in revocation lists.
+    """
+    wallet_id: str
+    currency: str
+    amount: float
+    quota: int
+    path: str
+    serial: int
+    not_before: int
+    not_after: int
+    signature: Optional[str] = None
+    algorithm: str = "HS256"
 
 
 class TokenManager:
@@ -33,9 +106,37 @@ class TokenManager:
             config_dir: Directory containing wallet configuration
         """
         self.config_dir = config_dir
+        self.signing_key_file = os.path.join(config_dir, "signing.key")
         self._private_key = None
         self._public_key = None
-        self._used_nonces = set()
+        # Algorithm new tokens are signed with; EdDSA once an Ed25519
+        # signing key is loaded
+        self.algorithm = "HS256"
+        # Ed25519 keys: only minting needs the signing key, edge nodes
+        # verify with the public key from verify.pem
+        self._signing_key = None
+        self._verify_key = None
+        # Modification times of the key files when keys were last loaded
+        self._keys_mtime = None
+        self.wallet = {}
+        self.meter = UnitMeter()
+        # Optional SettlementVerifier; when set, tokens must carry a
+        # payment_id settled for their amount and currency to their wallet
+        self.settlement = None
+        # Optional ReplayStore; when set, tokens must have been issued
+        # through it
+        self.replay = None
+        # Optional Tracer timing the stages of validate_token
+        self.tracer = None
+        # Optional EpochShard; when set, tokens are stamped with its shard
+        # and epoch, and tokens of other shards are rejected
+        self.shard = None
+        # Optional RevocationList of prepaid token serials
+        self.revocations = None
+        # Serials for prepaid tokens, allocated on first use
+        self.serials = None
+        # Prepaid quotas are counted per process, never shared
+        self.quotas = UnitMeter()
 
     def generate_keypair(self) -> str:
         """Generate a new keypair for signing tokens.
@@ -69,26 +170,206 @@ class TokenManager:
         try:
             with open(wallet_file, "r") as f:
                 for line in f:
-                    line = line.strip()
-                    if line.startswith("public_key="):
-                        self._public_key = line.split("=", 1)[1]
-            return True
+                    key, sep, value = line.strip().partition("=")
+                    if sep:
+                        self.wallet[key] = value
+                    if key == "public_key":
+                        self._public_key = value
         except Exception:
             return False
 
-    def sign_token(self, token: PaymentToken) -> str:
+        self.load_signing_key()
+        return True
+
+    @property
+    def has_signing_key(self) -> bool:
+        """Whether a signing key is loaded."""
+        if self.algorithm == "EdDSA":
+            return self._signing_key is not None
+        return self._private_key is not None
+
+    def load_signing_key(self) -> bool:
+        """Load the token signing secret, and the Ed25519 keys if present.
+
+        An Ed25519 signing key (signing.pem) switches new tokens to EdDSA.
+
+        Returns:
+            bool: True if a signing key was loaded
+        """
+        self._keys_mtime = self._key_mtimes()
+        self.load_verify_key()
+        ed25519_file = os.path.join(self.config_dir, "signing.pem")
+        if os.path.exists(ed25519_file):
+            _, serialization, _ = _load_ed25519()
+            with open(ed25519_file, "rb") as f:
+                self._signing_key = serialization.load_pem_private_key(f.read(), password=None)
+            self.algorithm = "EdDSA"
+
+        if not os.path.exists(self.signing_key_file):
+            return self._signing_key is not None
+
+        with open(self.signing_key_file, "r") as f:
+            self._private_key = f.read().strip()
+        return True
+
+    def reload_keys(self) -> bool:
+        """Reload the signing and verify keys if their files changed.
+
+        The keys are loaded into a fresh manager and swapped in, so a
+        check running meanwhile uses either the old or the new keys.
+        Files that fail to load leave the old keys in place.
+
+        Returns:
+            bool: True if new keys were loaded
+        """
+        mtimes = self._key_mtimes()
+        if mtimes == self._keys_mtime:
+            return False
+
+        fresh = TokenManager(self.config_dir)
+        fresh.signing_key_file = self.signing_key_file
+        try:
+            fresh.load_signing_key()
+        except (OSError, ValueError) as e:
+            logger.warning("Could not reload token keys: %s", e)
+            self._keys_mtime = mtimes
+            return False
+
+        self._private_key = fresh._private_key
+        self._signing_key = fresh._signing_key
+        self._verify_key = fresh._verify_key
+        self.algorithm = fresh.algorithm
+        self._keys_mtime = fresh._keys_mtime
+        logger.info("Reloaded token keys (%s)", self.algorithm)
+        return True
+
+    def _key_mtimes(self) -> tuple:
+        """Get the modification times of signing.key, signing.pem and verify.pem."""
+        mtimes = []
+        for path in (
+            self.signing_key_file,
+            os.path.join(self.config_dir, "signing.pem"),
+            os.path.join(self.config_dir, "verify.pem"),
+        ):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def load_verify_key(self) -> bool:
+        """Load the Ed25519 public key that EdDSA tokens are checked with.
+
+        Returns:
+            bool: True if verify.pem was loaded
+        """
+        verify_file = os.path.join(self.config_dir, "verify.pem")
+        if not os.path.exists(verify_file):
+            return False
+
+        _, serialization, _ = _load_ed25519()
+        with open(verify_file, "rb") as f:
+            self._verify_key = serialization.load_pem_public_key(f.read())
+        return True
+
+    def generate_ed25519_keypair(self) -> str:
+        """Generate an Ed25519 keypair and sign new tokens with it.
+
+        Returns:
+            str: PEM-encoded public key
+        """
+        ed25519, serialization, _ = _load_ed25519()
+        self._signing_key = ed25519.Ed25519PrivateKey.generate()
+        self._verify_key = self._signing_key.public_key()
+        self.algorithm = "EdDSA"
+        return self._verify_key.public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+
+    def save_ed25519_keys(self):
+        """Write signing.pem, readable by the owner only, and verify.pem.
+
+        Enforcement nodes (and the nginx filter) only need verify.pem.
+        """
+        if self._signing_key is None:
+            raise ValueError("Ed25519 signing key not available")
+
+        _, serialization, _ = _load_ed25519()
+        private_pem = self._signing_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        fd = os.open(
+            os.path.join(self.config_dir, "signing.pem"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(fd, "wb") as f:
+            f.write(private_pem)
+        with open(os.path.join(self.config_dir, "verify.pem"), "wb") as f:
+            f.write(self._verify_key.public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+            ))
+
+    def save_signing_key(self):
+        """Write the token signing secret, readable by the owner only.
+
+        The nginx filter verifies signatures with the same secret.
+        """
+        if self._private_key is None:
+            raise ValueError("Private key not available")
+
+        fd = os.open(self.signing_key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self._private_key + "\n")
+
+    def sign_token(self, token: Union[PaymentToken, PrepaidToken]) -> str:
         """Sign a payment token.
 
         Args:
-            token: PaymentToken to sign
+            token: PaymentToken or PrepaidToken to sign, with the
+                algorithm it is signed with
 
         Returns:
             str: Base64-encoded signature
         """
+        if token.algorithm == "EdDSA":
+            if self._signing_key is None:
+                raise ValueError("Ed25519 signing key not available")
+            return base64.b64encode(self._signing_key.sign(self._signing_payload(token))).decode()
+
         if self._private_key is None:
             raise ValueError("Private key not available")
 
-        token_data = json.dumps({
+        signature = hmac.new(
+            self._private_key.encode(),
+            self._signing_payload(token),
+            hashlib.sha256
+        ).digest()
+
+        return base64.b64encode(signature).decode()
+
+    def _signing_payload(self, token: Union[PaymentToken, PrepaidToken]) -> bytes:
+        """Serialize the signed fields of a token canonically.
+
+        Args:
+            token: PaymentToken or PrepaidToken to serialize
+
+        Returns:
+            bytes: Canonical JSON of the signed fields
+        """
+        if isinstance(token, PrepaidToken):
+            return json.dumps({
+                "wallet_id": token.wallet_id,
+                "currency": token.currency,
+                "amount": token.amount,
+                "quota": token.quota,
+                "path": token.path,
+                "serial": token.serial,
+                "not_before": token.not_before,
+                "not_after": token.not_after,
+            }, sort_keys=True).encode()
+
+        data = {
             "wallet_id": token.wallet_id,
             "currency": token.currency,
             "amount": token.amount,
@@ -96,15 +377,89 @@ class TokenManager:
             "path": token.path,
             "timestamp": token.timestamp,
             "nonce": token.nonce,
-        }, sort_keys=True)
+        }
+        if token.payment_id is not None:
+            data["payment_id"] = token.payment_id
+        if token.shard is not None:
+            data["shard"] = token.shard
+            data["epoch"] = token.epoch
 
-        signature = hmac.new(
-            self._private_key.encode(),
-            token_data.encode(),
-            hashlib.sha256
-        ).digest()
+        return json.dumps(data, sort_keys=True).encode()
 
-        return base64.b64encode(signature).decode()
+    def encode_token(self, token: Union[PaymentToken, PrepaidToken]) -> str:
+        """Encode a signed token for transport.
+
+        The format is ``header.payload.signature`` in unpadded URL-safe
+        base64. The payload is the exact byte string that was signed, so
+        verifiers can check the HMAC without re-serializing it. The
+        header tells prepaid tokens apart.
+
+        Args:
+            token: Signed PaymentToken or PrepaidToken
+
+        Returns:
+            str: Encoded token
+        """
+        if token.signature is None:
+            token.signature = self.sign_token(token)
+
+        return ".".join((
+            _SEGMENTS[token.algorithm, isinstance(token, PrepaidToken)],
+            _b64url_encode(self._signing_payload(token)),
+            _b64url_encode(base64.b64decode(token.signature)),
+        ))
+
+    def decode_token(self, encoded: str) -> Union[PaymentToken, PrepaidToken]:
+        """Decode a token produced by encode_token.
+
+        The signature is not checked here; see validate_token.
+
+        Args:
+            encoded: Encoded token string
+
+        Returns:
+            PaymentToken or PrepaidToken: Decoded token
+
+        Raises:
+            ValueError: If the token is malformed
+        """
+        parts = encoded.split(".")
+        if len(parts) != 3 or parts[0] not in _HEADERS:
+            raise ValueError("Invalid token format")
+        algorithm, prepaid = _HEADERS[parts[0]]
+
+        try:
+            payload = json.loads(_b64url_decode(parts[1]))
+            signature = base64.b64encode(_b64url_decode(parts[2])).decode()
+            if prepaid:
+                return PrepaidToken(
+                    wallet_id=payload["wallet_id"],
+                    currency=payload["currency"],
+                    amount=payload["amount"],
+                    quota=payload["quota"],
+                    path=payload["path"],
+                    serial=payload["serial"],
+                    not_before=payload["not_before"],
+                    not_after=payload["not_after"],
+                    signature=signature,
+                    algorithm=algorithm,
+                )
+            return PaymentToken(
+                wallet_id=payload["wallet_id"],
+                currency=payload["currency"],
+                amount=payload["amount"],
+                unit=payload["unit"],
+                path=payload["path"],
+                timestamp=payload["timestamp"],
+                nonce=payload["nonce"],
+                signature=signature,
+                payment_id=payload.get("payment_id"),
+                shard=payload.get("shard"),
+                epoch=payload.get("epoch"),
+                algorithm=algorithm,
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid token payload: {e}")
 
     def create_token(
         self,
@@ -114,6 +469,7 @@ class TokenManager:
         unit: int,
         path: str,
         ttl: int = 3600,
+        payment_id: Optional[str] = None,
     ) -> PaymentToken:
         """Create a new payment token.
 
@@ -124,6 +480,7 @@ class TokenManager:
             unit: Unit definition
             path: Protected path
             ttl: Token time-to-live in seconds
+            payment_id: USDC transfer that paid for the token
 
         Returns:
             PaymentToken: Generated token
@@ -137,62 +494,301 @@ class TokenManager:
             currency=currency,
             amount=amount,
             unit=unit,
-            path=path,
+            path=normalize_path(path),
             timestamp=timestamp,
             nonce=nonce,
+            payment_id=payment_id,
+            algorithm=self.algorithm,
         )
+        if self.shard is not None:
+            token.shard = self.shard.shard_id
+            token.epoch = self.shard.epoch(timestamp)
 
         token.signature = self.sign_token(token)
 
+        # Start settlement checks now so they are done before first use
+        if (
+            payment_id is not None
+            and self.settlement is not None
+            and not self.settlement.is_settled(payment_id)
+        ):
+            self.settlement.submit(payment_id)
+
+        return token
+
+    def create_prepaid_token(
+        self,
+        wallet_id: str,
+        currency: str,
+        amount: float,
+        quota: int,
+        path: str,
+        ttl: int = TOKEN_TTL,
+        not_before: Optional[int] = None,
+    ) -> PrepaidToken:
+        """Create a stateless prepaid token.
+
+        Nothing is recorded: the token is accepted on its signature,
+        window, scope and quota until it expires or its serial is revoked.
+
+        Args:
+            wallet_id: Wallet identifier
+            currency: Currency code (e.g., USDC)
+            amount: Payment amount
+            quota: Requests the token pays for
+            path: Protected path
+            ttl: Seconds the token is valid for after not_before
+            not_before: Unix time the token becomes valid (default now)
+
+        Returns:
+            PrepaidToken: Signed token
+        """
+        if self.serials is None:
+            from tollbot.payment.revocation import SerialAllocator
+            self.serials = SerialAllocator(os.path.join(self.config_dir, "serial"))
+
+        if not_before is None:
+            not_before = int(time.time())
+        token = PrepaidToken(
+            wallet_id=wallet_id,
+            currency=currency,
+            amount=amount,
+            quota=quota,
+            path=normalize_path(path),
+            serial=self.serials.next(),
+            not_before=not_before,
+            not_after=not_before + ttl,
+            algorithm=self.algorithm,
+        )
+        token.signature = self.sign_token(token)
         return token
 
     def validate_token(
         self,
-        token: PaymentToken,
+        token: Union[PaymentToken, PrepaidToken],
         min_amount: float,
         requested_path: str,
     ) -> bool:
         """Validate a payment token.
 
         Args:
-            token: PaymentToken to validate
+            token: PaymentToken or PrepaidToken to validate
             min_amount: Minimum required payment amount
             requested_path: Path being requested
 
         Returns:
             bool: True if token is valid
         """
-        expected_signature = self.sign_token(token)
-        if not hmac.compare_digest(token.signature, expected_signature):
+        tracer = self.tracer
+        if tracer is None:
+            return self._validate_token(token, min_amount, requested_path)
+
+        started = tracer.start("validate_token")
+        try:
+            return self._validate_token(token, min_amount, requested_path)
+        finally:
+            if started:
+                tracer.finish()
+
+    def _validate_token(self, token: PaymentToken, min_amount: float, requested_path: str) -> bool:
+        """Validate a payment token; see validate_token()."""
+        valid = self.verify_signature(token)
+        if self.tracer is not None:
+            self.tracer.stage("signature")
+        if not valid:
+            return False
+
+        return self.redeem_token(token, min_amount, requested_path)
+
+    def verify_signature(self, token: Union[PaymentToken, PrepaidToken]) -> bool:
+        """Check a token's signature.
+
+        EdDSA tokens need only the public key; HS256 tokens need the
+        shared secret, and are refused once an Ed25519 key is loaded so
+        that a leaked secret cannot forge tokens.
+
+        Args:
+            token: Decoded token
+
+        Returns:
+            bool: True if the signature is valid
+        """
+        if token.algorithm == "EdDSA":
+            if self._verify_key is None:
+                return False
+            _, _, InvalidSignature = _load_ed25519()
+            try:
+                self._verify_key.verify(base64.b64decode(token.signature), self._signing_payload(token))
+            except (InvalidSignature, ValueError):
+                return False
+            return True
+
+        if self._private_key is None or self._verify_key is not None:
+            return False
+        return hmac.compare_digest(token.signature, self.sign_token(token))
+
+    def verify_batch(self, tokens: Sequence[Union[PaymentToken, PrepaidToken]]) -> List[bool]:
+        """Check the signatures of many tokens at once.
+
+        The key and the exception class are looked up once for the whole
+        batch, and a token presented several times in it is checked once.
+        cryptography has no multi-signature Ed25519 verification, so
+        each distinct signature still costs one verify.
+
+        Args:
+            tokens: Decoded tokens
+
+        Returns:
+            list: One result per token
+        """
+        verify_key = self._verify_key
+        InvalidSignature = _load_ed25519()[2] if verify_key is not None else None
+        seen = {}
+        results = []
+        for token in tokens:
+            payload = self._signing_payload(token)
+            key = (token.algorithm, payload, token.signature)
+            valid = seen.get(key)
+            if valid is None:
+                if token.algorithm != "EdDSA":
+                    valid = self.verify_signature(token)
+                elif verify_key is None:
+                    valid = False
+                else:
+                    try:
+                        verify_key.verify(base64.b64decode(token.signature), payload)
+                        valid = True
+                    except (InvalidSignature, ValueError):
+                        valid = False
+                seen[key] = valid
+            results.append(valid)
+        return results
+
+    def redeem_token(
+        self,
+        token: Union[PaymentToken, PrepaidToken],
+        min_amount: float,
+        requested_path: str,
+    ) -> bool:
+        """Spend one request from a token whose signature was verified.
+
+        A token pays for ``unit`` requests; each call consumes one.
+
+        Args:
+            token: Verified PaymentToken or PrepaidToken
+            min_amount: Minimum required payment amount
+            requested_path: Path being requested
+
+        Returns:
+            bool: True if the request is covered by the token
+        """
+        now = int(time.time())
+        if isinstance(token, PrepaidToken):
+            return self._redeem_prepaid(token, min_amount, requested_path, now)
+
+        if token.timestamp < now - TOKEN_TTL:
             return False
 
-        if token.timestamp < int(time.time()) - 3600:
+        # Out-of-shard tokens never reach the stores below
+        if self.shard is not None and self.shard.check(token, now) is not None:
             return False
 
-        if not requested_path.startswith(token.path):
+        if not normalize_path(requested_path).startswith(token.path):
             return False
 
         if token.amount < min_amount:
             return False
 
-        if token.nonce in self._used_nonces:
+        tracer = self.tracer
+        if self.replay is not None:
+            issued = self.replay.issued(token.nonce)
+            if tracer is not None:
+                tracer.stage("nonce")
+            if not issued:
+                return False
+
+        if self.settlement is not None:
+            settled = self.settlement.covers(
+                token.payment_id, token.amount, token.currency, token.wallet_id
+            )
+            if tracer is not None:
+                tracer.stage("settlement")
+            if not settled:
+                return False
+
+        remaining = self.meter.consume(token.nonce, token.unit, token.timestamp + TOKEN_TTL, now)
+        if tracer is not None:
+            tracer.stage("meter")
+        return remaining >= 0
+
+    def _redeem_prepaid(
+        self, token: PrepaidToken, min_amount: float, requested_path: str, now: int
+    ) -> bool:
+        """Spend one request from a verified prepaid token; see redeem_token().
+
+        The quota is counted in this process only, so a token can serve
+        up to its quota on every process it is presented to.
+        """
+        if not token.not_before <= now < token.not_after:
             return False
 
-        self._used_nonces.add(token.nonce)
+        if not normalize_path(requested_path).startswith(token.path):
+            return False
 
-        return True
+        if token.amount < min_amount:
+            return False
 
-    def rotate_keys(self, config_dir: Optional[str] = None):
+        tracer = self.tracer
+        if self.revocations is not None:
+            revoked = self.revocations.is_revoked(token.serial)
+            if tracer is not None:
+                tracer.stage("revocation")
+            if revoked:
+                return False
+
+        remaining = self.quotas.consume(f"p:{token.serial}", token.quota, token.not_after, now)
+        if tracer is not None:
+            tracer.stage("quota")
+        return remaining >= 0
+
+    def rotate_keys(self, config_dir: Optional[str] = None, ed25519: bool = False):
         """Rotate wallet keys.
 
         Args:
             config_dir: Configuration directory
+            ed25519: Generate Ed25519 keys instead, sign new tokens with
+                them from now on, and remove the HS256 secret; without
+                it, an earlier rotation to Ed25519 is undone
         """
         if config_dir is None:
             config_dir = self.config_dir
+        self.signing_key_file = os.path.join(config_dir, "signing.key")
+        wallet_file = os.path.join(config_dir, "wallet.conf")
+
+        if ed25519:
+            self.config_dir = config_dir
+            self.generate_ed25519_keypair()
+            self.save_ed25519_keys()
+            # Anyone holding the shared secret could still mint HS256 tokens
+            self._private_key = None
+            if os.path.exists(self.signing_key_file):
+                os.remove(self.signing_key_file)
+            with open(wallet_file, "a") as f:
+                f.write(f"rotation_timestamp={int(time.time())}\n")
+            return
+
+        # Back to HS256: Ed25519 keys left behind would be loaded again
+        # and make nodes refuse the new HS256 tokens
+        self._signing_key = None
+        self._verify_key = None
+        self.algorithm = "HS256"
+        for name in ("signing.pem", "verify.pem"):
+            path = os.path.join(config_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
 
         new_public_key = self.generate_keypair()
-        wallet_file = os.path.join(config_dir, "wallet.conf")
+        self.save_signing_key()
 
         with open(wallet_file, "a") as f:
             f.write(f"public_key={new_public_key}\n")
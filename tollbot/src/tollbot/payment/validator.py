@@ -2,9 +2,21 @@
 import os
 import json
 import time
-from typing import Optional
+from http import HTTPStatus
+from typing import Optional, Tuple
 
-from tollbot.payment.token import TokenManager
+from tollbot.metrics import Metrics
+from tollbot.payment.ratelimit import RateLimiter
+from tollbot.payment.revocation import RevocationList, SerialAllocator
+from tollbot.payment.token import PrepaidToken, TokenManager
+from tollbot.robots_parser import RobotsParser
+from tollbot.tracing import Tracer
+
+TOKEN_CACHE_SIZE = 10000
+# Seconds between checks of robots_cache.json for a new price table
+PRICE_RELOAD_INTERVAL = 1.0
+# Throttled rejections written to the audit log: one in every N
+THROTTLED_AUDIT_SAMPLE = 100
 
 
 class PaymentValidator:
@@ -18,7 +30,23 @@ class PaymentValidator:
         """
         self.config_dir = config_dir
         self.manager = TokenManager(config_dir)
+        self.manager.load_signing_key()
         self.dry_run = False
+        self.audit = None
+        self.metrics = Metrics()
+        # Optional Tracer timing the stages of each check; see set_tracer()
+        self.tracer = None
+        self._throttled = 0
+        # Verified tokens by their encoded form, so repeat presentations
+        # of a unit token skip decoding and signature checks
+        self._verified = {}
+        self._revocations_mtime = None
+        # Price table from robots_cache.json, with its lookups cached
+        self.prices = RobotsParser(metrics=self.metrics)
+        self._prices_mtime = None
+        self._prices_checked = float("-inf")
+        # Optional DemandPricing scaling prices with traffic
+        self.demand = None
         self._load_config()
 
     def _load_config(self):
@@ -35,6 +63,91 @@ class PaymentValidator:
         self.default_price = float(self.config.get("default_price", 0.001))
         self.default_unit = int(self.config.get("default_unit", 100))
 
+        rate_limit = float(self.config.get("rate_limit", 1.0))
+        burst = int(self.config.get("rate_burst", 20))
+        self.limiter = RateLimiter(rate_limit, burst) if rate_limit > 0 else None
+
+        trace_buffer = int(self.config.get("trace_buffer", 0))
+        if trace_buffer > 0:
+            self.set_tracer(Tracer(trace_buffer))
+
+        audit_dir = self.config.get("audit_log_dir")
+        if audit_dir:
+            from tollbot.logging.audit import AuditLogger
+            self.audit = AuditLogger(
+                audit_dir,
+                aggregate=bool(self.config.get("audit_aggregate", False)),
+                sample_rate=int(self.config.get("audit_sample_rate", 0)),
+                metrics=self.metrics,
+            )
+
+        store_url = self.config.get("store_url")
+        if store_url:
+            from tollbot.payment.store import open_client, open_store
+            self.manager.replay, self.manager.meter = open_store(store_url)
+            if store_url.startswith("redis://"):
+                # Prepaid serials must not collide across nodes
+                self.manager.serials = SerialAllocator(
+                    os.path.join(self.config_dir, "serial"), client=open_client(store_url)
+                )
+
+        shard_id = self.config.get("shard_id")
+        if shard_id is not None:
+            from tollbot.payment.shard import DEFAULT_EPOCH_LENGTH, EpochShard
+            from tollbot.payment.store import open_client
+            self.manager.shard = EpochShard(
+                int(shard_id),
+                int(self.config.get("shard_count", 1)),
+                int(self.config.get("epoch_length", DEFAULT_EPOCH_LENGTH)),
+                open_client(store_url) if (store_url or "").startswith("redis://") else None,
+            )
+
+        self.reload_revocations()
+
+        demand_target_rate = float(self.config.get("demand_target_rate", 0))
+        if demand_target_rate > 0:
+            from tollbot.pricing import DEFAULT_MAX_FACTOR, DEFAULT_WINDOW, DemandPricing
+            self.demand = DemandPricing(
+                demand_target_rate,
+                int(self.config.get("demand_window", DEFAULT_WINDOW)),
+                float(self.config.get("demand_max_factor", DEFAULT_MAX_FACTOR)),
+                metrics=self.metrics,
+            )
+
+        settlement_url = self.config.get("settlement_url")
+        if settlement_url:
+            from tollbot.payment.settlement import HttpSettlementBackend, SettlementVerifier
+            backend = HttpSettlementBackend(settlement_url, self.config.get("settlement_api_key"))
+            self.manager.settlement = SettlementVerifier(backend)
+
+    def reload_revocations(self):
+        """Load revoked.json if it changed since the last load."""
+        path = os.path.join(self.config_dir, "revoked.json")
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        if mtime != self._revocations_mtime:
+            self.manager.revocations = RevocationList.load(path)
+            self._revocations_mtime = mtime
+
+    def reload_keys(self):
+        """Reload the token keys if their files changed.
+
+        Tokens verified with the old keys are forgotten.
+        """
+        if self.manager.reload_keys():
+            self._verified = {}
+
+    def set_tracer(self, tracer: Optional[Tracer]):
+        """Time the stages of every check, or stop with None.
+
+        Args:
+            tracer: Tracer to record into
+        """
+        self.tracer = tracer
+        self.manager.tracer = tracer
+
     def validate_request(
         self,
         token: str,
@@ -51,15 +164,183 @@ class PaymentValidator:
         Returns:
             bool: True if request is authorized
         """
+        return self.check_request(token, path, amount) == HTTPStatus.OK
+
+    def check_request(
+        self,
+        token: Optional[str],
+        path: str,
+        amount: Optional[float] = None,
+        client_ip: Optional[str] = None,
+        user_agent: Optional[str] = None,
+    ) -> HTTPStatus:
+        """Check a request and get the status to answer it with.
+
+        Rejections drain the client's rate limit bucket. Once it is
+        empty the client is answered TOO_MANY_REQUESTS without looking
+        at its token until the bucket refills.
+
+        Args:
+            token: Base64-encoded payment token, if one was presented
+            path: Requested path
+            amount: Expected payment amount
+            client_ip: Client IP address, for rate limiting and audit
+            user_agent: Client User-Agent header, for rate limiting
+
+        Returns:
+            HTTPStatus: OK if authorized, PAYMENT_REQUIRED if there is no
+            token or its units are spent, FORBIDDEN if it is invalid,
+            TOO_MANY_REQUESTS if the client is rate limited
+        """
+        start = time.perf_counter()
+        tracer = self.tracer
+        if tracer is None:
+            status, reason = self._check_request(token, path, amount, client_ip, user_agent)
+        else:
+            started = tracer.start("validate_request")
+            try:
+                status, reason = self._check_request(token, path, amount, client_ip, user_agent)
+            finally:
+                if started:
+                    tracer.finish()
+        self.metrics.observe("validation_seconds", time.perf_counter() - start)
+        self.metrics.inc("validations", status=status.value)
+        if reason is not None:
+            self.metrics.inc("rejections", reason=reason)
+        return status
+
+    def _check_request(
+        self,
+        token: Optional[str],
+        path: str,
+        amount: Optional[float],
+        client_ip: Optional[str],
+        user_agent: Optional[str],
+    ) -> Tuple[HTTPStatus, Optional[str]]:
+        """Check a request; see check_request().
+
+        Returns:
+            tuple: (status, rejection reason or None)
+        """
         if self.dry_run:
-            return True
+            return HTTPStatus.OK, None
+
+        tracer = self.tracer
+        client = None
+        if self.limiter is not None and client_ip:
+            client = RateLimiter.client_key(client_ip, user_agent)
+            limited = self.limiter.limited(client)
+            if tracer is not None:
+                tracer.stage("rate_limit")
+            if limited:
+                return self._throttle(path, client_ip), "throttled"
+
+        # Surges apply to new mints only: a token paid for at the price of
+        # its mint stays good, so it is checked against the base price
+        path, _, price = self._lookup(path)
+        min_amount = amount or price
+        if tracer is not None:
+            tracer.stage("price_lookup")
+
+        status, reason = self._check_token(token, path, min_amount)
+        if status == HTTPStatus.OK:
+            if self.audit is not None:
+                # Accepted tokens are always in the verified cache
+                token_data = self._verified.get(token)
+                self.audit.log_validation(
+                    path,
+                    token_data.wallet_id if token_data is not None else None,
+                    token_data.amount if token_data is not None else min_amount,
+                    True,
+                    client_ip,
+                )
+                if tracer is not None:
+                    tracer.stage("audit")
+            return status, reason
 
+        if client is not None and not self.limiter.charge(client):
+            return self._throttle(path, client_ip), "throttled"
+        if self.audit is not None:
+            self.audit.log_request(path, min_amount, client_ip)
+            if tracer is not None:
+                tracer.stage("audit")
+        return status, reason
+
+    def _throttle(self, path: str, client_ip: str) -> HTTPStatus:
+        """Reject a rate limited client, auditing a sample of rejections."""
+        self._throttled += 1
+        if self.audit is not None and self._throttled % THROTTLED_AUDIT_SAMPLE == 1:
+            self.audit.log_validation(
+                path, None, 0.0, False, client_ip,
+                f"rate limited ({self._throttled} throttled)",
+            )
+        return HTTPStatus.TOO_MANY_REQUESTS
+
+    def _check_token(
+        self, token: Optional[str], path: str, min_amount: float
+    ) -> Tuple[HTTPStatus, Optional[str]]:
+        """Get the status and rejection reason for a request's token."""
+        if not token:
+            return HTTPStatus.PAYMENT_REQUIRED, "missing"
+
+        tracer = self.tracer
         try:
+            token_data = self._verified.get(token)
+            if token_data is not None:
+                self.metrics.inc("token_cache_hits")
+                if self.manager.redeem_token(token_data, min_amount, path):
+                    return HTTPStatus.OK, None
+                return self._rejection_status(token_data)
+
+            self.metrics.inc("token_cache_misses")
             token_data = self._decode_token(token)
-            min_amount = amount or self._get_min_price(path)
-            return self.manager.validate_token(token_data, min_amount, path)
+            if tracer is not None:
+                tracer.stage("decode")
+            if not self.manager.validate_token(token_data, min_amount, path):
+                return self._rejection_status(token_data)
+
+            if len(self._verified) >= TOKEN_CACHE_SIZE:
+                del self._verified[next(iter(self._verified))]
+            self._verified[token] = token_data
+            return HTTPStatus.OK, None
         except Exception:
-            return False
+            return HTTPStatus.FORBIDDEN, "invalid"
+
+    def _rejection_status(self, token) -> Tuple[HTTPStatus, str]:
+        """Get the status for a rejected token.
+
+        Args:
+            token: Rejected PaymentToken or PrepaidToken
+
+        Returns:
+            tuple: (MISDIRECTED_REQUEST if it belongs to another shard,
+            PAYMENT_REQUIRED if its units or quota are spent or its
+            payment has not settled, else FORBIDDEN; rejection reason)
+        """
+        if isinstance(token, PrepaidToken):
+            revocations = self.manager.revocations
+            if revocations is not None and revocations.is_revoked(token.serial):
+                return HTTPStatus.FORBIDDEN, "revoked"
+            if self.manager.quotas.exhausted(f"p:{token.serial}"):
+                return HTTPStatus.PAYMENT_REQUIRED, "exhausted"
+            return HTTPStatus.FORBIDDEN, "invalid"
+
+        shard = self.manager.shard
+        reason = shard.check(token) if shard is not None else None
+        if reason == "shard":
+            return HTTPStatus.MISDIRECTED_REQUEST, reason
+        if reason is not None:
+            return HTTPStatus.FORBIDDEN, reason
+
+        if self.manager.meter.exhausted(token.nonce):
+            return HTTPStatus.PAYMENT_REQUIRED, "exhausted"
+
+        settlement = self.manager.settlement
+        if settlement is not None and not settlement.covers(
+            token.payment_id, token.amount, token.currency, token.wallet_id
+        ):
+            return HTTPStatus.PAYMENT_REQUIRED, "unsettled"
+        return HTTPStatus.FORBIDDEN, "invalid"
 
     def _decode_token(self, token: str):
         """Decode a base64-encoded token.
@@ -70,19 +351,10 @@ class PaymentValidator:
         Returns:
             PaymentToken: Decoded token
         """
-        from tollbot.payment.token import PaymentToken
-        return PaymentToken(
-            wallet_id=self.wallet_id,
-            currency=self.currency,
-            amount=self.default_price,
-            unit=self.default_unit,
-            path="/",
-            timestamp=int(time.time()),
-            nonce="",
-        )
+        return self.manager.decode_token(token)
 
     def _get_min_price(self, path: str) -> float:
-        """Get minimum price for a path.
+        """Get the price of a new token for a path, surge included.
 
         Args:
             path: Requested path
@@ -90,17 +362,43 @@ class PaymentValidator:
         Returns:
             float: Minimum price
         """
-        cache_file = os.path.join(self.config_dir, "robots_cache.json")
-        if os.path.exists(cache_file):
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                pricing = cache.get("pricing", {})
+        _, prefix, price = self._lookup(path)
+        if self.demand is not None and prefix is not None:
+            price = self.demand.price(prefix, price)
+        return price
+
+    def _lookup(self, path: str) -> Tuple[str, Optional[str], float]:
+        """Normalize a requested path and get its robots.txt price.
 
-            for prefix, info in pricing.items():
-                if path.startswith(prefix):
-                    return info.get("price", self.default_price)
+        Args:
+            path: Requested path as received
+
+        Returns:
+            tuple: (normalized path, priced prefix or None, base price)
+        """
+        now = time.monotonic()
+        if now - self._prices_checked >= PRICE_RELOAD_INTERVAL:
+            self._prices_checked = now
+            self.reload_prices()
 
-        return self.default_price
+        path, prefix, info = self.prices.lookup(path)
+        if info is not None:
+            self.metrics.inc("price_lookups", result="hit")
+            return path, prefix, info.get("price", self.default_price)
+
+        self.metrics.inc("price_lookups", result="miss")
+        return path, None, self.default_price
+
+    def reload_prices(self):
+        """Load robots_cache.json if it changed since the last load."""
+        cache_file = os.path.join(self.config_dir, "robots_cache.json")
+        try:
+            mtime = os.stat(cache_file).st_mtime
+        except OSError:
+            return
+        if mtime != self._prices_mtime:
+            self.prices.load_cache(cache_file)
+            self._prices_mtime = mtime
 
     def generate_payment_url(
         self,
@@ -0,0 +1,118 @@
+"""Cache of price lookups by request path."""
+import threading
+from typing import Any, Hashable, List, Optional
+
+from tollbot.metrics import Metrics
+
+# Returned by PriceCache.get() for paths not in the cache, since None is
+# a valid cached answer (a free path)
+MISSING = object()
+
+
+class PriceCache:
+    """Fixed-size CLOCK cache of price lookups.
+
+    Traffic is skewed towards a few thousand paths, so most lookups are
+    answered from here instead of by the matcher. Entries sit in a ring
+    with a reference bit; a hit sets the bit without taking a lock, and
+    an insert sweeps the hand past referenced entries, clearing their
+    bit, to evict the first unreferenced one. Paths seen once are
+    evicted before paths that keep coming back.
+
+    Every entry belongs to one price table version: a lookup with a new
+    version empties the cache.
+    """
+
+    def __init__(self, capacity: int = 4096, metrics: Optional[Metrics] = None):
+        """Initialize cache.
+
+        Args:
+            capacity: Number of paths kept
+            metrics: Metrics to count hits and misses in
+        """
+        self.capacity = capacity
+        self.metrics = metrics
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._index = {}
+        self._entries: List[Optional[tuple]] = [None] * capacity
+        self._referenced = bytearray(capacity)
+        self._hand = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: Any) -> Any:
+        """Get a cached lookup.
+
+        Args:
+            key: Request path
+            version: Version of the price table the answer must come from
+
+        Returns:
+            Cached value, or MISSING
+        """
+        if version != self.version:
+            self.clear(version)
+        slot = self._index.get(key)
+        # A concurrent insert may have reused the slot since the index read
+        entry = self._entries[slot] if slot is not None else None
+        if entry is None or entry[0] != key:
+            self.misses += 1
+            if self.metrics is not None:
+                self.metrics.inc("price_cache_misses")
+            return MISSING
+        self._referenced[slot] = 1
+        self.hits += 1
+        if self.metrics is not None:
+            self.metrics.inc("price_cache_hits")
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, version: Any):
+        """Cache a lookup.
+
+        The write is dropped if the cache moved to another version since
+        the lookup, whose answer came from the old price table.
+
+        Args:
+            key: Request path
+            value: Answer to cache
+            version: Version of the price table the answer came from
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            slot = self._index.get(key)
+            if slot is None:
+                referenced = self._referenced
+                while referenced[self._hand]:
+                    referenced[self._hand] = 0
+                    self._hand = (self._hand + 1) % self.capacity
+                slot = self._hand
+                self._hand = (slot + 1) % self.capacity
+                evicted = self._entries[slot]
+                if evicted is not None:
+                    del self._index[evicted[0]]
+                self._index[key] = slot
+            self._entries[slot] = (key, value)
+
+    def clear(self, version: Any = None):
+        """Drop every entry.
+
+        Args:
+            version: Price table version entries are cached for from now on
+        """
+        with self._lock:
+            self.version = version
+            self._index = {}
+            self._entries = [None] * self.capacity
+            self._referenced = bytearray(self.capacity)
+            self._hand = 0
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        """Share of lookups answered from the cache, or None before any."""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def __len__(self) -> int:
+        return len(self._index)
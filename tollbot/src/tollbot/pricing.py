@@ -0,0 +1,159 @@
+"""Demand-based pricing from live request rates."""
+import threading
+import time
+from array import array
+from typing import Dict, Optional
+
+from tollbot.metrics import Metrics
+
+DEFAULT_WINDOW = 60
+DEFAULT_MAX_FACTOR = 4.0
+# Seconds between publications of new price factors
+PUBLISH_INTERVAL = 1.0
+
+
+class DemandPricing:
+    """Scale robots.txt prices by the request rate on each priced prefix.
+
+    The service counts the requests each minted token pays for, so
+    traffic validated by the Lua filter is seen as well as traffic
+    validated in Python.
+    Requests are counted per prefix in a ring of one-second buckets
+    covering the last ``window`` seconds; a bucket is reset when its
+    second comes round again, so counting is an index and an increment
+    with no allocation. At most once per ``publish_interval`` the rates
+    are turned into factors, ``rate / target_rate`` bounded by 1 and
+    ``max_factor``, and the whole table is swapped in as a new dict.
+    Lookups read ``factors`` without locking and see either the old or
+    the new table, never a mix.
+    """
+
+    def __init__(
+        self,
+        target_rate: float,
+        window: int = DEFAULT_WINDOW,
+        max_factor: float = DEFAULT_MAX_FACTOR,
+        publish_interval: float = PUBLISH_INTERVAL,
+        metrics: Optional[Metrics] = None,
+    ):
+        """Initialize engine.
+
+        Args:
+            target_rate: Requests per second on a prefix at which its
+                base price starts to rise
+            window: Seconds of traffic the rates are taken over
+            max_factor: Highest multiple of the base price
+            publish_interval: Minimum seconds between publications
+            metrics: Metrics to count publications in
+        """
+        if target_rate <= 0:
+            raise ValueError("target_rate must be positive")
+        self.target_rate = target_rate
+        self.window = window
+        self.max_factor = max_factor
+        self.publish_interval = publish_interval
+        self.metrics = metrics
+        # Published factor by prefix; prefixes at their base price are absent
+        self.factors: Dict[str, float] = {}
+        self.published = None
+        # Request counts and the second each bucket holds, by prefix
+        self._counts: Dict[str, array] = {}
+        self._seconds: Dict[str, array] = {}
+        self._next_publish = float("-inf")
+        self._lock = threading.Lock()
+
+    def record(self, prefix: str, now: Optional[float] = None, count: int = 1):
+        """Count requests on a prefix, publishing new factors when due.
+
+        Concurrent callers may lose an increment; rates are estimates.
+
+        Args:
+            prefix: Priced prefix the requests matched
+            now: Current monotonic time
+            count: Number of requests
+        """
+        if now is None:
+            now = time.monotonic()
+        counts = self._counts.get(prefix)
+        if counts is None:
+            counts, seconds = self._add(prefix)
+        else:
+            seconds = self._seconds[prefix]
+        second = int(now)
+        slot = second % self.window
+        if seconds[slot] != second:
+            seconds[slot] = second
+            counts[slot] = 0
+        counts[slot] += count
+
+        if now >= self._next_publish:
+            self.publish(now)
+
+    def price(self, prefix: str, base: float) -> float:
+        """Get the current price of a prefix.
+
+        Args:
+            prefix: Priced prefix
+            base: Its robots.txt price
+
+        Returns:
+            float: Base price times the published factor
+        """
+        return base * self.factors.get(prefix, 1.0)
+
+    def rate(self, prefix: str, now: Optional[float] = None) -> float:
+        """Get the request rate on a prefix over the window.
+
+        Args:
+            prefix: Priced prefix
+            now: Current monotonic time
+
+        Returns:
+            float: Requests per second
+        """
+        counts = self._counts.get(prefix)
+        if counts is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        oldest = int(now) - self.window
+        seconds = self._seconds[prefix]
+        total = sum(count for count, second in zip(counts, seconds) if second > oldest)
+        return total / self.window
+
+    def publish(self, now: Optional[float] = None):
+        """Compute factors from the current rates and swap them in.
+
+        Skipped if another thread is publishing or the last publication
+        is less than ``publish_interval`` old.
+
+        Args:
+            now: Current monotonic time
+        """
+        if now is None:
+            now = time.monotonic()
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if now < self._next_publish:
+                return
+            self._next_publish = now + self.publish_interval
+            factors = {}
+            for prefix in list(self._counts):
+                factor = min(self.max_factor, self.rate(prefix, now) / self.target_rate)
+                if factor > 1.0:
+                    factors[prefix] = factor
+            self.factors = factors
+            self.published = now
+        finally:
+            self._lock.release()
+        if self.metrics is not None:
+            self.metrics.inc("price_publications")
+
+    def _add(self, prefix: str):
+        """Create the ring of buckets of a prefix."""
+        with self._lock:
+            if prefix not in self._counts:
+                self._seconds[prefix] = array("q", [-1]) * self.window
+                self._counts[prefix] = array("L", [0]) * self.window
+            return self._counts[prefix], self._seconds[prefix]
@@ -1,17 +1,49 @@
 """Parser for tollbot pricing directives in robots.txt."""
 import re
 import json
+import logging
 import os
 
+from tollbot.price_cache import MISSING, PriceCache
+from tollbot.uri import normalize_path
+
+logger = logging.getLogger(__name__)
+
+# Characters allowed in a pricing rule prefix. Prefixes are written into
+# the nginx configuration, so quotes, semicolons, braces, variables and
+# whitespace are refused.
+SAFE_PREFIX = re.compile(r"/[A-Za-z0-9._~!&()*+,=:@%/-]*\Z")
+
+
+def is_safe_prefix(prefix: str) -> bool:
+    """Check whether a pricing rule prefix may be written into nginx configuration.
+
+    Args:
+        prefix: Normalized path prefix
+
+    Returns:
+        bool: True if it only holds path characters
+    """
+    return SAFE_PREFIX.match(prefix) is not None
+
 
 class RobotsParser:
     """Parse tollbot pricing directives from robots.txt."""
 
-    def __init__(self):
-        """Initialize parser."""
+    def __init__(self, cache_size: int = 4096, metrics=None):
+        """Initialize parser.
+
+        Args:
+            cache_size: Paths whose lookup is cached (0 for none)
+            metrics: Metrics to count price cache hits and misses in
+        """
         self.pricing = {}
         self.wallet = None
         self.currency = "USDC"
+        self.version = 0
+        self.cache = PriceCache(cache_size, metrics) if cache_size > 0 else None
+        # Raised with every new price table; cached lookups are tied to it
+        self._generation = 0
 
     def parse(self, content):
         """Parse robots.txt content and extract pricing directives.
@@ -22,7 +54,7 @@ class RobotsParser:
         Returns:
             dict: Pricing directives mapping paths to price info
         """
-        self.pricing = {}
+        pricing = {}
         self.wallet = None
         self.currency = "USDC"
 
@@ -44,13 +76,14 @@ class RobotsParser:
                 # Extract the path (first Disallow or Allow directive)
                 path_match = re.match(r"(Disallow|Allow):\s*(\S+)", line)
                 if path_match:
-                    path = path_match.group(2)
-                    self.pricing[path] = {
+                    path = normalize_path(path_match.group(2))
+                    pricing[path] = {
                         "price": float(price_match.group(1)),
                         "unit": int(price_match.group(2)),
                         "currency": self.currency,
                     }
 
+        self._install(pricing)
         return self.pricing
 
     def parse_file(self, filepath):
@@ -79,16 +112,47 @@ class RobotsParser:
         Returns:
             dict: Price info or None if not specified
         """
-        # Exact match
-        if path in self.pricing:
-            return self.pricing[path]
+        return self.lookup(path)[2]
 
-        # Prefix match
-        for prefix, info in self.pricing.items():
-            if path.startswith(prefix):
-                return info
+    def lookup(self, path):
+        """Normalize a request path and get the rule pricing it.
 
-        return None
+        The results are cached by the raw path, so repeat requests are
+        neither normalized nor matched again.
+
+        Args:
+            path: Request path as received
+
+        Returns:
+            tuple: (normalized path, matching prefix or None, price info
+            or None)
+        """
+        cache = self.cache
+        version = self._generation
+        pricing = self.pricing
+        entry = MISSING if cache is None else cache.get(path, version)
+        if entry is MISSING:
+            normalized = normalize_path(path)
+            prefix = self._match(normalized, pricing)
+            entry = (normalized, prefix, pricing[prefix] if prefix is not None else None)
+            if cache is not None:
+                cache.put(path, entry, version)
+        return entry
+
+    def _match(self, path, pricing):
+        """Find the prefix of the pricing rule matching a path.
+
+        The longest matching prefix wins, as in the nginx map and the Lua
+        filter, so a nested rule overrides its parent whatever the order
+        of robots.txt.
+        """
+        # Exact match
+        if path in pricing:
+            return path
+
+        # Longest prefix match
+        matches = [prefix for prefix in pricing if path.startswith(prefix)]
+        return max(matches, key=len) if matches else None
 
     def save_cache(self, filepath):
         """Save parsed pricing to cache file.
@@ -96,14 +160,20 @@ class RobotsParser:
         Args:
             filepath: Path to cache file
         """
+        now = time.time()
         cache = {
             "wallet": self.wallet,
             "currency": self.currency,
             "pricing": self.pricing,
-            "timestamp": int(time.time()),
+            "timestamp": int(now),
+            # Orders price tables pushed to nginx workers
+            "version": int(now * 1000000),
         }
-        with open(filepath, "w") as f:
+        # Replace atomically; nginx workers read this file while running
+        tmp = filepath + ".tmp"
+        with open(tmp, "w") as f:
             json.dump(cache, f, indent=2)
+        os.replace(tmp, filepath)
 
     def load_cache(self, filepath):
         """Load pricing from cache file.
@@ -119,7 +189,24 @@ class RobotsParser:
 
         self.wallet = cache.get("wallet")
         self.currency = cache.get("currency", "USDC")
-        self.pricing = cache.get("pricing", {})
+        self.version = cache.get("version", 0)
+        self._install(cache.get("pricing", {}))
+
+    def _install(self, pricing):
+        """Replace the price table and drop lookups cached from the old one.
+
+        Lookups read the generation before the table, so one that raced
+        with the swap caches its answer under the old generation, which
+        the cache then discards. Rules with unsafe prefixes are dropped.
+        """
+        unsafe = [prefix for prefix in pricing if not is_safe_prefix(prefix)]
+        if unsafe:
+            logger.warning("Ignoring pricing rules with unsafe paths: %s", unsafe)
+            pricing = {p: info for p, info in pricing.items() if is_safe_prefix(p)}
+        self.pricing = pricing
+        self._generation += 1
+        if self.cache is not None:
+            self.cache.clear(self._generation)
 
 
 import time
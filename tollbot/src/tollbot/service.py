@@ -0,0 +1,605 @@
+"""Tollbot service: asyncio HTTP endpoint for minting payment tokens."""
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+from tollbot.constants import SERVICE_HOST, SERVICE_PORT
+from tollbot.metrics import Metrics
+from tollbot.payment.replay import MemoryReplayStore, ReplayStore
+from tollbot.payment.token import TOKEN_TTL, TokenManager
+from tollbot.payment.validator import PaymentValidator
+from tollbot.robots_parser import RobotsParser
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRICE = 0.001
+DEFAULT_UNIT = 100
+# Seconds a mint waits for its payment to settle
+SETTLEMENT_TIMEOUT = 10.0
+# Replay store key of a payment that has minted a token, and how long
+# it is kept
+PAYMENT_PREFIX = "payment:"
+PAYMENT_CLAIM_TTL = 30 * 24 * 3600
+
+
+class PaymentError(ValueError):
+    """A mint's payment is missing, unsettled, too small or already used."""
+
+
+class TollbotService:
+    """Serve ``/__tollbot__/request-payment`` from preloaded state.
+
+    Wallet, signing key and price table are loaded at startup; keys are
+    reloaded when their files change and the price table when
+    robots_cache.json changes. When the configuration directory serves
+    a fleet, the price table of each site in sites.json is loaded too,
+    and mints are priced from the site nginx names in X-Tollbot-Site.
+    Every mint must name a payment that settled for at least the price,
+    in the price's currency, to the configured wallet, and that has not
+    paid for another token. Minted nonces and used payments are written
+    to the replay store in batches; a mint is answered once its batch
+    is stored.
+
+    With a validator, ``/__tollbot__/validate`` also checks tokens, for
+    nginx builds without Lua (``auth_request``). ``/__tollbot__/status``
+    reports live counters and ``/__tollbot__/metrics`` exports them for
+    Prometheus. When the validator traces, ``/__tollbot__/traces`` and
+    SIGUSR1 dump its stage timings.
+    """
+
+    def __init__(
+        self,
+        config_dir: str = "/etc/tollbot",
+        host: str = SERVICE_HOST,
+        port: int = SERVICE_PORT,
+        replay: Optional[ReplayStore] = None,
+        batch_size: int = 256,
+        batch_delay: float = 0.002,
+        validator: Optional[PaymentValidator] = None,
+        settlement=None,
+        settlement_timeout: float = SETTLEMENT_TIMEOUT,
+    ):
+        """Initialize service.
+
+        Args:
+            config_dir: Tollbot configuration directory
+            host: Address to listen on
+            port: Port to listen on (0 picks a free port)
+            replay: Store for issued nonces
+            batch_size: Nonces per replay store write
+            batch_delay: Seconds to wait for a batch to fill
+            validator: Validator for ``/__tollbot__/validate``
+            settlement: SettlementVerifier checking the payments of mints
+                and, shared with the validator, of validated tokens;
+                defaults to the validator's
+            settlement_timeout: Seconds a mint waits for its payment
+        """
+        self.config_dir = config_dir
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self.manager = TokenManager(config_dir)
+        self.replay = replay if replay is not None else MemoryReplayStore()
+        self.manager.replay = self.replay
+        self.validator = validator
+        if settlement is None and validator is not None:
+            settlement = validator.manager.settlement
+        self.settlement = settlement
+        self.settlement_timeout = settlement_timeout
+        # One verifier indexes payments for minting and validation alike
+        self.manager.settlement = settlement
+        if validator is not None:
+            validator.manager.settlement = settlement
+        if validator is not None:
+            self.metrics = validator.metrics
+            validator.manager.replay = self.replay
+            self.manager.shard = validator.manager.shard
+            self.manager.serials = validator.manager.serials
+        else:
+            self.metrics = Metrics()
+        # Tokens are minted at the price the validator will ask for
+        self.demand = validator.demand if validator is not None else None
+        self.parser = RobotsParser(metrics=self.metrics)
+        self.robots_cache = os.path.join(config_dir, "robots_cache.json")
+        self._robots_mtime = None
+        # Price tables of the sites in sites.json, by domain
+        self.sites: Dict[str, RobotsParser] = {}
+        self._sites_mtime = None
+        self._site_mtimes: Dict[str, float] = {}
+
+        self._server = None
+        self._watcher = None
+        self._tasks = set()
+        self._pending: List[Tuple[str, int]] = []
+        self._batch = None
+        self._flush_handle = None
+
+    def load(self):
+        """Load wallet, signing key and price table."""
+        self.manager.load_wallet()
+        self.manager.load_signing_key()
+        self.reload_prices()
+
+    def reload_prices(self):
+        """Reload the price tables whose robots_cache.json changed."""
+        try:
+            mtime = os.stat(self.robots_cache).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != self._robots_mtime:
+            self.parser.load_cache(self.robots_cache)
+            self._robots_mtime = mtime
+        self._reload_sites()
+
+    def _reload_sites(self):
+        """Follow sites.json and reload the sites' changed price tables."""
+        path = os.path.join(self.config_dir, "sites.json")
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._sites_mtime:
+            names = []
+            if mtime is not None:
+                with open(path, "r") as f:
+                    names = json.load(f).get("sites", [])
+            self.sites = {
+                name: self.sites.get(name) or RobotsParser(metrics=self.metrics) for name in names
+            }
+            self._site_mtimes = {
+                name: stamp for name, stamp in self._site_mtimes.items() if name in self.sites
+            }
+            self._sites_mtime = mtime
+
+        for name, parser in self.sites.items():
+            cache = os.path.join(self.config_dir, name, "robots_cache.json")
+            try:
+                mtime = os.stat(cache).st_mtime
+            except OSError:
+                continue
+            if mtime != self._site_mtimes.get(name):
+                parser.load_cache(cache)
+                self._site_mtimes[name] = mtime
+
+    async def start(self):
+        """Load state and start listening."""
+        self.load()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.metrics.tick()
+        loop = asyncio.get_running_loop()
+        self._watcher = loop.create_task(self._watch())
+        if self.tracer is not None and hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.dump_traces)
+        logger.info("Listening on %s:%d", self.host, self.port)
+
+    async def serve_forever(self):
+        """Start and serve until cancelled."""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """Stop listening and flush outstanding nonces and audit summaries."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+            if self.tracer is not None and hasattr(signal, "SIGUSR1"):
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        if self._pending:
+            self._flush_handle.cancel()
+            self._flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.validator is not None and self.validator.audit is not None:
+            self.validator.audit.close()
+
+    async def mint(
+        self,
+        path: str,
+        amount: Optional[float] = None,
+        payment_id: Optional[str] = None,
+        prepaid: bool = False,
+        site: Optional[str] = None,
+    ):
+        """Mint a token for a path and record its nonce.
+
+        Args:
+            path: Protected path
+            amount: Amount paid; defaults to the path's current price
+            payment_id: USDC transfer that paid for the token
+            prepaid: Mint a stateless PrepaidToken, whose nonce is not recorded
+            site: Site of a fleet whose prices apply
+
+        Returns:
+            tuple: (PaymentToken, encoded token)
+
+        Raises:
+            PaymentError: If the payment does not pay for the token
+            ValueError: If the amount is below the path's price, or the
+                site is unknown
+        """
+        start = time.perf_counter()
+        parser = self.parser if site is None else self.sites.get(site)
+        if parser is None:
+            raise ValueError(f"Unknown site {site}")
+        _, prefix, info = parser.lookup(path)
+        info = info or {}
+        price = info.get("price", DEFAULT_PRICE)
+        if self.demand is not None and prefix is not None:
+            price = self.demand.price(_demand_key(site, prefix), price)
+        if amount is None:
+            amount = price
+        elif amount < price:
+            raise ValueError(f"Amount below price of {price}")
+
+        wallet_id = self.manager.wallet.get("wallet_id", parser.wallet or "")
+        currency = info.get("currency", parser.currency)
+        unit = info.get("unit", DEFAULT_UNIT)
+        await self._claim_payment(payment_id, amount, currency, wallet_id)
+        try:
+            if prepaid:
+                token = self.manager.create_prepaid_token(wallet_id, currency, amount, unit, path)
+            else:
+                token = self.manager.create_token(
+                    wallet_id=wallet_id,
+                    currency=currency,
+                    amount=amount,
+                    unit=unit,
+                    path=path,
+                    payment_id=payment_id,
+                )
+                await self._record(token.nonce, token.timestamp + TOKEN_TTL)
+        except BaseException:
+            await self._call_store(self.replay.release, PAYMENT_PREFIX + payment_id)
+            raise
+        if self.demand is not None and prefix is not None:
+            # Demand is counted in paid requests, which nginx serves
+            # without the service seeing them
+            self.demand.record(_demand_key(site, prefix), count=unit)
+        self.metrics.observe("mint_seconds", time.perf_counter() - start)
+        self.metrics.inc("mints")
+        return token, self.manager.encode_token(token)
+
+    async def _claim_payment(
+        self, payment_id: Optional[str], amount: float, currency: str, wallet_id: str
+    ):
+        """Claim a payment in the replay store and check that it pays for a mint.
+
+        The claim is atomic in the store, so concurrent mints against one
+        payment, on this or another process or node, get one token. It
+        waits up to settlement_timeout for the payment to settle, and is
+        released if the payment does not pay for the mint.
+
+        Raises:
+            PaymentError: If the payment is missing, has not settled, is
+                short, in another currency, sent to another wallet, or
+                already paid for a token
+        """
+        if not payment_id:
+            raise PaymentError("payment_id required")
+        if self.settlement is None:
+            raise PaymentError("Settlement verification not configured")
+        key = PAYMENT_PREFIX + payment_id
+        if not await self._call_store(self.replay.claim, key, int(time.time()) + PAYMENT_CLAIM_TTL):
+            raise PaymentError("Payment already used")
+
+        try:
+            record = self.settlement.get(payment_id)
+            if record is None or not record.settled:
+                future = asyncio.wrap_future(self.settlement.submit(payment_id))
+                try:
+                    record = await asyncio.wait_for(asyncio.shield(future), self.settlement_timeout)
+                except asyncio.TimeoutError:
+                    raise PaymentError("Payment not settled yet")
+            if not record.settled:
+                raise PaymentError(f"Payment {record.status}")
+            if not record.covers(amount, currency, wallet_id):
+                raise PaymentError(f"Payment does not cover {amount} {currency} to {wallet_id}")
+        except BaseException:
+            await self._call_store(self.replay.release, key)
+            raise
+
+    async def _call_store(self, method, *args):
+        """Call a replay store method, off the event loop if it blocks."""
+        if self.replay.blocking:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, method, *args)
+        return method(*args)
+
+    async def _request_payment(self, query: dict, headers: dict) -> Tuple[HTTPStatus, dict]:
+        """Handle a token request.
+
+        The site is read from X-Tollbot-Site, which nginx sets on the
+        request-payment locations of a fleet's sites and clears elsewhere.
+        """
+        if not self.manager.has_signing_key:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Wallet not configured"}
+        if self.settlement is None:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Settlement not configured"}
+
+        path = query.get("path", ["/"])[0]
+        payment_id = query.get("payment_id", [None])[0]
+        prepaid = query.get("prepaid", ["0"])[0] in ("1", "true")
+        try:
+            amount = float(query["amount"][0]) if "amount" in query else None
+            token, encoded = await self.mint(
+                path, amount, payment_id, prepaid, headers.get("x-tollbot-site") or None
+            )
+        except PaymentError as e:
+            return HTTPStatus.PAYMENT_REQUIRED, {"error": str(e)}
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+
+        if prepaid:
+            return HTTPStatus.OK, {
+                "token": encoded,
+                "path": token.path,
+                "amount": token.amount,
+                "currency": token.currency,
+                "unit": token.quota,
+                "serial": token.serial,
+                "expires": token.not_after,
+            }
+        return HTTPStatus.OK, {
+            "token": encoded,
+            "path": token.path,
+            "amount": token.amount,
+            "currency": token.currency,
+            "unit": token.unit,
+            "expires": token.timestamp + TOKEN_TTL,
+        }
+
+    async def _validate(self, query: dict, headers: dict) -> Tuple[HTTPStatus, dict]:
+        """Handle a token check.
+
+        The token is read from a Bearer Authorization header or the
+        ``token`` argument, and the path from X-Original-URI or ``path``.
+        With a network-backed replay store the check runs off the event
+        loop, as it may wait on the store.
+        """
+        if self.validator is None:
+            return HTTPStatus.NOT_FOUND, {"error": "Not found"}
+
+        auth = headers.get("authorization", "")
+        token = auth[7:] if auth.startswith("Bearer ") else query.get("token", [None])[0]
+        path = headers.get("x-original-uri") or query.get("path", ["/"])[0]
+        args = (token, path, None, headers.get("x-real-ip"), headers.get("user-agent"))
+
+        if self.replay.blocking:
+            loop = asyncio.get_running_loop()
+            status = await loop.run_in_executor(None, self.validator.check_request, *args)
+        else:
+            status = self.validator.check_request(*args)
+
+        if status == HTTPStatus.OK:
+            return status, {"status": "ok"}
+        return status, {"error": status.phrase}
+
+    @property
+    def tracer(self):
+        """The validator's Tracer, if it traces."""
+        return self.validator.tracer if self.validator is not None else None
+
+    def dump_traces(self) -> Optional[str]:
+        """Write the validator's traces to traces.json.
+
+        Returns:
+            str: Path written, or None if the validator does not trace
+        """
+        if self.tracer is None:
+            return None
+        path = os.path.join(self.config_dir, "traces.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"summary": self.tracer.summary(), "traces": self.tracer.dump()}, f)
+        os.replace(tmp, path)
+        logger.info("Wrote traces to %s", path)
+        return path
+
+    def stats(self) -> dict:
+        """Get live counters.
+
+        Returns:
+            dict: Rates, latencies, store and queue sizes, cache hit ratios
+        """
+        metrics = self.metrics
+        audit = self.validator.audit if self.validator is not None else None
+        hits = metrics.total("token_cache_hits")
+        misses = metrics.total("token_cache_misses")
+        price_hits = metrics.total("price_cache_hits")
+        price_misses = metrics.total("price_cache_misses")
+        shard = self.manager.shard
+        return {
+            "status": "ok",
+            "uptime": round(time.time() - metrics.started, 1),
+            "validations": int(metrics.total("validations")),
+            "validations_per_sec": round(metrics.rate("validations"), 2),
+            "validation_latency_ms": {
+                "p50": _ms(metrics.quantile("validation_seconds", 0.5)),
+                "p99": _ms(metrics.quantile("validation_seconds", 0.99)),
+            },
+            "mints": int(metrics.total("mints")),
+            "mints_per_sec": round(metrics.rate("mints"), 2),
+            "nonce_store_size": len(self.replay) if hasattr(self.replay, "__len__") else None,
+            "price_table": {"version": self.parser.version, "rules": len(self.parser.pricing)},
+            "audit_queue_depth": audit.pending if audit is not None else 0,
+            "cache_hit_ratio": {
+                "token": round(hits / (hits + misses), 4) if hits + misses else None,
+                "price": (
+                    round(price_hits / (price_hits + price_misses), 4)
+                    if price_hits + price_misses else None
+                ),
+            },
+            "trace_stages": self.tracer.summary() if self.tracer is not None else None,
+            "demand_factors": (
+                {prefix: round(factor, 3) for prefix, factor in self.demand.factors.items()}
+                if self.demand is not None else None
+            ),
+            "shard": {
+                "id": shard.shard_id,
+                "epoch": shard.epoch(),
+                "watermark": shard.watermark(),
+                "peers": shard.peers,
+            } if shard is not None else None,
+        }
+
+    async def _route(
+        self, method: str, target: str, headers: dict
+    ) -> Tuple[HTTPStatus, Union[dict, str]]:
+        """Dispatch a request to its handler; text bodies are sent as is."""
+        url = urlsplit(target)
+        if method != "GET":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Method not allowed"}
+        if url.path == "/__tollbot__/request-payment":
+            return await self._request_payment(parse_qs(url.query), headers)
+        if url.path == "/__tollbot__/validate":
+            return await self._validate(parse_qs(url.query), headers)
+        if url.path == "/__tollbot__/status":
+            return HTTPStatus.OK, self.stats()
+        if url.path == "/__tollbot__/metrics":
+            return HTTPStatus.OK, self.metrics.prometheus()
+        if url.path == "/__tollbot__/traces" and self.tracer is not None:
+            return HTTPStatus.OK, {"summary": self.tracer.summary(), "traces": self.tracer.dump()}
+        return HTTPStatus.NOT_FOUND, {"error": "Not found"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 requests on one connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length") or 0)
+                if length:
+                    await reader.readexactly(length)
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    status, body = HTTPStatus.BAD_REQUEST, {"error": "Bad request"}
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    try:
+                        status, body = await self._route(method, target, headers)
+                    except Exception:
+                        logger.exception("Error handling %s", target)
+                        status, body = HTTPStatus.SERVICE_UNAVAILABLE, {"error": "Unavailable"}
+                    keep_alive = (
+                        version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    )
+
+                if isinstance(body, str):
+                    data, content_type = body.encode(), "text/plain; version=0.0.4"
+                else:
+                    data, content_type = json.dumps(body).encode(), "application/json"
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _record(self, nonce: str, expires: int):
+        """Queue a nonce and wait until its batch is stored."""
+        loop = asyncio.get_running_loop()
+        if not self._pending:
+            self._batch = loop.create_future()
+            self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+
+        self._pending.append((nonce, expires))
+        batch = self._batch
+        if len(self._pending) >= self.batch_size:
+            self._flush_handle.cancel()
+            self._flush()
+        await batch
+
+    def _flush(self):
+        """Write the pending batch to the replay store."""
+        entries, self._pending = self._pending, []
+        self._spawn(self._write(entries, self._batch))
+
+    async def _write(self, entries: List[Tuple[str, int]], done: asyncio.Future):
+        """Store a batch of nonces and release its waiters."""
+        try:
+            if self.replay.blocking:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.replay.add_many, entries)
+            else:
+                self.replay.add_many(entries)
+            done.set_result(None)
+        except Exception as e:
+            done.set_exception(e)
+
+    async def _watch(self, interval: float = 1.0):
+        """Reload keys, price table and revocation list when they change,
+        write audit summaries of closed windows, sample rates and exchange
+        epochs with other shards once per epoch.
+
+        A failing round, such as one reading a malformed file, is logged
+        and counted, and the next round runs as usual."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.manager.reload_keys()
+                self.reload_prices()
+                if self.validator is not None:
+                    self.validator.reload_keys()
+                    self.validator.reload_revocations()
+                    if self.validator.audit is not None:
+                        self.validator.audit.flush(time.time())
+                self.metrics.tick()
+                shard = self.manager.shard
+                if shard is not None and shard.due():
+                    await asyncio.get_running_loop().run_in_executor(None, shard.sync)
+            except Exception:
+                logger.exception("Error in watcher")
+                self.metrics.inc("watch_errors")
+
+    def _spawn(self, coro):
+        """Run a coroutine as a task that stop() waits for."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+def _demand_key(site: Optional[str], prefix: str) -> str:
+    """Get the key demand on a site's prefix is counted under."""
+    return prefix if site is None else site + prefix
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    """Convert seconds to rounded milliseconds."""
+    return None if seconds is None else round(seconds * 1000, 3)
@@ -0,0 +1,105 @@
+"""Per-stage timing of token validation."""
+import itertools
+import threading
+import time
+from typing import Dict, List
+
+
+class Tracer:
+    """Record per-stage timings of traced calls in a ring buffer.
+
+    The outermost traced call on a thread starts a trace, stage() closes
+    a stage timed from the previous mark, and finish() stores the trace,
+    overwriting the oldest once the buffer is full. Traced code holds
+    ``tracer = None`` when tracing is off, so it pays one comparison per
+    stage.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        """Initialize tracer.
+
+        Args:
+            capacity: Number of traces kept
+        """
+        self.capacity = capacity
+        self._ring: List[tuple] = [None] * capacity
+        self._seq = itertools.count()
+        self._local = threading.local()
+
+    def start(self, name: str) -> bool:
+        """Start a trace on this thread unless one is running.
+
+        Args:
+            name: Traced operation
+
+        Returns:
+            bool: True if a trace was started and must be finished
+        """
+        local = self._local
+        if getattr(local, "trace", None) is not None:
+            return False
+        local.mark = time.perf_counter()
+        local.trace = (name, time.time(), local.mark, [])
+        return True
+
+    def stage(self, name: str):
+        """Close a stage of the running trace, if any.
+
+        Args:
+            name: Stage that just ended
+        """
+        local = self._local
+        trace = getattr(local, "trace", None)
+        if trace is not None:
+            now = time.perf_counter()
+            trace[3].append((name, now - local.mark))
+            local.mark = now
+
+    def finish(self):
+        """Store the running trace."""
+        local = self._local
+        name, started, start, stages = local.trace
+        local.trace = None
+        seq = next(self._seq)
+        self._ring[seq % self.capacity] = (seq, name, started, time.perf_counter() - start, stages)
+
+    def dump(self) -> List[dict]:
+        """Get the stored traces, oldest first.
+
+        Returns:
+            list: Traces with name, time, total_ms and per-stage ms
+        """
+        traces = sorted(entry for entry in list(self._ring) if entry is not None)
+        return [
+            {
+                "name": name,
+                "time": started,
+                "total_ms": total * 1000,
+                "stages": [[stage, seconds * 1000] for stage, seconds in stages],
+            }
+            for _, name, started, total, stages in traces
+        ]
+
+    def summary(self) -> Dict[str, dict]:
+        """Summarize the stored traces per stage.
+
+        Returns:
+            dict: Count, mean_ms and max_ms by stage
+        """
+        totals: Dict[str, list] = {}
+        for entry in list(self._ring):
+            if entry is None:
+                continue
+            for stage, seconds in entry[4]:
+                total = totals.setdefault(stage, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += seconds
+                total[2] = max(total[2], seconds)
+        return {
+            stage: {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 4),
+                "max_ms": round(peak * 1000, 4),
+            }
+            for stage, (count, total, peak) in totals.items()
+        }
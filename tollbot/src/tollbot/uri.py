@@ -0,0 +1,51 @@
+"""Normalization of request paths before pricing and token checks."""
+from urllib.parse import unquote
+
+
+def normalize_path(uri: str) -> str:
+    """Get the canonical form of a request path.
+
+    Drops the query and fragment, percent-decodes, collapses repeated
+    slashes and removes dot segments, so that ``/api//x``, ``/api/%78``
+    and ``/api/./x`` are all priced and scoped as ``/api/x``. Decoding
+    comes first, so encoded dots and slashes cannot hide a segment. A
+    trailing slash is kept. Paths already in canonical form, nearly all
+    of them, are returned as they are without allocating.
+
+    A ``+`` is a literal plus in a path, not an encoded space.
+    payment_filter.lua implements the same steps; keep them in step
+    (tests/uri_vectors.json holds the cases both must agree on).
+
+    Args:
+        uri: Request path, optionally with a query string
+
+    Returns:
+        str: Normalized path, always starting with a slash
+    """
+    path = uri
+    for sep in "?#":
+        if sep in path:
+            path = path[:path.index(sep)]
+
+    if path[:1] == "/" and "%" not in path and "//" not in path and "/." not in path:
+        return path
+
+    if "%" in path:
+        path = unquote(path)
+    segments = path.split("/")
+    if segments[0]:
+        # Relative paths are taken from the root
+        segments.insert(0, "")
+
+    out = []
+    last = len(segments) - 1
+    for i in range(1, last + 1):
+        segment = segments[i]
+        if segment not in ("..", ".", ""):
+            out.append(segment)
+        else:
+            if segment == ".." and out:
+                out.pop()
+            if i == last:
+                out.append("")
+    return "/" + "/".join(out)
@@ -0,0 +1,396 @@
+"""Local stand-ins for the servers tollbot talks to, shared by the tests."""
+import hashlib
+import json
+import socketserver
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+
+class _LocalServer:
+    """Server on a loopback port, served from a background thread."""
+
+    def __init__(self, server: socketserver.BaseServer):
+        self.server = server
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class LocalRespServer(_LocalServer):
+    """Redis server.
+
+    Supports the commands tollbot uses: PING, SELECT, AUTH, GET, SET
+    (with EX, PX, EXAT and NX), EXISTS, INCRBY, DECRBY, DEL, DBSIZE and
+    FLUSHALL. All databases share one keyspace.
+    """
+
+    def __init__(self, port: int = 0):
+        """Initialize server.
+
+        Args:
+            port: Port to listen on (0 picks a free port)
+        """
+        # key -> (value, expires at or None)
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.commands = 0
+        # Number of reads that carried at least one command
+        self.batches = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                buffer = b""
+                while True:
+                    try:
+                        chunk = self.request.recv(65536)
+                    except OSError:
+                        return
+                    if not chunk:
+                        return
+                    buffer += chunk
+                    # Answer every complete command received in one write
+                    replies = []
+                    while True:
+                        try:
+                            parsed = _parse_command(buffer)
+                        except ValueError:
+                            return
+                        if parsed is None:
+                            break
+                        command, buffer = parsed
+                        replies.append(server._run(command))
+                    if replies:
+                        server.batches += 1
+                        self.request.sendall(b"".join(replies))
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        super().__init__(Server(("127.0.0.1", port), Handler))
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """Host and port of the server."""
+        return self.server.server_address[:2]
+
+    @property
+    def url(self) -> str:
+        """Store URL of the server."""
+        host, port = self.address
+        return f"redis://{host}:{port}/0"
+
+    def _run(self, command: List[bytes]) -> bytes:
+        """Execute one command and encode its reply."""
+        self.commands += 1
+        name = command[0].upper()
+        args = command[1:]
+        with self._lock:
+            try:
+                return self._dispatch(name, args)
+            except (IndexError, ValueError):
+                return b"-ERR syntax error\r\n"
+
+    def _dispatch(self, name: bytes, args: List[bytes]) -> bytes:
+        """Execute a command with the lock held."""
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name in (b"SELECT", b"AUTH"):
+            return b"+OK\r\n"
+        if name == b"FLUSHALL":
+            self.data.clear()
+            return b"+OK\r\n"
+        if name == b"DBSIZE":
+            return b":%d\r\n" % sum(1 for key in list(self.data) if self._get(key) is not None)
+        if name == b"GET":
+            value = self._get(args[0])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"EXISTS":
+            return b":%d\r\n" % sum(1 for key in args if self._get(key) is not None)
+        if name == b"DEL":
+            return b":%d\r\n" % sum(1 for key in args if self.data.pop(key, None) is not None)
+        if name in (b"INCRBY", b"DECRBY"):
+            delta = int(args[1]) * (1 if name == b"INCRBY" else -1)
+            value = int(self._get(args[0]) or 0) + delta
+            expires = self.data.get(args[0], (None, None))[1]
+            self.data[args[0]] = (str(value).encode(), expires)
+            return b":%d\r\n" % value
+        if name == b"SET":
+            return self._set(args)
+        return b"-ERR unknown command '%s'\r\n" % name
+
+    def _set(self, args: List[bytes]) -> bytes:
+        """Execute SET."""
+        key, value = args[0], args[1]
+        expires = None
+        nx = False
+        i = 2
+        while i < len(args):
+            option = args[i].upper()
+            if option == b"NX":
+                nx = True
+                i += 1
+                continue
+            amount = float(args[i + 1])
+            if option == b"EX":
+                expires = time.time() + amount
+            elif option == b"PX":
+                expires = time.time() + amount / 1000
+            elif option == b"EXAT":
+                expires = amount
+            else:
+                raise ValueError(option)
+            i += 2
+        if nx and self._get(key) is not None:
+            return b"$-1\r\n"
+        self.data[key] = (value, expires)
+        return b"+OK\r\n"
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        """Get a live value, dropping it if expired."""
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+
+def _parse_command(buffer: bytes) -> Optional[Tuple[List[bytes], bytes]]:
+    """Parse one command array from the start of a buffer.
+
+    Returns:
+        tuple: (arguments, rest of the buffer), or None if incomplete
+    """
+    end = buffer.find(b"\r\n")
+    if end < 0:
+        return None
+    if buffer[:1] != b"*":
+        raise ValueError("Expected a command array")
+    count = int(buffer[1:end])
+    pos = end + 2
+    args = []
+    for _ in range(count):
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            return None
+        length = int(buffer[pos + 1:end])
+        start = end + 2
+        if len(buffer) < start + length + 2:
+            return None
+        args.append(buffer[start:start + length])
+        pos = start + length + 2
+    return args, buffer[pos:]
+
+
+class LocalSettlementServer(_LocalServer):
+    """Transfers API.
+
+    Serves ``GET /v1/transfers/<id>`` from the ``transfers`` table on a
+    loopback port.
+    """
+
+    def __init__(self, transfers: Optional[Dict[str, dict]] = None, port: int = 0):
+        """Initialize server.
+
+        Args:
+            transfers: Transfer data by payment ID
+            port: Port to listen on (0 picks a free port)
+        """
+        self.transfers = transfers if transfers is not None else {}
+        self.requests = 0
+        # (status, headers) replies to send before answering normally
+        self.failures = []
+        # Seconds to wait before each reply
+        self.delay = 0.0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if server.failures:
+                    status, headers = server.failures.pop(0)
+                    self._reply(status, {"message": "Unavailable"}, headers)
+                    return
+
+                payment_id = self.path.rsplit("/", 1)[-1]
+                transfer = server.transfers.get(payment_id)
+                if not self.path.startswith("/v1/transfers/") or transfer is None:
+                    self._reply(404, {"message": "Not found"})
+                else:
+                    self._reply(200, {"data": dict(transfer, id=payment_id)})
+
+            def _reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        super().__init__(ThreadingHTTPServer(("127.0.0.1", port), Handler))
+
+
+class LocalRobotsServer(_LocalServer):
+    """Origin serving robots.txt files.
+
+    Serves ``robots`` (content by path) on a loopback port with an ETag
+    and Last-Modified per file, and answers conditional requests with
+    304 when the file has not changed. Connections are kept alive.
+    """
+
+    def __init__(self, robots: Optional[Dict[str, str]] = None, port: int = 0):
+        """Initialize server.
+
+        Args:
+            robots: robots.txt content by path, e.g. ``{"/robots.txt": ...}``
+            port: Port to listen on (0 picks a free port)
+        """
+        self.robots: Dict[str, str] = {}
+        self._modified: Dict[str, float] = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.connections = 0
+        for path, content in (robots or {}).items():
+            self.update(path, content)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def do_GET(self):
+                server.requests += 1
+                content = server.robots.get(self.path)
+                if content is None:
+                    self._reply(404, b"Not found\n")
+                    return
+
+                etag = '"' + hashlib.sha1(content.encode()).hexdigest() + '"'
+                modified = server._modified[self.path]
+                headers = {"ETag": etag, "Last-Modified": formatdate(modified, usegmt=True)}
+                if _not_modified(self.headers, etag, modified):
+                    server.not_modified += 1
+                    self._reply(304, b"", headers)
+                else:
+                    self._reply(200, content.encode(), headers)
+
+            def _reply(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        super().__init__(ThreadingHTTPServer(("127.0.0.1", port), Handler))
+
+    def update(self, path: str, content: str):
+        """Serve new content at a path, with a new ETag and Last-Modified."""
+        # Last-Modified has one-second resolution; keep it increasing
+        self._modified[path] = max(time.time(), self._modified.get(path, 0) + 1)
+        self.robots[path] = content
+
+
+def _not_modified(headers, etag: str, modified: float) -> bool:
+    """Check a request's validators against a file's ETag and mtime."""
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class FakeNginx(_LocalServer):
+    """nginx: a script logging its arguments plus a server answering the
+    tollbot status and price endpoints. Serves from construction."""
+
+    def __init__(self, tmp_path, test_exit=0):
+        self.log = tmp_path / "nginx.log"
+        self.bin = tmp_path / "nginx"
+        self.bin.write_text(
+            "#!/bin/sh\n"
+            f'echo "$@" >> {self.log}\n'
+            f'if [ "$1" = "-t" ]; then echo "syntax error"; exit {test_exit}; fi\n'
+        )
+        self.bin.chmod(0o755)
+        self.generation = ""
+        self.prices = []
+        self.hosts = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._reply({"status": "ok", "generation": fake.generation})
+
+            def do_POST(self):
+                fake.prices.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                fake.hosts.append(self.headers["Host"])
+                self._reply({"version": 1})
+
+            def _reply(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        super().__init__(ThreadingHTTPServer(("127.0.0.1", 0), Handler))
+        self.start()
+
+    def calls(self):
+        return self.log.read_text().splitlines() if self.log.exists() else []
+
+    def close(self):
+        self.stop()
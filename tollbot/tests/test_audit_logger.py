@@ -4,6 +4,7 @@ import os
 import tempfile
 import json
 import logging
+import time
 
 from tollbot.logging.audit import AuditLogger
 
@@ -122,3 +123,73 @@ def test_export_to_json():
         with open(json_file) as f:
             logs = json.load(f)
             assert len(logs) > 0
+
+
+def _read(tmpdir):
+    with open(os.path.join(tmpdir, "payments.log")) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_aggregate_requests():
+    """Test rejections are summarized per prefix, client and window."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger = AuditLogger(tmpdir, aggregate=True, prefixes=["/api/data/"])
+
+        for _ in range(3):
+            logger.log_request("/api/data/1", 0.001, "192.168.1.1")
+        logger.log_request("/api/data/2", 0.001, "192.168.1.2")
+        logger.log_request("/blog/post", 0.002, "192.168.1.1")
+        logger.log_validation("/api/data/1", "W123", 0.001, False, "192.168.1.1", "expired")
+
+        logger.flush()
+        summaries = {}
+        for log in _read(tmpdir):
+            key = (log["event"], log["path_prefix"], log["client_ip"])
+            summaries[key] = summaries.get(key, 0) + log["count"]
+        assert summaries == {
+            ("payment_request", "/api/data/", "192.168.1.1"): 3,
+            ("payment_request", "/api/data/", "192.168.1.2"): 1,
+            ("payment_request", "/blog/", "192.168.1.1"): 1,
+            ("validation", "/api/data/", "192.168.1.1"): 1,
+        }
+
+
+def test_aggregate_keeps_paid_validations():
+    """Test successful validations are logged in full when aggregating."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger = AuditLogger(tmpdir, aggregate=True)
+
+        logger.log_validation("/api/data/", "W123", 0.001, True, "192.168.1.1")
+        logs = _read(tmpdir)
+        assert len(logs) == 1
+        assert logs[0]["is_valid"] is True
+
+
+def test_aggregate_flushes_closed_windows():
+    """Test a summary is written once its window has closed."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger = AuditLogger(tmpdir, aggregate=True, window=60)
+        logger.log_request("/api/data/", 0.001, "192.168.1.1")
+
+        logger.flush(now=0)
+        assert not os.path.getsize(os.path.join(tmpdir, "payments.log"))
+
+        logger.flush(now=time.time() + 60)
+        logs = _read(tmpdir)
+        assert len(logs) == 1
+        assert logs[0]["event_type"] == "summary"
+        assert logs[0]["amount"] == 0.001
+
+
+def test_aggregate_sampling():
+    """Test one raw rejection in N is logged alongside the summary."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger = AuditLogger(tmpdir, aggregate=True, sample_rate=4)
+
+        for _ in range(8):
+            logger.log_request("/api/data/", 0.001, "192.168.1.1")
+        logger.close()
+
+        logs = _read(tmpdir)
+        assert [log["event_type"] for log in logs].count("payment_request") == 2
+        assert sum(log["count"] for log in logs if log["event_type"] == "summary") == 8
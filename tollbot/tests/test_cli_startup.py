@@ -0,0 +1,76 @@
+"""Tests for tollbot CLI startup cost."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import tollbot
+
+# Import time budget for tollbot's own modules, in microseconds. Timings
+# depend on the machine, so the budget is only checked when set.
+STARTUP_BUDGET_US = int(os.environ.get("TOLLBOT_STARTUP_BUDGET_US", 0))
+
+# Modules that must stay out of quick commands
+DEFERRED = (
+    "requests",
+    "ssl",
+    "asyncio",
+    "tollbot.nginx.configurator",
+    "tollbot.payment.token",
+    "tollbot.payment.validator",
+    "tollbot.service",
+)
+
+
+def _import_times(*args):
+    """Run the CLI with -X importtime and get cumulative time per module."""
+    env = dict(os.environ)
+    src = os.path.dirname(os.path.dirname(tollbot.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "tollbot", *args],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def _own_time(times):
+    """Get the import time of tollbot's own modules."""
+    # Nested modules are counted in their parents too, so this overestimates
+    return sum(t for name, t in times.items() if name.split(".")[0] == "tollbot")
+
+
+@pytest.mark.parametrize("args", [["--version"], ["status"]])
+def test_startup_imports(args):
+    """Test quick commands import only what they need."""
+    times = _import_times(*args)
+
+    assert "tollbot.cli.main" in times
+    assert [name for name in DEFERRED if name in times] == []
+
+
+def test_renew_imports(tmp_path):
+    """Test renew imports the token module only, and nginx support only with nginx."""
+    times = _import_times("renew", "--config-dir", str(tmp_path), "--nginx-root", str(tmp_path))
+
+    assert "tollbot.cli.renew_cmd" in times
+    assert "tollbot.payment.token" in times
+    assert [name for name in DEFERRED if name in times and name != "tollbot.payment.token"] == []
+
+
+@pytest.mark.skipif(not STARTUP_BUDGET_US, reason="TOLLBOT_STARTUP_BUDGET_US not set")
+@pytest.mark.parametrize("args", [["--version"], ["status"]])
+def test_startup_budget(args):
+    """Test quick commands import tollbot within the configured budget."""
+    assert _own_time(_import_times(*args)) < STARTUP_BUDGET_US
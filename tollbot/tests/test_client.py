@@ -0,0 +1,85 @@
+"""Tests for tollbot payment backend client."""
+import pytest
+import threading
+import time
+
+import requests
+
+from tollbot.payment.client import BackendClient
+
+from tests.fakes import LocalSettlementServer
+
+TRANSFERS = {"pay_1": {"status": "complete"}}
+
+
+def test_get_json():
+    """Test fetching a document and a missing one."""
+    with LocalSettlementServer(TRANSFERS) as server:
+        client = BackendClient(server.url)
+        try:
+            assert client.get_json("/v1/transfers/pay_1")["data"]["status"] == "complete"
+            assert client.get_json("/v1/transfers/pay_2") is None
+        finally:
+            client.close()
+
+
+def test_retry_with_backoff():
+    """Test transient failures are retried."""
+    with LocalSettlementServer(TRANSFERS) as server:
+        server.failures = [(503, {}), (500, {})]
+        client = BackendClient(server.url, backoff=0.01)
+        try:
+            assert client.get_json("/v1/transfers/pay_1") is not None
+            assert server.requests == 3
+        finally:
+            client.close()
+
+
+def test_retry_after_honored():
+    """Test Retry-After overrides the backoff schedule."""
+    with LocalSettlementServer(TRANSFERS) as server:
+        server.failures = [(429, {"Retry-After": "0"})]
+        client = BackendClient(server.url, backoff=30.0)
+        try:
+            start = time.monotonic()
+            assert client.get_json("/v1/transfers/pay_1") is not None
+            assert time.monotonic() - start < 5
+        finally:
+            client.close()
+
+
+def test_retries_exhausted():
+    """Test the last failure is raised once retries run out."""
+    with LocalSettlementServer(TRANSFERS) as server:
+        server.failures = [(503, {})] * 3
+        client = BackendClient(server.url, max_retries=2, backoff=0.01)
+        try:
+            with pytest.raises(requests.HTTPError):
+                client.get_json("/v1/transfers/pay_1")
+            assert server.requests == 3
+        finally:
+            client.close()
+
+
+def test_concurrent_lookups_coalesced():
+    """Test simultaneous lookups of one path make one upstream call."""
+    with LocalSettlementServer(TRANSFERS) as server:
+        server.delay = 0.3
+        client = BackendClient(server.url)
+        results = []
+
+        def lookup():
+            results.append(client.get_json("/v1/transfers/pay_1"))
+
+        try:
+            threads = [threading.Thread(target=lookup) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(results) == 8
+            assert all(r["data"]["status"] == "complete" for r in results)
+            assert server.requests == 1
+        finally:
+            client.close()
@@ -0,0 +1,80 @@
+"""Tests for tollbot robots.txt fetching."""
+import json
+
+from tollbot.fetcher import (
+    FAILED,
+    NOT_MODIFIED,
+    PUBLISHED,
+    Origin,
+    RobotsFetcher,
+)
+
+from tests.fakes import LocalRobotsServer
+
+ROBOTS = "User-agent: *\nDisallow: /api/  # @price: 0.001 @unit: 100\n"
+
+
+def _prices(config_dir):
+    """Get the published price table of a config directory."""
+    return json.loads((config_dir / "robots_cache.json").read_text())["pricing"]
+
+
+def test_conditional_fetch(tmp_path):
+    """Test unchanged files cost a 304 and changed ones are republished."""
+    with LocalRobotsServer({"/robots.txt": ROBOTS}) as server:
+        origin = Origin(server.url + "/robots.txt", str(tmp_path))
+        fetcher = RobotsFetcher([origin])
+        try:
+            assert fetcher.check(origin) == PUBLISHED
+            assert _prices(tmp_path)["/api/"]["price"] == 0.001
+            assert origin.etag is not None
+
+            assert fetcher.check(origin) == NOT_MODIFIED
+            assert server.not_modified == 1
+
+            server.update("/robots.txt", ROBOTS.replace("0.001", "0.002"))
+            assert fetcher.check(origin) == PUBLISHED
+            assert _prices(tmp_path)["/api/"]["price"] == 0.002
+
+            # One pooled connection served every request
+            assert server.requests == 3
+            assert server.connections == 1
+        finally:
+            fetcher.close()
+
+
+def test_refresh_fleet(tmp_path):
+    """Test origins are checked together and failures keep the last table."""
+    with LocalRobotsServer() as server:
+        origins = []
+        for i in range(5):
+            server.update(f"/site{i}/robots.txt", ROBOTS.replace("0.001", f"0.00{i + 1}"))
+            origins.append(Origin(f"{server.url}/site{i}/robots.txt", str(tmp_path / f"site{i}")))
+        fetcher = RobotsFetcher(origins, max_workers=2)
+        try:
+            assert fetcher.refresh_all() == {PUBLISHED: 5}
+            assert _prices(tmp_path / "site4")["/api/"]["price"] == 0.005
+
+            del server.robots["/site0/robots.txt"]
+            server.update("/site1/robots.txt", ROBOTS.replace("0.001", "0.009"))
+            assert fetcher.refresh_all() == {FAILED: 1, PUBLISHED: 1, NOT_MODIFIED: 3}
+            assert "404" in origins[0].error
+            assert _prices(tmp_path / "site0")["/api/"]["price"] == 0.001
+            assert _prices(tmp_path / "site1")["/api/"]["price"] == 0.009
+        finally:
+            fetcher.close()
+
+
+def test_oversized_robots_refused(tmp_path):
+    """Test a robots.txt over the size cap fails and keeps the last table."""
+    with LocalRobotsServer({"/robots.txt": ROBOTS}) as server:
+        origin = Origin(f"{server.url}/robots.txt", str(tmp_path))
+        fetcher = RobotsFetcher([origin], max_size=len(ROBOTS) + 100)
+        try:
+            assert fetcher.check(origin) == PUBLISHED
+            server.update("/robots.txt", ROBOTS + "#" * 200 + "\n")
+            assert fetcher.check(origin) == FAILED
+            assert "bytes" in origin.error
+            assert _prices(tmp_path)["/api/"]["price"] == 0.001
+        finally:
+            fetcher.close()
@@ -0,0 +1,120 @@
+"""Tests for tollbot init command."""
+import json
+
+from tollbot.cli.init_cmd import init_fleet, read_manifest, reload_fleet
+from tollbot.nginx.configurator import NginxConfigurator
+
+from tests.fakes import FakeNginx, LocalRobotsServer
+
+ROBOTS = """User-agent: *
+Disallow: /api/ # @price: 0.001 @unit: 100
+Disallow: /blog/ # @price: 0.002 @unit: 10
+"""
+
+
+def test_read_manifest(tmp_path):
+    """Test manifest lines, comments and robots.txt paths."""
+    manifest = tmp_path / "domains.txt"
+    manifest.write_text("# fleet\nexample.com\n\nexample.org /srv/org/robots.txt  # moved\n")
+
+    assert read_manifest(str(manifest)) == [
+        ("example.com", None),
+        ("example.org", "/srv/org/robots.txt"),
+    ]
+
+
+def test_init_fleet(tmp_path):
+    """Test each domain becomes a site of one configuration directory."""
+    robots = tmp_path / "robots.txt"
+    robots.write_text(ROBOTS)
+    config_dir = tmp_path / "tollbot"
+    entries = [
+        ("a.example.com", str(robots)),
+        ("b.example.com", str(tmp_path / "missing.txt")),
+        ("c.example.com", str(robots)),
+    ]
+
+    results = init_fleet(entries, str(config_dir), wallet="W123", jobs=2)
+
+    assert [r["domain"] for r in results] == [d for d, _ in entries]
+    assert [r["status"] for r in results] == ["ok", "warning", "ok"]
+    assert [r["prices"] for r in results] == [2, 0, 2]
+
+    assert (config_dir / "wallet.conf").read_text().startswith("wallet_id=W123\n")
+    include = (config_dir / "nginx" / "tollbot-include.conf").read_text()
+    assert f"include {config_dir}/*/nginx/tollbot-map.conf;" in include
+    assert json.loads((config_dir / "sites.json").read_text()) == {
+        "sites": ["a.example.com", "b.example.com", "c.example.com"],
+    }
+
+    site = config_dir / "a.example.com"
+    assert json.loads((site / "robots_cache.json").read_text())["pricing"]["/blog/"]["unit"] == 10
+    price_map = (site / "nginx" / "tollbot-map.conf").read_text()
+    assert "map $uri $tollbot_prefix_a_example_com {" in price_map
+    assert '"~^/api/" "/api/";' in price_map
+    locations = (site / "nginx" / "tollbot-locations.conf").read_text()
+    assert "set $tollbot_site a.example.com;" in locations
+    assert "set $tollbot_prefix $tollbot_prefix_a_example_com;" in locations
+    assert "~^" not in (config_dir / "b.example.com" / "nginx" / "tollbot-map.conf").read_text()
+
+
+def test_init_fleet_invalid_domain(tmp_path):
+    """Test domains that cannot name a site fail alone."""
+    results = init_fleet([("../evil", None), ("ok.example.com", None)], str(tmp_path), jobs=1)
+
+    assert [r["status"] for r in results] == ["failed", "warning"]
+    assert json.loads((tmp_path / "sites.json").read_text()) == {"sites": ["ok.example.com"]}
+
+
+def test_reload_fleet(tmp_path):
+    """Test a fleet is merged into one nginx, tested, reloaded and probed once."""
+    root = tmp_path / "nginx"
+    (root / "sites").mkdir(parents=True)
+    (root / "nginx.conf").write_text("events {}\nhttp {\n    include sites/*.conf;\n}\n")
+    for name in ("a", "b"):
+        (root / "sites" / f"{name}.conf").write_text(
+            f"server {{\n    listen 80;\n    server_name {name}.example.com;\n"
+            "    location / {\n        root /var/www;\n    }\n}\n"
+        )
+    robots = tmp_path / "robots.txt"
+    robots.write_text(ROBOTS)
+    config_dir = tmp_path / "tollbot"
+    results = init_fleet(
+        [("a.example.com", str(robots)), ("b.example.com", str(robots))], str(config_dir), jobs=2
+    )
+
+    (tmp_path / "bin").mkdir()
+    nginx = FakeNginx(tmp_path / "bin")
+    try:
+        first = NginxConfigurator("a.example.com", str(config_dir), site=True)
+        first.write_site()
+        nginx.generation = first.generation
+        ok, detail = reload_fleet(
+            results, str(config_dir), str(root), nginx_bin=str(nginx.bin), nginx_url=nginx.url
+        )
+    finally:
+        nginx.close()
+
+    assert ok is True, detail
+    assert detail.startswith("3 files merged, tested and reloaded")
+    assert nginx.calls() == [f"-t -c {root / 'nginx.conf'}", "-s reload"]
+    for name in ("a", "b"):
+        conf = (root / "sites" / f"{name}.conf").read_text()
+        assert f"include {config_dir}/{name}.example.com/nginx/tollbot-locations.conf;" in conf
+        assert f"access_by_lua_file {config_dir}/lua/tollbot_access.lua;" in conf
+
+
+def test_init_fleet_remote_origins(tmp_path):
+    """Test robots.txt URLs in the manifest are fetched from their origins."""
+    config_dir = tmp_path / "tollbot"
+    with LocalRobotsServer({"/robots.txt": ROBOTS}) as server:
+        entries = [
+            ("a.example.com", server.url + "/robots.txt"),
+            ("b.example.com", server.url + "/missing.txt"),
+        ]
+        results = init_fleet(entries, str(config_dir), dry_run=True, jobs=2)
+
+    assert [r["status"] for r in results] == ["ok", "warning"]
+    assert [r["prices"] for r in results] == [2, 0]
+    cache = json.loads((config_dir / "a.example.com" / "robots_cache.json").read_text())
+    assert cache["pricing"]["/api/"]["price"] == 0.001
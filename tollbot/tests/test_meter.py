@@ -0,0 +1,56 @@
+"""Tests for tollbot unit metering."""
+import pytest
+import time
+
+from tollbot.payment.meter import UnitMeter
+
+
+def test_consume_units():
+    """Test a token is good for exactly unit requests."""
+    meter = UnitMeter()
+    now = int(time.time())
+
+    results = [meter.consume("nonce", 3, now + 60, now) for _ in range(4)]
+    assert results == [2, 1, 0, -1]
+    assert meter.exhausted("nonce") is True
+
+
+def test_consume_independent_tokens():
+    """Test counters are kept per token."""
+    meter = UnitMeter()
+    now = int(time.time())
+
+    assert meter.consume("a", 1, now + 60, now) == 0
+    assert meter.consume("b", 2, now + 60, now) == 1
+    assert meter.remaining("a") == 0
+    assert meter.remaining("b") == 1
+    assert meter.remaining("c") is None
+
+
+def test_consume_expired_token():
+    """Test expired tokens get no units."""
+    meter = UnitMeter()
+    now = int(time.time())
+
+    assert meter.consume("old", 100, now - 1, now) == -1
+    assert meter.consume("soon", 100, now + 5, now) == 99
+    assert meter.consume("soon", 100, now + 5, now + 5) == -1
+
+
+def test_counters_expire_with_token():
+    """Test counters are dropped once their token expires."""
+    meter = UnitMeter(granularity=10)
+    now = int(time.time())
+
+    meter.consume("short", 100, now + 10, now)
+    meter.consume("long", 100, now + 3600, now)
+    assert len(meter) == 2
+
+    meter.consume("other", 100, now + 3600, now + 30)
+    assert meter.remaining("short") is None
+    assert meter.remaining("long") == 99
+    assert len(meter) == 2
+
+    # A long idle gap sweeps only the populated buckets
+    meter.consume("late", 100, now + 100000, now + 50000)
+    assert len(meter) == 1
@@ -0,0 +1,83 @@
+"""Tests for runtime metrics."""
+import threading
+
+from tollbot.metrics import Metrics
+
+
+def test_counters_merge_threads():
+    """Test counters recorded on several threads are summed."""
+    metrics = Metrics()
+
+    def work():
+        for _ in range(1000):
+            metrics.inc("validations", status=200)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.inc("validations", status=402)
+
+    assert metrics.counters()[("validations", (("status", 200),))] == 4000
+    assert metrics.total("validations") == 4001
+
+
+def test_quantile():
+    """Test quantiles are estimated from histogram buckets."""
+    metrics = Metrics(buckets=(0.001, 0.01, 0.1))
+    assert metrics.quantile("latency", 0.5) is None
+
+    for _ in range(98):
+        metrics.observe("latency", 0.0005)
+    metrics.observe("latency", 0.05)
+    metrics.observe("latency", 5.0)
+
+    assert metrics.quantile("latency", 0.5) <= 0.001
+    assert 0.01 < metrics.quantile("latency", 0.99) <= 0.1
+    assert metrics.histograms()[("latency", ())][-1] > 5.0
+
+
+def test_rate():
+    """Test rates are computed over tick() samples."""
+    metrics = Metrics(window=2)
+    metrics.tick(now=100)
+    metrics.inc("mints", 10)
+    metrics.tick(now=101)
+    metrics.inc("mints", 30)
+    metrics.tick(now=102)
+
+    assert metrics.rate("mints") == 20.0
+    metrics.tick(now=103)
+    assert metrics.rate("mints") == 15.0
+
+
+def test_prometheus():
+    """Test rendering in the Prometheus text format."""
+    metrics = Metrics(buckets=(0.001, 0.01))
+    metrics.inc("rejections", reason="missing")
+    metrics.inc("rejections", 2, reason="throttled")
+    metrics.observe("validation_seconds", 0.0005)
+    metrics.observe("validation_seconds", 0.005)
+
+    assert metrics.prometheus().splitlines() == [
+        "# TYPE tollbot_rejections_total counter",
+        'tollbot_rejections_total{reason="missing"} 1',
+        'tollbot_rejections_total{reason="throttled"} 2',
+        "# TYPE tollbot_validation_seconds histogram",
+        'tollbot_validation_seconds_bucket{le="0.001"} 1',
+        'tollbot_validation_seconds_bucket{le="0.01"} 2',
+        'tollbot_validation_seconds_bucket{le="+Inf"} 2',
+        "tollbot_validation_seconds_sum 0.0055",
+        "tollbot_validation_seconds_count 2",
+    ]
+
+
+def test_prometheus_large_counter():
+    """Test large counters are rendered without losing precision."""
+    metrics = Metrics()
+    metrics.inc("requests", 1234567)
+    metrics.inc("paid", 0.1 + 0.2)
+
+    assert "tollbot_requests_total 1234567" in metrics.prometheus().splitlines()
+    assert "tollbot_paid_total 0.30000000000000004" in metrics.prometheus().splitlines()
@@ -1,9 +1,13 @@
 """Tests for tollbot nginx configurator."""
 import pytest
+import json
 import os
 import tempfile
 
 from tollbot.nginx.configurator import NginxConfigurator
+from tollbot.robots_parser import RobotsParser
+
+from tests.fakes import FakeNginx
 
 
 def test_generate_config():
@@ -20,8 +24,15 @@ def test_generate_config():
         domain_file = os.path.join(tmpdir, "nginx", "example.com.conf")
         assert os.path.exists(domain_file)
 
+        # Check Lua modules were installed
+        lua_file = os.path.join(tmpdir, "lua", "payment_filter.lua")
+        assert os.path.exists(lua_file)
+        with open(os.path.join(tmpdir, "lua", "tollbot_init.lua")) as f:
+            assert f'init_worker("{tmpdir}")' in f.read()
+
         # Verify content
-        with open(include_file) as f:
+        locations_file = os.path.join(tmpdir, "nginx", "tollbot-locations.conf")
+        with open(locations_file) as f:
             content = f.read()
             assert "/__tollbot__/validate" in content
             assert "/__tollbot__/request-payment" in content
@@ -32,8 +43,24 @@ def test_get_include_config():
     configurator = NginxConfigurator("example.com", "/tmp")
     config = configurator._get_include_config()
 
+    assert 'lua_package_path "/tmp/lua/?.lua;;"' in config
+    assert "init_worker_by_lua_file /tmp/lua/tollbot_init.lua;" in config
+    assert "lua_shared_dict tollbot_units" in config
+    assert "lua_shared_dict tollbot_limits" in config
+    assert "lua_shared_dict tollbot_metrics" in config
+
+
+def test_get_locations_config():
+    """Test endpoint locations generation."""
+    configurator = NginxConfigurator("example.com", "/tmp")
+    config = configurator._get_locations_config()
+
     assert "location /__tollbot__/validate" in config
-    assert "content_by_lua_file" in config
+    assert "content_by_lua_file /tmp/lua/tollbot_access.lua;" in config
+    assert "location = /__tollbot__/metrics" in config
+    assert "content_by_lua_file /tmp/lua/tollbot_metrics.lua;" in config
+    # Endpoints turn off an access handler inherited from the server block
+    assert config.count("access_by_lua_block { return }") == config.count("location ")
 
 
 def test_get_domain_config():
@@ -43,6 +70,7 @@ def test_get_domain_config():
 
     assert "server_name example.com" in config
     assert "/api/" in config
+    assert "include /tmp/nginx/tollbot-locations.conf;" in config
 
 
 def test_test_config():
@@ -62,3 +90,136 @@ def test_reload():
     # This will fail if nginx is not running, but that's expected
     # We just want to make sure the method exists and doesn't crash
     configurator.reload()
+
+
+def test_get_price_map():
+    """Test price map generation from the price table."""
+    pricing = {
+        "/api/": {"price": 0.001, "unit": 100, "currency": "USDC"},
+        "/api/models/": {"price": 0.003, "unit": 100, "currency": "USDC"},
+    }
+    configurator = NginxConfigurator("example.com", "/tmp", pricing=pricing)
+    config = configurator._get_include_config()
+
+    assert "map $uri $tollbot_prefix {" in config
+    assert '    default "";' in config
+    # Most specific prefix must be matched first
+    assert config.index('"~^/api/models/" "/api/models/";') < config.index('"~^/api/" "/api/";')
+    # Prices are looked up live, so they are not part of the config
+    assert "0.003" not in config
+
+
+def test_get_price_map_from_cache(tmp_path):
+    """Test the price map falls back to the robots.txt cache."""
+    cache_file = tmp_path / "robots_cache.json"
+    cache_file.write_text('{"pricing": {"/cgi-bin/": {"price": 0.002}}}')
+
+    configurator = NginxConfigurator("example.com", str(tmp_path))
+    # nginx unescapes the doubled backslash, leaving the regex \-
+    assert '"~^/cgi\\\\-bin/" "/cgi-bin/";' in configurator._get_price_map()
+
+
+def test_get_price_map_refuses_unsafe_prefixes(tmp_path):
+    """Test prefixes that could break out of the map are never written."""
+    pricing = {
+        '/x";}include"/tmp/evil.conf";map$a$b{': {"price": 0.01},
+        "/a b/": {"price": 0.01},
+        "/api/": {"price": 0.01},
+    }
+    price_map = NginxConfigurator("example.com", str(tmp_path), pricing=pricing)._get_price_map()
+    assert "evil" not in price_map
+    assert "/a b/" not in price_map
+    assert '"~^/api/" "/api/";' in price_map
+
+
+@pytest.fixture
+def fake_nginx(tmp_path):
+    nginx = FakeNginx(tmp_path)
+    yield nginx
+    nginx.close()
+
+
+def _configurator(tmp_path, nginx, pricing):
+    config_dir = tmp_path / "tollbot"
+    config_dir.mkdir(exist_ok=True)
+    return NginxConfigurator(
+        "example.com", str(config_dir), pricing=pricing,
+        nginx_bin=str(nginx.bin), nginx_url=nginx.url,
+    )
+
+
+def test_reload_tests_first(tmp_path):
+    """Test a failing configuration test prevents the reload."""
+    nginx = FakeNginx(tmp_path, test_exit=1)
+    try:
+        configurator = _configurator(tmp_path, nginx, {})
+        assert configurator.reload() is False
+        assert nginx.calls() == ["-t"]
+        assert configurator.last_error == "syntax error"
+    finally:
+        nginx.close()
+
+
+def test_reload_probes_new_generation(tmp_path, fake_nginx):
+    """Test reload waits for the status endpoint to report the new config."""
+    configurator = _configurator(tmp_path, fake_nginx, {"/api/": {"price": 0.001}})
+    configurator.write_snippets()
+
+    fake_nginx.generation = "stale"
+    assert configurator.probe(timeout=0.2, interval=0.05) is False
+
+    fake_nginx.generation = configurator.generation
+    assert configurator.reload() is True
+    assert fake_nginx.calls() == ["-t", "-s reload"]
+
+
+def test_apply_price_change_without_reload(tmp_path, fake_nginx):
+    """Test price-only changes are pushed and prefix changes reloaded."""
+    pricing = {"/api/": {"price": 0.001}}
+    configurator = _configurator(tmp_path, fake_nginx, pricing)
+    parser = RobotsParser()
+    parser.pricing = pricing
+    parser.save_cache(os.path.join(configurator.config_dir, "robots_cache.json"))
+    assert configurator.write_snippets() is True
+    fake_nginx.generation = configurator.generation
+
+    # Same prefixes, new price: pushed to the workers
+    pricing["/api/"]["price"] = 0.002
+    parser.save_cache(os.path.join(configurator.config_dir, "robots_cache.json"))
+    assert configurator.apply() is True
+    assert fake_nginx.calls() == []
+    assert fake_nginx.prices[-1]["pricing"]["/api/"]["price"] == 0.002
+
+    # New prefix: tested and reloaded
+    pricing["/blog/"] = {"price": 0.001}
+    generation = configurator.generation
+    fake_nginx.generation = "pending"
+    assert configurator.write_snippets() is True
+    assert configurator.generation != generation
+    fake_nginx.generation = configurator.generation
+    assert configurator.reload() is True
+    assert fake_nginx.calls() == ["-t", "-s reload"]
+
+
+def test_for_config_dir(tmp_path, fake_nginx):
+    """Test later commands find the domain init configured and push to its vhost."""
+    config_dir = tmp_path / "tollbot"
+    assert NginxConfigurator.for_config_dir(str(config_dir)) == []
+
+    configurator = _configurator(tmp_path, fake_nginx, {"/api/": {"price": 0.001}})
+    configurator.write_snippets()
+    parser = RobotsParser()
+    parser.pricing = {"/api/": {"price": 0.001}}
+    parser.save_cache(str(config_dir / "robots_cache.json"))
+
+    [found] = NginxConfigurator.for_config_dir(
+        str(config_dir), nginx_bin=str(fake_nginx.bin), nginx_url=fake_nginx.url
+    )
+    assert (found.domain, found.site) == ("example.com", False)
+    fake_nginx.generation = configurator.generation
+    assert found.apply() is True
+    assert fake_nginx.hosts == ["example.com"]
+
+    (config_dir / "sites.json").write_text(json.dumps({"sites": ["a.example.com", "b.example.com"]}))
+    sites = NginxConfigurator.for_config_dir(str(config_dir))
+    assert [(c.domain, c.site) for c in sites] == [("a.example.com", True), ("b.example.com", True)]
@@ -0,0 +1,146 @@
+"""Tests for merging tollbot into an nginx configuration."""
+import pytest
+
+pytest.importorskip("certbot_nginx._internal.parser")
+
+from tests.fakes import FakeNginx
+from tollbot.nginx.configurator import NginxConfigurator
+from tollbot.nginx.merge import BACKUP_EXT, CachedNginxParser
+
+NGINX_CONF = """events {}
+http {
+    include sites/*.conf;
+}
+"""
+
+EXAMPLE_CONF = """server {
+    listen 80;
+    server_name example.com;
+
+    location /api/ {
+        proxy_pass http://127.0.0.1:8080;
+    }
+
+    location /static/ {
+        root /var/www;
+    }
+}
+"""
+
+OTHER_CONF = """server {
+    listen 80;
+    server_name other.org;
+
+    location / {
+        root /var/www/other;
+    }
+}
+"""
+
+PRICING = {"/api/": {"price": 0.001}, "/blog/": {"price": 0.002}}
+
+
+@pytest.fixture
+def nginx_root(tmp_path):
+    """Build a small nginx tree with two sites."""
+    root = tmp_path / "nginx"
+    (root / "sites").mkdir(parents=True)
+    (root / "nginx.conf").write_text(NGINX_CONF)
+    (root / "sites" / "example.conf").write_text(EXAMPLE_CONF)
+    (root / "sites" / "other.conf").write_text(OTHER_CONF)
+    return root
+
+
+@pytest.fixture
+def nginx(tmp_path):
+    """Stand in for the nginx binary merges are tested with."""
+    (tmp_path / "bin").mkdir()
+    fake = FakeNginx(tmp_path / "bin")
+    yield fake
+    fake.close()
+
+
+def _configurator(domain, config_dir, nginx):
+    return NginxConfigurator(domain, str(config_dir), pricing=PRICING, nginx_bin=str(nginx.bin))
+
+
+def test_merge_priced_locations(nginx_root, tmp_path, nginx):
+    """Test only the vhost and locations serving priced paths are changed."""
+    config_dir = str(tmp_path / "tollbot")
+    configurator = _configurator("example.com", config_dir, nginx)
+
+    changed = configurator.merge(str(nginx_root))
+    assert sorted(changed) == [
+        str(nginx_root / "nginx.conf"),
+        str(nginx_root / "sites" / "example.conf"),
+    ]
+
+    access = f"access_by_lua_file {config_dir}/lua/tollbot_access.lua;"
+    assert f"include {config_dir}/nginx/tollbot-include.conf;" in (
+        nginx_root / "nginx.conf"
+    ).read_text()
+
+    example = (nginx_root / "sites" / "example.conf").read_text()
+    assert f"include {config_dir}/nginx/tollbot-locations.conf;" in example
+    api, static = example.split("location /static/")
+    # /api/ is covered by its location, /blog/ only by the server block
+    assert api.count(access) == 2
+    assert access not in static
+
+    assert (nginx_root / "sites" / "other.conf").read_text() == OTHER_CONF
+    assert (nginx_root / "sites" / ("example.conf" + BACKUP_EXT)).read_text() == EXAMPLE_CONF
+    assert nginx.calls() == [f"-t -c {nginx_root / 'nginx.conf'}"]
+
+
+def test_merge_rolled_back(nginx_root, tmp_path):
+    """Test files are restored when nginx rejects the merged configuration."""
+    (tmp_path / "bin").mkdir()
+    nginx = FakeNginx(tmp_path / "bin", test_exit=1)
+    try:
+        configurator = _configurator("example.com", tmp_path / "tollbot", nginx)
+        with pytest.raises(ValueError, match="original files restored"):
+            configurator.merge(str(nginx_root))
+    finally:
+        nginx.close()
+
+    assert (nginx_root / "nginx.conf").read_text() == NGINX_CONF
+    assert (nginx_root / "sites" / "example.conf").read_text() == EXAMPLE_CONF
+    assert configurator.last_error == "syntax error"
+
+
+def test_merge_is_idempotent(nginx_root, tmp_path, nginx):
+    """Test merging twice leaves the configuration unchanged."""
+    configurator = _configurator("example.com", tmp_path / "tollbot", nginx)
+    configurator.merge(str(nginx_root))
+    merged = (nginx_root / "sites" / "example.conf").read_text()
+
+    assert configurator.merge(str(nginx_root)) == []
+    assert (nginx_root / "sites" / "example.conf").read_text() == merged
+
+
+def test_parse_cache(nginx_root, tmp_path):
+    """Test unchanged files are loaded from the parse cache."""
+    cache_file = str(tmp_path / "cache" / "nginx-parse.json")
+    first = CachedNginxParser(str(nginx_root), cache_file)
+    assert (first.hits, first.misses) == (0, 3)
+
+    (nginx_root / "sites" / "other.conf").write_text(OTHER_CONF.replace("other.org", "other.net"))
+    second = CachedNginxParser(str(nginx_root), cache_file)
+    assert (second.hits, second.misses) == (2, 1)
+    assert "other.net" in str(second.parsed[str(nginx_root / "sites" / "other.conf")])
+
+
+def test_merge_refuses_second_config_dir(nginx_root, tmp_path, nginx):
+    """Test an nginx instance is only given one tollbot configuration directory."""
+    _configurator("example.com", tmp_path / "a", nginx).merge(str(nginx_root))
+    merged = (nginx_root / "nginx.conf").read_text()
+
+    other = _configurator("other.org", tmp_path / "b", nginx)
+    with pytest.raises(ValueError, match="one configuration directory per nginx instance"):
+        other.merge(str(nginx_root))
+    assert (nginx_root / "nginx.conf").read_text() == merged
+    assert (nginx_root / "sites" / "other.conf").read_text() == OTHER_CONF
+
+    # Another domain served from the same directory is fine
+    same = _configurator("other.org", tmp_path / "a", nginx)
+    assert same.merge(str(nginx_root)) == [str(nginx_root / "sites" / "other.conf")]
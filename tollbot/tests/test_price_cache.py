@@ -0,0 +1,65 @@
+"""Tests for tollbot price lookup cache."""
+import pytest
+
+from tollbot.metrics import Metrics
+from tollbot.price_cache import MISSING, PriceCache
+
+
+def test_get_and_put():
+    """Test cached answers, including None, are returned for their version."""
+    cache = PriceCache(capacity=4)
+    assert cache.get("/api/x", 1) is MISSING
+
+    cache.put("/api/x", {"price": 0.001}, 1)
+    cache.put("/free", None, 1)
+    assert cache.get("/api/x", 1) == {"price": 0.001}
+    assert cache.get("/free", 1) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # A new price table version empties the cache
+    assert cache.get("/api/x", 2) is MISSING
+    assert len(cache) == 0
+
+
+def test_clock_eviction():
+    """Test paths that are hit again outlive paths seen once."""
+    cache = PriceCache(capacity=4)
+    for path in ("/a", "/b", "/c", "/d"):
+        cache.get(path, 1)
+        cache.put(path, path, 1)
+    cache.get("/a", 1)
+    cache.get("/c", 1)
+
+    cache.put("/e", "/e", 1)
+    cache.put("/f", "/f", 1)
+
+    assert len(cache) == 4
+    assert cache.get("/a", 1) == "/a"
+    assert cache.get("/c", 1) == "/c"
+    assert cache.get("/b", 1) is MISSING
+    assert cache.get("/d", 1) is MISSING
+
+
+def test_hit_metrics():
+    """Test hits and misses are counted in metrics."""
+    metrics = Metrics()
+    cache = PriceCache(capacity=4, metrics=metrics)
+    assert cache.hit_ratio is None
+
+    cache.get("/a", 1)
+    cache.put("/a", None, 1)
+    cache.get("/a", 1)
+    cache.get("/a", 1)
+
+    assert metrics.total("price_cache_hits") == 2
+    assert metrics.total("price_cache_misses") == 1
+    assert cache.hit_ratio == pytest.approx(2 / 3)
+
+
+def test_put_after_version_change():
+    """Test an answer looked up under an old version is not cached."""
+    cache = PriceCache(capacity=4)
+    assert cache.get("/api/x", 1) is MISSING
+    cache.clear(2)
+    cache.put("/api/x", "old price", 1)
+    assert cache.get("/api/x", 2) is MISSING
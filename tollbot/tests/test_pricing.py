@@ -0,0 +1,81 @@
+"""Tests for tollbot demand-based pricing."""
+import pytest
+import json
+
+from tollbot.payment.token import TokenManager
+from tollbot.payment.validator import PaymentValidator
+from tollbot.pricing import DemandPricing
+from tollbot.robots_parser import RobotsParser
+
+
+def test_factor_follows_rate():
+    """Test prices rise with the window's rate, within max_factor."""
+    demand = DemandPricing(target_rate=1.0, window=10, max_factor=3.0)
+    now = 1000.0
+    for _ in range(20):
+        demand.record("/api/", now)
+    demand.record("/free/", now)
+
+    # Published before the burst was counted, and not again within the interval
+    assert demand.factors == {}
+    demand.publish(now + 0.5)
+    assert demand.factors == {}
+
+    demand.publish(now + 1)
+    assert demand.rate("/api/", now + 1) == 2.0
+    assert demand.factors == {"/api/": 2.0}
+    assert demand.price("/api/", 0.001) == pytest.approx(0.002)
+    assert demand.price("/free/", 0.001) == 0.001
+
+    for _ in range(100):
+        demand.record("/api/", now + 2)
+    demand.publish(now + 3)
+    assert demand.factors["/api/"] == 3.0
+
+    # Buckets older than the window no longer count
+    demand.publish(now + 13)
+    assert demand.factors == {}
+
+
+def test_ring_reuses_buckets():
+    """Test a bucket is reset when its second comes round again."""
+    demand = DemandPricing(target_rate=1.0, window=4)
+    demand.record("/api/", 100.0)
+    demand.record("/api/", 100.5)
+    assert demand.rate("/api/", 100.5) == 0.5
+
+    demand.record("/api/", 104.0)
+    assert demand.rate("/api/", 104.0) == 0.25
+    assert len(demand._counts["/api/"]) == 4
+
+    with pytest.raises(ValueError):
+        DemandPricing(target_rate=0)
+
+
+def test_validator_demand_pricing(tmp_path):
+    """Test surges raise the quote for new tokens but not the bar for minted ones."""
+    (tmp_path / "config.ini").write_text(json.dumps({"demand_target_rate": 0.05, "demand_window": 10}))
+    parser = RobotsParser()
+    parser.parse("Disallow: /api/  # @price: 0.001 @unit: 100\n")
+    parser.save_cache(str(tmp_path / "robots_cache.json"))
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    base = manager.encode_token(manager.create_token("W", "USDC", 0.001, 100, "/api/"))
+    short = manager.encode_token(manager.create_token("W", "USDC", 0.0005, 100, "/api/"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator._get_min_price("/api/x") == 0.001
+
+    # Validation alone does not count as demand; mints do
+    assert validator.check_request(base, "/api/x") == 200
+    assert validator.demand.rate("/api/") == 0.0
+    # One paid request in ten seconds is twice the target rate
+    validator.demand.record("/api/")
+    assert validator.demand.factors == {"/api/": 2.0}
+    assert validator._get_min_price("/api/x") == pytest.approx(0.002)
+    assert validator.generate_payment_url("/api/x").endswith("amount=0.002")
+    # Tokens minted before the surge keep working; underpaid ones never did
+    assert validator.check_request(base, "/api/x") == 200
+    assert validator.check_request(short, "/api/x") == 403
+    assert validator.metrics.total("price_publications") == 1
@@ -0,0 +1,46 @@
+"""Tests for tollbot rate limiter."""
+from tollbot.payment.ratelimit import RateLimiter
+
+
+def test_charge_until_empty():
+    """Test a bucket allows its burst and then refuses."""
+    limiter = RateLimiter(rate=1.0, burst=3)
+    key = RateLimiter.client_key("10.0.0.1", "bot")
+
+    assert [limiter.charge(key, now=100.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.limited(key, now=100.0) is True
+
+
+def test_bucket_refills():
+    """Test a bucket refills at the configured rate."""
+    limiter = RateLimiter(rate=1.0, burst=2)
+    key = RateLimiter.client_key("10.0.0.1", "bot")
+    limiter.charge(key, now=100.0)
+    limiter.charge(key, now=100.0)
+
+    assert limiter.limited(key, now=100.5) is True
+    assert limiter.limited(key, now=101.0) is False
+    assert limiter.charge(key, now=101.0) is True
+    assert limiter.charge(key, now=101.0) is False
+
+
+def test_clients_are_independent():
+    """Test clients are keyed by address and user agent."""
+    limiter = RateLimiter(rate=1.0, burst=1)
+    limiter.charge(RateLimiter.client_key("10.0.0.1", "bot"), now=100.0)
+
+    assert limiter.limited(RateLimiter.client_key("10.0.0.1", "bot"), now=100.0) is True
+    assert limiter.limited(RateLimiter.client_key("10.0.0.1", "browser"), now=100.0) is False
+    assert limiter.limited(RateLimiter.client_key("10.0.0.2", "bot"), now=100.0) is False
+
+
+def test_idle_clients_purged():
+    """Test idle clients are dropped on the next sweep."""
+    limiter = RateLimiter(rate=1.0, burst=5, purge_interval=60)
+    limiter._next_purge = 160.0
+    limiter.charge("a", now=100.0)
+    limiter.charge("b", now=150.0)
+    assert len(limiter) == 2
+
+    limiter.charge("b", now=160.0)
+    assert len(limiter) == 1
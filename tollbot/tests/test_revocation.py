@@ -0,0 +1,64 @@
+"""Tests for tollbot prepaid token revocation."""
+import pytest
+
+from tollbot.payment.resp import RespClient
+from tollbot.payment.revocation import RevocationList, SerialAllocator
+
+from tests.fakes import LocalRespServer
+
+
+def test_revoke_and_compact():
+    """Test revoked serials are kept one bit each from the base."""
+    revocations = RevocationList()
+    revocations.revoke([3, 17, 1000])
+
+    assert revocations.is_revoked(3) is True
+    assert revocations.is_revoked(4) is False
+    assert revocations.is_revoked(1000) is True
+    assert revocations.is_revoked(5000) is False
+    assert len(revocations.bitmap) == 126
+
+    revocations.compact(20)
+    assert revocations.base == 16
+    assert revocations.is_revoked(3) is False
+    assert revocations.is_revoked(17) is True
+    assert revocations.is_revoked(1000) is True
+
+
+def test_save_and_load(tmp_path):
+    """Test a published list loads back with a new version."""
+    path = str(tmp_path / "revoked.json")
+    assert RevocationList.load(path) is None
+
+    revocations = RevocationList()
+    revocations.revoke([42])
+    revocations.save(path)
+    revocations.save(path)
+
+    loaded = RevocationList.load(path)
+    assert loaded.version == 2
+    assert loaded.is_revoked(42) is True
+    assert loaded.is_revoked(41) is False
+
+
+def test_serials_survive_restart(tmp_path):
+    """Test serials keep increasing across allocators on one file."""
+    path = str(tmp_path / "serial")
+    first = SerialAllocator(path, block=4)
+    assert [first.next() for _ in range(6)] == [0, 1, 2, 3, 4, 5]
+
+    second = SerialAllocator(path, block=4)
+    assert second.next() == 8
+
+
+def test_serials_unique_across_nodes(tmp_path):
+    """Test nodes sharing a store never hand out the same serial."""
+    with LocalRespServer() as server:
+        nodes = [
+            SerialAllocator(str(tmp_path / f"serial{i}"), block=4, client=RespClient(*server.address))
+            for i in range(2)
+        ]
+        serials = [node.next() for _ in range(6) for node in nodes]
+        for node in nodes:
+            node.client.close()
+    assert sorted(serials) == list(range(10)) + [12, 13]
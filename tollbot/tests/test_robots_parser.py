@@ -119,3 +119,52 @@ Disallow: /api/  # @price: 0.001 @unit: 100
 
     assert parser2.wallet == "CIRCLE_WALLET_ID"
     assert "/api/" in parser2.pricing
+
+
+def test_get_price_cached(tmp_path):
+    """Test price lookups are cached until the price table changes."""
+    parser = RobotsParser()
+    parser.parse("Disallow: /api/  # @price: 0.001 @unit: 100\n")
+
+    assert parser.get_price("/api/x")["price"] == 0.001
+    assert parser.get_price("/api/x")["price"] == 0.001
+    assert parser.get_price("/free") is None
+    assert parser.cache.hits == 1
+
+    parser.parse("Disallow: /api/  # @price: 0.005 @unit: 100\n")
+    assert parser.get_price("/api/x")["price"] == 0.005
+
+    cache_file = str(tmp_path / "robots_cache.json")
+    other = RobotsParser()
+    other.parse("Disallow: /free  # @price: 0.002 @unit: 1\n")
+    other.save_cache(cache_file)
+    parser.load_cache(cache_file)
+    assert parser.get_price("/api/x") is None
+    assert parser.get_price("/free")["price"] == 0.002
+
+
+def test_get_price_nested_prefix():
+    """Test the longest matching prefix wins regardless of rule order."""
+    content = """
+# @wallet: CIRCLE_WALLET_ID @currency: USDC
+User-agent: *
+Disallow: /api/  # @price: 0.001 @unit: 100
+Disallow: /api/premium/  # @price: 0.05 @unit: 100
+"""
+    parser = RobotsParser()
+    parser.parse(content)
+
+    assert parser.get_price("/api/premium/report")["price"] == 0.05
+    assert parser.get_price("/api/premium/")["price"] == 0.05
+    assert parser.get_price("/api/free")["price"] == 0.001
+
+
+def test_parse_drops_unsafe_prefixes():
+    """Test rules whose path could inject nginx configuration are ignored."""
+    parser = RobotsParser()
+    pricing = parser.parse(
+        'Disallow: /x";}include"/tmp/evil.conf";map$a$b{ # @price: 0.01 @unit: 1\n'
+        "Disallow: /%22%3B/  # @price: 0.01 @unit: 1\n"
+        "Disallow: /api/  # @price: 0.01 @unit: 1\n"
+    )
+    assert list(pricing) == ["/api/"]
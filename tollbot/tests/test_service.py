@@ -0,0 +1,416 @@
+"""Tests for the tollbot service."""
+import pytest
+import asyncio
+import json
+import threading
+import time
+
+from tollbot.cli.status_cmd import fetch_status
+from tollbot.logging.audit import AuditLogger
+from tollbot.payment.replay import MemoryReplayStore
+from tollbot.payment.settlement import MemorySettlementBackend, SettlementVerifier
+from tollbot.payment.token import TokenManager
+from tollbot.payment.store import MmapReplayStore
+from tollbot.payment.validator import PaymentValidator
+from tollbot.pricing import DemandPricing
+from tollbot.robots_parser import RobotsParser
+from tollbot.service import PaymentError, TollbotService
+
+ROBOTS = """
+# @wallet: CIRCLE_WALLET_ID @currency: USDC
+User-agent: *
+Disallow: /api/  # @price: 0.002 @unit: 50
+"""
+
+
+def _transfer(amount="0.002", wallet="W123", status="complete"):
+    """Build transfers API data for a payment."""
+    return {
+        "status": status,
+        "amount": {"amount": amount, "currency": "USD"},
+        "destination": {"type": "wallet", "id": wallet},
+    }
+
+
+def _settlement(transfers=None):
+    """Build a verifier over settled payments pay_0 to pay_63 and transfers."""
+    payments = {f"pay_{i}": _transfer() for i in range(64)}
+    payments.update(transfers or {})
+    return SettlementVerifier(
+        MemorySettlementBackend(payments), retry_interval=0.01, max_attempts=2
+    )
+
+
+def _configure(config_dir):
+    """Write a signing key and price table to config_dir."""
+    manager = TokenManager(str(config_dir))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    (config_dir / "wallet.conf").write_text("wallet_id=W123\ncurrency=USDC\n")
+
+    parser = RobotsParser()
+    parser.parse(ROBOTS)
+    parser.save_cache(str(config_dir / "robots_cache.json"))
+
+
+async def _get(port, targets):
+    """Send GET requests over one keep-alive connection."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    responses = []
+    try:
+        for target in targets:
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            status_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line == b"\r\n":
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(int(headers["content-length"]))
+            if headers["content-type"] == "application/json":
+                body = json.loads(body)
+            responses.append((int(status_line.split()[1]), body))
+    finally:
+        writer.close()
+    return responses
+
+
+def _run(service, coro_fn):
+    """Run coro_fn(port) against a started service."""
+    async def main():
+        await service.start()
+        try:
+            return await coro_fn(service.port)
+        finally:
+            await service.stop()
+
+    try:
+        return asyncio.run(main())
+    finally:
+        if service.settlement is not None:
+            service.settlement.shutdown()
+
+
+def test_request_payment(tmp_path):
+    """Test minting a token through the endpoint."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0, settlement=_settlement())
+
+    (status, body), = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/api/data/&payment_id=pay_0",
+    ]))
+
+    assert status == 200
+    assert body["amount"] == 0.002
+    assert body["unit"] == 50
+
+    token = service.manager.decode_token(body["token"])
+    assert token.wallet_id == "W123"
+    assert token.payment_id == "pay_0"
+    assert service.replay.issued(token.nonce) is True
+    assert service.replay.issued("payment:pay_0") is True
+    assert service.manager.validate_token(token, 0.002, "/api/data/x") is True
+
+
+def test_mint_site_prices(tmp_path):
+    """Test mints for a site of a fleet are priced from the site's table."""
+    _configure(tmp_path)
+    (tmp_path / "b.example.com").mkdir()
+    parser = RobotsParser()
+    parser.parse(ROBOTS.replace("0.002", "0.004"))
+    parser.save_cache(str(tmp_path / "b.example.com" / "robots_cache.json"))
+    (tmp_path / "sites.json").write_text(json.dumps({"sites": ["b.example.com"]}))
+    settlement = _settlement({"pay_b": _transfer("0.004")})
+    service = TollbotService(str(tmp_path), port=0, settlement=settlement)
+
+    async def mint(port):
+        token, _ = await service.mint("/api/x", payment_id="pay_b", site="b.example.com")
+        with pytest.raises(ValueError, match="Unknown site"):
+            await service.mint("/api/x", payment_id="pay_1", site="c.example.com")
+        return token
+
+    assert _run(service, mint).amount == 0.004
+
+
+def test_mint_records_demand(tmp_path):
+    """Test mints count the requests they pay for as demand."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0, settlement=_settlement())
+    service.demand = DemandPricing(target_rate=1.0, window=10)
+
+    async def mint(port):
+        await service.mint("/api/x", payment_id="pay_0")
+        with pytest.raises(PaymentError, match="does not cover"):
+            await service.mint("/api/y", payment_id="pay_1")
+
+    _run(service, mint)
+
+    # One token pays for 50 requests, and surges price the next mint
+    assert service.demand.rate("/api/") == 5.0
+    assert service.demand.factors == {"/api/": 4.0}
+
+
+def test_audit_summaries_flushed(tmp_path, monkeypatch):
+    """Test the watcher writes closed audit windows and stop writes the rest."""
+    _configure(tmp_path)
+    validator = PaymentValidator(str(tmp_path))
+    audit = validator.audit = AuditLogger(str(tmp_path / "audit"), aggregate=True)
+    service = TollbotService(str(tmp_path), port=0, validator=validator)
+    audit.log_request("/api/x", 0.002, "10.0.0.1")
+
+    async def watch():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(service._watch(0.01), 0.1)
+
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    asyncio.run(watch())
+    monkeypatch.undo()
+    assert audit.pending == 0
+    summaries = (tmp_path / "audit" / "payments.log").read_text().splitlines()
+    assert json.loads(summaries[-1])["count"] == 1
+
+    audit.log_request("/api/x", 0.002, "10.0.0.1")
+
+    async def idle(port):
+        assert audit.pending == 1
+
+    _run(service, idle)
+    assert audit.pending == 0
+
+
+def test_watch_survives_errors(tmp_path):
+    """Test a malformed file fails watcher rounds without stopping the watcher."""
+    _configure(tmp_path)
+    validator = PaymentValidator(str(tmp_path))
+    service = TollbotService(str(tmp_path), port=0, validator=validator)
+    (tmp_path / "revoked.json").write_text("{}")
+
+    async def watch():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(service._watch(0.01), 0.1)
+
+    asyncio.run(watch())
+    assert service.metrics.total("watch_errors") >= 2
+
+
+def test_validate_off_loop_with_blocking_store(tmp_path):
+    """Test checks run on an executor thread when the replay store blocks."""
+    _configure(tmp_path)
+    replay = MemoryReplayStore()
+    replay.blocking = True
+    validator = PaymentValidator(str(tmp_path))
+    service = TollbotService(str(tmp_path), port=0, replay=replay, validator=validator)
+    threads = []
+    check_request = validator.check_request
+    validator.check_request = lambda *args: threads.append(threading.get_ident()) or check_request(*args)
+
+    responses = _run(service, lambda port: _get(port, ["/__tollbot__/validate?path=/api/x"]))
+
+    assert [status for status, _ in responses] == [402]
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_request_payment_prepaid(tmp_path):
+    """Test prepaid tokens record only their payment in the replay store."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0, settlement=_settlement())
+
+    (status, body), = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/api/data/&prepaid=1&payment_id=pay_0",
+    ]))
+
+    assert status == 200
+    assert body["unit"] == 50
+    assert body["serial"] == 0
+    assert len(service.replay) == 1
+
+    token = service.manager.decode_token(body["token"])
+    assert token.quota == 50
+    assert service.manager.validate_token(token, 0.002, "/api/data/x") is True
+
+
+def test_request_payment_batches_nonces(tmp_path):
+    """Test concurrent mints share replay store writes."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0, batch_size=16, settlement=_settlement())
+    writes = []
+    add_many = service.replay.add_many
+    service.replay.add_many = lambda entries: writes.append(len(entries)) or add_many(entries)
+
+    async def mint_many(port):
+        return await asyncio.gather(*(
+            service.mint("/api/", payment_id=f"pay_{i}") for i in range(64)
+        ))
+
+    tokens = _run(service, mint_many)
+
+    assert len({token.nonce for token, _ in tokens}) == 64
+    # Payments are claimed one by one; nonces are written in batches
+    assert sum(writes) == 64
+    assert len(writes) < 64
+    assert len(service.replay) == 128
+
+
+@pytest.mark.parametrize("store", ["memory", "mmap"])
+def test_concurrent_mints_claim_payment_once(tmp_path, store):
+    """Test concurrent mints against one payment, on two services, get one token."""
+    _configure(tmp_path)
+    if store == "memory":
+        replays = [MemoryReplayStore()] * 2
+    else:
+        replays = [MmapReplayStore(str(tmp_path / "replay.tbl"), slots=64) for _ in range(2)]
+    services = [
+        TollbotService(str(tmp_path), port=0, replay=replay, settlement=_settlement())
+        for replay in replays
+    ]
+
+    async def mint_many(port):
+        return await asyncio.gather(*(
+            services[i % 2].mint("/api/", payment_id="pay_1") for i in range(8)
+        ), return_exceptions=True)
+
+    try:
+        results = _run(services[0], mint_many)
+    finally:
+        services[1].settlement.shutdown()
+        for replay in set(replays):
+            replay.close()
+
+    tokens = [r for r in results if not isinstance(r, Exception)]
+    assert len(tokens) == 1
+    assert all(str(r) == "Payment already used" for r in results if isinstance(r, Exception))
+
+
+def test_request_payment_errors(tmp_path):
+    """Test error responses."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0, settlement=_settlement())
+
+    responses = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/api/&amount=0.001&payment_id=pay_0",
+        "/__tollbot__/status",
+        "/nowhere",
+    ]))
+
+    assert [status for status, _ in responses] == [400, 200, 404]
+
+
+def test_request_payment_requires_payment(tmp_path):
+    """Test tokens are only minted against an unused payment that covers them."""
+    _configure(tmp_path)
+    settlement = _settlement({
+        "short": _transfer(amount="0.001"),
+        "elsewhere": _transfer(wallet="W999"),
+        "failed": _transfer(status="failed"),
+    })
+    service = TollbotService(str(tmp_path), port=0, settlement=settlement)
+
+    responses = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/api/",
+        "/__tollbot__/request-payment?path=/api/&payment_id=unknown",
+        "/__tollbot__/request-payment?path=/api/&payment_id=failed",
+        "/__tollbot__/request-payment?path=/api/&payment_id=short",
+        "/__tollbot__/request-payment?path=/api/&payment_id=elsewhere",
+        "/__tollbot__/request-payment?path=/api/&payment_id=pay_1",
+        "/__tollbot__/request-payment?path=/api/&payment_id=pay_1",
+        "/__tollbot__/request-payment?path=/api/&payment_id=pay_2&amount=0.003",
+    ]))
+
+    assert [status for status, _ in responses] == [402, 402, 402, 402, 402, 200, 402, 402]
+    assert responses[0][1]["error"] == "payment_id required"
+    assert responses[6][1]["error"] == "Payment already used"
+    assert service.metrics.total("mints") == 1
+
+
+def test_request_payment_without_settlement(tmp_path):
+    """Test nothing is minted when payments cannot be verified."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0)
+
+    (status, body), = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/api/&payment_id=pay_0",
+    ]))
+
+    assert status == 500
+    assert body["error"] == "Settlement not configured"
+
+
+def test_request_payment_without_wallet(tmp_path):
+    """Test minting fails cleanly without a signing key."""
+    service = TollbotService(str(tmp_path), port=0)
+
+    (status, body), = _run(service, lambda port: _get(port, [
+        "/__tollbot__/request-payment?path=/",
+    ]))
+
+    assert status == 500
+    assert body["error"] == "Wallet not configured"
+
+
+def test_unissued_token_rejected(tmp_path):
+    """Test tokens not recorded in the replay store are rejected."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0)
+    service.load()
+
+    token = service.manager.create_token("W123", "USDC", 0.002, 50, "/api/")
+    assert service.manager.validate_token(token, 0.002, "/api/") is False
+
+
+def test_validate_and_status(tmp_path):
+    """Test token checks and the live counters they feed."""
+    _configure(tmp_path)
+    service = TollbotService(
+        str(tmp_path), port=0, validator=PaymentValidator(str(tmp_path)), settlement=_settlement()
+    )
+
+    async def validate(port):
+        (_, minted), = await _get(port, ["/__tollbot__/request-payment?path=/api/&payment_id=pay_0"])
+        return await _get(port, [
+            f"/__tollbot__/validate?path=/api/data&token={minted['token']}",
+            f"/__tollbot__/validate?path=/api/data&token={minted['token']}",
+            "/__tollbot__/validate?path=/api/data",
+            "/__tollbot__/status",
+            "/__tollbot__/metrics",
+        ])
+
+    responses = _run(service, validate)
+
+    assert [status for status, _ in responses] == [200, 200, 402, 200, 200]
+    stats = responses[3][1]
+    assert stats["validations"] == 3
+    assert stats["mints"] == 1
+    assert stats["validation_latency_ms"]["p99"] > 0
+    assert stats["nonce_store_size"] == 2
+    assert stats["price_table"]["rules"] == 1
+    assert stats["price_table"]["version"] > 0
+    assert stats["cache_hit_ratio"]["token"] == 0.5
+    assert stats["demand_factors"] is None
+
+    metrics = responses[4][1].decode()
+    assert 'tollbot_validations_total{status="200"} 2' in metrics
+    assert 'tollbot_rejections_total{reason="missing"} 1' in metrics
+    assert 'tollbot_validation_seconds_count 3' in metrics
+
+
+def test_fetch_status(tmp_path):
+    """Test tollbot status reads live counters from the service."""
+    _configure(tmp_path)
+    service = TollbotService(str(tmp_path), port=0)
+
+    async def fetch(port):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            loop.run_in_executor(None, fetch_status, "/__tollbot__/status", "127.0.0.1", port),
+            loop.run_in_executor(None, fetch_status, "/nowhere", "127.0.0.1", port),
+        )
+
+    live, missing = _run(service, fetch)
+
+    assert live["status"] == "ok"
+    assert live["price_table"]["rules"] == 1
+    assert missing is None
+    assert fetch_status("/__tollbot__/status", "127.0.0.1", service.port) is None
@@ -0,0 +1,186 @@
+"""Tests for tollbot settlement verification."""
+import pytest
+
+from tollbot.payment.settlement import (
+    HttpSettlementBackend,
+    MemorySettlementBackend,
+    SettlementVerifier,
+)
+from tollbot.payment.token import TokenManager
+
+from tests.fakes import LocalSettlementServer
+
+SETTLED_TRANSFER = {
+    "status": "complete",
+    "amount": {"amount": "0.10", "currency": "USD"},
+    "destination": {"type": "wallet", "id": "W"},
+}
+
+
+def test_memory_backend_lookup():
+    """Test looking up transfers in the offline backend."""
+    backend = MemorySettlementBackend({"pay_1": SETTLED_TRANSFER})
+
+    record = backend.lookup("pay_1")
+    assert record.settled is True
+    assert record.amount == 0.10
+    assert record.currency == "USD"
+
+    assert backend.lookup("pay_2").status == "unknown"
+
+
+def test_record_covers():
+    """Test a settled payment covers only its amount, currency and wallet."""
+    backend = MemorySettlementBackend({
+        "pay_1": SETTLED_TRANSFER,
+        "pay_2": {"status": "pending", "amount": {"amount": "0.10", "currency": "USD"}},
+    })
+
+    record = backend.lookup("pay_1")
+    assert record.destination == "W"
+    assert record.covers(0.10, "USDC", "W") is True
+    assert record.covers(0.05, "USD", "W") is True
+    assert record.covers(0.11, "USDC", "W") is False
+    assert record.covers(0.10, "EURC", "W") is False
+    assert record.covers(0.10, "USDC", "X") is False
+    assert record.covers(0.10, "USDC", "") is False
+    assert backend.lookup("pay_2").covers(0.10, "USDC", "W") is False
+
+
+def test_http_backend_lookup():
+    """Test looking up transfers against the local stand-in server."""
+    with LocalSettlementServer({"pay_1": SETTLED_TRANSFER}) as server:
+        backend = HttpSettlementBackend(server.url)
+        try:
+            assert backend.lookup("pay_1").settled is True
+            assert backend.lookup("pay_2").status == "unknown"
+        finally:
+            backend.close()
+
+
+def test_verifier_indexes_results():
+    """Test verification results land in the settled-payment index."""
+    backend = MemorySettlementBackend({
+        "pay_1": SETTLED_TRANSFER,
+        "pay_2": {"status": "failed"},
+    })
+    verifier = SettlementVerifier(backend, retry_interval=0.01, max_attempts=2)
+    try:
+        assert verifier.is_settled("pay_1") is False
+        verifier.submit("pay_1").result(timeout=5)
+        verifier.submit("pay_2").result(timeout=5)
+
+        assert verifier.is_settled("pay_1") is True
+        assert verifier.is_settled("pay_2") is False
+        assert verifier.get("pay_2").status == "failed"
+    finally:
+        verifier.shutdown()
+
+
+def test_verifier_rechecks_pending():
+    """Test pending payments are checked again until they settle."""
+    transfers = {"pay_1": {"status": "pending"}}
+    backend = MemorySettlementBackend(transfers)
+    lookup = backend.lookup
+
+    def settle_after_first(payment_id):
+        record = lookup(payment_id)
+        transfers[payment_id] = SETTLED_TRANSFER
+        return record
+
+    backend.lookup = settle_after_first
+    verifier = SettlementVerifier(backend, retry_interval=0.01)
+    try:
+        record = verifier.submit("pay_1").result(timeout=5)
+        assert record.settled is True
+    finally:
+        verifier.shutdown()
+
+
+def test_verifier_resubmits_stale_pending():
+    """Test a payment still pending after its checks is checked again on use."""
+    transfers = {"pay_1": {"status": "pending"}}
+    verifier = SettlementVerifier(
+        MemorySettlementBackend(transfers), retry_interval=0.01, max_attempts=1
+    )
+    try:
+        verifier.submit("pay_1").result(timeout=5)
+        assert verifier.get("pay_1").status == "pending"
+
+        transfers["pay_1"] = SETTLED_TRANSFER
+        verifier.get("pay_1").checked_at -= 1
+        assert verifier.covers("pay_1", 0.10, "USDC", "W") is False
+        verifier.submit("pay_1").result(timeout=5)
+        assert verifier.covers("pay_1", 0.10, "USDC", "W") is True
+    finally:
+        verifier.shutdown()
+
+
+def test_verifier_fails_unreadable_transfers():
+    """Test a transfer that does not parse is recorded as failed."""
+    backend = MemorySettlementBackend({
+        "pay_1": {"status": "complete", "amount": {"amount": "ten", "currency": "USD"}},
+    })
+    verifier = SettlementVerifier(backend, retry_interval=0.01, max_attempts=3)
+    try:
+        assert verifier.submit("pay_1").result(timeout=5).status == "failed"
+        assert verifier.get("pay_1").status == "failed"
+    finally:
+        verifier.shutdown()
+
+
+def test_verifier_caps_index():
+    """Test the least recently checked payments are evicted from the index."""
+    backend = MemorySettlementBackend({f"pay_{i}": SETTLED_TRANSFER for i in range(3)})
+    verifier = SettlementVerifier(backend, max_records=2)
+    try:
+        for i in range(3):
+            verifier.submit(f"pay_{i}").result(timeout=5)
+        assert list(verifier.index) == ["pay_1", "pay_2"]
+        assert verifier.is_settled("pay_0") is False
+    finally:
+        verifier.shutdown()
+
+
+def test_token_requires_settlement():
+    """Test tokens are only redeemable once their payment settles."""
+    transfers = {}
+    verifier = SettlementVerifier(MemorySettlementBackend(transfers), max_attempts=1)
+    manager = TokenManager()
+    manager.generate_keypair()
+    manager.settlement = verifier
+    try:
+        unpaid = manager.create_token("W", "USDC", 0.001, 10, "/api/", payment_id="pay_0")
+        transfers["pay_1"] = SETTLED_TRANSFER
+        paid = manager.create_token("W", "USDC", 0.001, 10, "/api/", payment_id="pay_1")
+        verifier.submit("pay_0").result(timeout=5)
+        verifier.submit("pay_1").result(timeout=5)
+
+        assert manager.validate_token(unpaid, 0.001, "/api/") is False
+        assert manager.validate_token(paid, 0.001, "/api/") is True
+    finally:
+        verifier.shutdown()
+
+
+def test_token_checked_against_payment(tmp_path):
+    """Test unseen payments are looked up on first use and must cover the token."""
+    transfers = {"pay_1": SETTLED_TRANSFER}
+    minter = TokenManager(str(tmp_path))
+    minter.generate_keypair()
+    minter.save_signing_key()
+    verifier = SettlementVerifier(MemorySettlementBackend(transfers), max_attempts=1)
+    manager = TokenManager(str(tmp_path))
+    manager.load_signing_key()
+    manager.settlement = verifier
+    try:
+        paid = minter.create_token("W", "USDC", 0.10, 10, "/api/", payment_id="pay_1")
+        overstated = minter.create_token("W", "USDC", 1.00, 10, "/api/", payment_id="pay_1")
+        redirected = minter.create_token("X", "USDC", 0.10, 10, "/api/", payment_id="pay_1")
+
+        assert manager.validate_token(paid, 0.001, "/api/") is False
+        verifier.submit("pay_1").result(timeout=5)
+        assert manager.validate_token(paid, 0.001, "/api/") is True
+        assert manager.validate_token(overstated, 0.001, "/api/") is False
+        assert manager.validate_token(redirected, 0.001, "/api/") is False
+    finally:
+        verifier.shutdown()
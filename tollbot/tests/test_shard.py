@@ -0,0 +1,87 @@
+"""Tests for tollbot token sharding."""
+import pytest
+import json
+
+from tollbot.payment.resp import RespClient
+from tollbot.payment.shard import EpochShard
+from tollbot.payment.token import TokenManager
+from tollbot.payment.validator import PaymentValidator
+
+from tests.fakes import LocalRespServer
+
+
+def test_tokens_carry_shard_and_epoch(tmp_path):
+    """Test minted tokens are stamped and the stamp is signed."""
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.shard = EpochShard(1, 4, epoch_length=60)
+
+    token = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    assert token.shard == 1
+    assert token.epoch == token.timestamp // 60
+
+    decoded = manager.decode_token(manager.encode_token(token))
+    assert (decoded.shard, decoded.epoch) == (1, token.epoch)
+    assert manager.validate_token(decoded, 0.001, "/api/x") is True
+
+    decoded.shard = 2
+    assert manager.validate_token(decoded, 0.001, "/api/x") is False
+
+
+def test_check_shard_and_epoch():
+    """Test tokens of other shards and dead epochs are rejected."""
+    shard = EpochShard(0, 2, epoch_length=600)
+    now = 6000 * 600
+    epoch = shard.epoch(now)
+
+    class Token:
+        def __init__(self, shard, epoch):
+            self.shard, self.epoch = shard, epoch
+
+    assert shard.check(Token(0, epoch), now) is None
+    assert shard.check(Token(None, None), now) is None
+    assert shard.check(Token(1, epoch), now) == "shard"
+    assert shard.check(Token(0, epoch - shard.span), now) is None
+    assert shard.check(Token(0, epoch - shard.span - 1), now) == "epoch"
+    assert shard.check(Token(0, epoch + 2), now) == "epoch"
+
+    # Epochs never go back with the clock
+    assert shard.epoch(now - 3600) == epoch
+
+    with pytest.raises(ValueError):
+        EpochShard(2, 2)
+
+
+def test_check_request_misdirected(tmp_path):
+    """Test a validator answers 421 for tokens of another shard."""
+    (tmp_path / "config.ini").write_text(json.dumps({"shard_id": 0, "shard_count": 2}))
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    manager.shard = EpochShard(1, 2)
+    encoded = manager.encode_token(manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator.check_request(encoded, "/api/data/") == 421
+    assert validator.metrics.counters()[("rejections", (("reason", "shard"),))] == 1
+
+
+def test_sync_adopts_highest_epoch():
+    """Test shards exchange epochs and follow the one furthest ahead."""
+    with LocalRespServer() as server:
+        ahead = EpochShard(0, 2, epoch_length=60, client=RespClient(*server.address))
+        behind = EpochShard(1, 2, epoch_length=60, client=RespClient(*server.address))
+        try:
+            now = 1000 * 60
+            assert ahead.due(now + 120) is True
+            ahead.sync(now + 120)
+            assert ahead.due(now + 120) is False
+
+            behind.sync(now)
+            assert behind.peers == {0: 1002, 1: 1000}
+            assert behind.epoch(now) == 1002
+            assert behind.due(now) is False
+            assert behind.due(now + 180) is True
+        finally:
+            ahead.close()
+            behind.close()
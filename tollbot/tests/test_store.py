@@ -0,0 +1,187 @@
+"""Tests for tollbot shared nonce and unit counter stores."""
+import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tollbot.payment.meter import UnitMeter
+from tollbot.payment.replay import MemoryReplayStore
+from tollbot.payment.resp import RespClient, RespError
+from tollbot.payment.store import (
+    MmapReplayStore,
+    MmapUnitMeter,
+    RedisReplayStore,
+    RedisUnitMeter,
+    open_store,
+)
+
+from tests.fakes import LocalRespServer
+
+
+@pytest.fixture
+def server():
+    with LocalRespServer() as server:
+        yield server
+
+
+def test_resp_client_pipeline(server):
+    """Test a pipeline is sent in one write and errors come back in place."""
+    client = RespClient(*server.address)
+    try:
+        assert client.execute("PING") == b"PONG"
+        replies = client.pipeline([
+            ("SET", "a", 5, "EX", 60),
+            ("SET", "a", 9, "NX"),
+            ("DECRBY", "a", 2),
+            ("GET", "a"),
+            ("NOPE",),
+        ])
+        assert replies[:4] == [b"OK", None, 3, b"3"]
+        assert isinstance(replies[4], RespError)
+        assert server.batches == 2
+        assert server.commands == 6
+
+        with pytest.raises(RespError):
+            client.execute("NOPE")
+    finally:
+        client.close()
+
+
+def test_redis_replay_store_shared(server):
+    """Test nonces issued through one node are seen by another."""
+    node1 = RedisReplayStore(RespClient(*server.address))
+    node2 = RedisReplayStore(RespClient(*server.address))
+    try:
+        expires = int(time.time()) + 60
+        node1.add_many([("n1", expires), ("n2", expires), ("old", int(time.time()) - 1)])
+
+        assert node2.issued("n1") is True
+        assert node2.issued("n2") is True
+        assert node2.issued("old") is False
+        assert node2.issued("unknown") is False
+    finally:
+        node1.close()
+        node2.close()
+
+
+def test_redis_unit_meter_shared(server):
+    """Test spends on two nodes add up once pushed."""
+    node1 = RedisUnitMeter(RespClient(*server.address), flush_interval=60)
+    node2 = RedisUnitMeter(RespClient(*server.address), flush_interval=60)
+    try:
+        now = int(time.time())
+        for _ in range(4):
+            node1.consume("nonce", 10, now + 60, now)
+            node2.consume("nonce", 10, now + 60, now)
+        assert node1.remaining("nonce") == 6
+
+        node1.flush()
+        node2.flush()
+        assert node2.remaining("nonce") == 2
+
+        # node1 learns the shared count with its next push
+        assert node1.consume("nonce", 10, now + 60, now) == 5
+        node1.flush()
+        assert node1.remaining("nonce") == 1
+        assert node1.consume("nonce", 10, now + 60, now) == 0
+        assert node1.consume("nonce", 10, now + 60, now) == -1
+    finally:
+        node1.close()
+        node2.close()
+
+
+def test_redis_unit_meter_server_down():
+    """Test spends are counted locally while the server is unreachable."""
+    with LocalRespServer() as server:
+        address = server.address
+    meter = RedisUnitMeter(RespClient(*address, timeout=0.2), flush_interval=60)
+    try:
+        now = int(time.time())
+        assert meter.consume("nonce", 2, now + 60, now) == 1
+        assert meter.consume("nonce", 2, now + 60, now) == 0
+        assert meter.consume("nonce", 2, now + 60, now) == -1
+        meter.flush()
+        assert meter.exhausted("nonce") is True
+    finally:
+        meter.close()
+
+
+def test_mmap_store_shared(tmp_path):
+    """Test mmap tables are shared by every instance on the same files."""
+    replay1 = MmapReplayStore(str(tmp_path / "replay.tbl"), slots=64)
+    replay2 = MmapReplayStore(str(tmp_path / "replay.tbl"), slots=64)
+    meter1 = MmapUnitMeter(str(tmp_path / "units.tbl"), slots=64)
+    meter2 = MmapUnitMeter(str(tmp_path / "units.tbl"), slots=64)
+    try:
+        now = int(time.time())
+        replay1.add_many([("n1", now + 60)])
+        assert replay2.issued("n1") is True
+        assert replay2.issued("n2") is False
+
+        assert meter1.consume("nonce", 3, now + 60, now) == 2
+        assert meter2.consume("nonce", 3, now + 60, now) == 1
+        assert meter1.consume("nonce", 3, now + 60, now) == 0
+        assert meter2.consume("nonce", 3, now + 60, now) == -1
+        assert meter1.exhausted("nonce") is True
+    finally:
+        for store in (replay1, replay2, meter1, meter2):
+            store.close()
+
+
+@pytest.mark.parametrize("kind", ["memory", "mmap", "redis"])
+def test_replay_store_claim(kind, tmp_path, server):
+    """Test one of many concurrent claims on a key wins, across instances."""
+    if kind == "memory":
+        shared = MemoryReplayStore()
+        stores = [shared, shared]
+    elif kind == "mmap":
+        stores = [MmapReplayStore(str(tmp_path / "replay.tbl"), slots=64) for _ in range(2)]
+    else:
+        stores = [RedisReplayStore(RespClient(*server.address)) for _ in range(2)]
+    try:
+        expires = int(time.time()) + 60
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            claims = list(pool.map(lambda i: stores[i % 2].claim("payment:p1", expires), range(16)))
+        assert claims.count(True) == 1
+        assert stores[1].issued("payment:p1") is True
+
+        stores[0].release("payment:p1")
+        assert stores[0].issued("payment:p1") is False
+        assert stores[1].claim("payment:p1", expires) is True
+        assert stores[0].claim("payment:p1", expires) is False
+    finally:
+        for store in set(stores):
+            store.close()
+
+
+def test_mmap_table_bounded(tmp_path):
+    """Test a full table evicts entries instead of growing."""
+    replay = MmapReplayStore(str(tmp_path / "replay.tbl"), slots=8)
+    try:
+        expires = int(time.time()) + 60
+        replay.add_many([(f"n{i}", expires) for i in range(20)])
+        issued = [replay.issued(f"n{i}") for i in range(20)]
+        assert sum(issued) == 8
+    finally:
+        replay.close()
+
+
+def test_open_store(tmp_path, server):
+    """Test store URLs pick their backend."""
+    replay, meter = open_store("memory://")
+    assert isinstance(replay, MemoryReplayStore)
+    assert isinstance(meter, UnitMeter)
+
+    replay, meter = open_store(f"mmap://{tmp_path}")
+    assert isinstance(replay, MmapReplayStore)
+    assert isinstance(meter, MmapUnitMeter)
+    replay.close()
+    meter.close()
+
+    replay, meter = open_store(server.url)
+    assert isinstance(replay, RedisReplayStore)
+    assert isinstance(meter, RedisUnitMeter)
+    replay.close()
+    meter.close()
+
+    with pytest.raises(ValueError):
+        open_store("etcd://localhost")
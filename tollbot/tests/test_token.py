@@ -4,7 +4,8 @@ import time
 import os
 import tempfile
 
-from tollbot.payment.token import TokenManager, PaymentToken
+from tollbot.payment.revocation import RevocationList
+from tollbot.payment.token import TokenManager, PaymentToken, PrepaidToken
 
 
 def test_generate_keypair():
@@ -127,7 +128,7 @@ def test_validate_token_replay():
         wallet_id="TEST_WALLET",
         currency="USDC",
         amount=0.001,
-        unit=100,
+        unit=1,
         path="/api/data/",
     )
 
@@ -138,6 +139,23 @@ def test_validate_token_replay():
     assert is_valid is False
 
 
+def test_validate_token_unit():
+    """Test a unit token authorizes exactly unit requests."""
+    manager = TokenManager()
+    manager.generate_keypair()
+
+    token = manager.create_token(
+        wallet_id="TEST_WALLET",
+        currency="USDC",
+        amount=0.001,
+        unit=3,
+        path="/api/data/",
+    )
+
+    results = [manager.validate_token(token, 0.001, "/api/data/") for _ in range(4)]
+    assert results == [True, True, True, False]
+
+
 def test_rotate_keys():
     """Test key rotation."""
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -151,3 +169,191 @@ def test_rotate_keys():
 
         wallet_file = os.path.join(tmpdir, "wallet.conf")
         assert os.path.exists(wallet_file)
+
+
+def test_encode_decode_token():
+    """Test encoded tokens round-trip and still validate."""
+    manager = TokenManager()
+    manager.generate_keypair()
+
+    token = manager.create_token(
+        wallet_id="TEST_WALLET",
+        currency="USDC",
+        amount=0.001,
+        unit=100,
+        path="/api/data/",
+    )
+
+    encoded = manager.encode_token(token)
+    assert encoded.count(".") == 2
+
+    decoded = manager.decode_token(encoded)
+    assert decoded == token
+    assert manager.validate_token(decoded, 0.001, "/api/data/") is True
+
+
+def test_decode_token_tampered():
+    """Test a modified payload fails signature validation."""
+    manager = TokenManager()
+    manager.generate_keypair()
+
+    token = manager.create_token(
+        wallet_id="TEST_WALLET",
+        currency="USDC",
+        amount=0.001,
+        unit=100,
+        path="/api/data/",
+    )
+    header, _, signature = manager.encode_token(token).split(".")
+    forged = manager.create_token("TEST_WALLET", "USDC", 1.0, 100, "/api/data/")
+    payload = manager.encode_token(forged).split(".")[1]
+
+    decoded = manager.decode_token(f"{header}.{payload}.{signature}")
+    assert manager.validate_token(decoded, 0.001, "/api/data/") is False
+
+    with pytest.raises(ValueError):
+        manager.decode_token("not-a-token")
+
+
+def test_save_and_load_signing_key():
+    """Test the signing key is persisted with owner-only permissions."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manager = TokenManager(tmpdir)
+        manager.generate_keypair()
+        manager.save_signing_key()
+
+        key_file = os.path.join(tmpdir, "signing.key")
+        assert os.stat(key_file).st_mode & 0o777 == 0o600
+
+        other = TokenManager(tmpdir)
+        assert other.load_signing_key() is True
+        assert other._private_key == manager._private_key
+
+
+def test_prepaid_token(tmp_path):
+    """Test prepaid tokens are accepted within their window, scope and quota."""
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+
+    token = manager.create_prepaid_token("TEST_WALLET", "USDC", 0.001, 2, "/api/")
+    decoded = manager.decode_token(manager.encode_token(token))
+    assert isinstance(decoded, PrepaidToken)
+    assert decoded == token
+
+    assert manager.validate_token(decoded, 0.001, "/other/") is False
+    assert manager.validate_token(decoded, 0.01, "/api/x") is False
+    assert manager.validate_token(decoded, 0.001, "/api/x") is True
+    assert manager.validate_token(decoded, 0.001, "/api/x") is True
+    assert manager.validate_token(decoded, 0.001, "/api/x") is False
+
+    later = manager.create_prepaid_token(
+        "TEST_WALLET", "USDC", 0.001, 2, "/api/", not_before=int(time.time()) + 60
+    )
+    assert later.serial == token.serial + 1
+    assert manager.validate_token(later, 0.001, "/api/x") is False
+
+    decoded.quota = 100
+    assert manager.validate_token(decoded, 0.001, "/api/x") is False
+
+
+def test_prepaid_token_revoked(tmp_path):
+    """Test revoked prepaid tokens are rejected, even once verified."""
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.revocations = RevocationList()
+    token = manager.create_prepaid_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+
+    assert manager.validate_token(token, 0.001, "/api/x") is True
+    manager.revocations.revoke([token.serial])
+    assert manager.redeem_token(token, 0.001, "/api/x") is False
+
+
+def test_ed25519_tokens(tmp_path):
+    """Test EdDSA tokens verify on a node holding only the public key."""
+    pytest.importorskip("cryptography")
+    minter = TokenManager(str(tmp_path))
+    minter.generate_ed25519_keypair()
+    minter.save_ed25519_keys()
+    assert oct(os.stat(tmp_path / "signing.pem").st_mode & 0o777) == "0o600"
+
+    token = minter.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    prepaid = minter.create_prepaid_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    assert token.algorithm == "EdDSA"
+
+    edge_dir = tmp_path / "edge"
+    edge_dir.mkdir()
+    (edge_dir / "verify.pem").write_bytes((tmp_path / "verify.pem").read_bytes())
+    edge = TokenManager(str(edge_dir))
+    edge.load_signing_key()
+    assert edge.has_signing_key is False
+
+    decoded = edge.decode_token(minter.encode_token(token))
+    assert decoded.algorithm == "EdDSA"
+    assert edge.validate_token(decoded, 0.001, "/api/x") is True
+    assert edge.validate_token(edge.decode_token(minter.encode_token(prepaid)), 0.001, "/api/x") is True
+
+    decoded.amount = 1.0
+    assert edge.validate_token(decoded, 0.001, "/api/x") is False
+
+
+def test_verify_batch(tmp_path):
+    """Test batch verification matches one-by-one checks."""
+    pytest.importorskip("cryptography")
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    hs256 = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    manager.generate_ed25519_keypair()
+    good = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    bad = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    bad.path = "/"
+
+    # HS256 tokens are refused once an Ed25519 key is loaded
+    tokens = [good, bad, hs256, good, bad]
+    assert manager.verify_batch(tokens) == [True, False, False, True, False]
+    assert manager.verify_batch(tokens) == [manager.verify_signature(t) for t in tokens]
+
+
+def test_rotate_back_to_hs256(tmp_path):
+    """Test rotating without ed25519 after an Ed25519 rotation signs with HS256 again."""
+    pytest.importorskip("cryptography")
+    (tmp_path / "wallet.conf").write_text("wallet_id=W\n")
+    manager = TokenManager(str(tmp_path))
+    manager.rotate_keys(ed25519=True)
+    assert manager.algorithm == "EdDSA"
+
+    manager.rotate_keys()
+    assert manager.algorithm == "HS256"
+    assert not (tmp_path / "signing.pem").exists()
+    assert not (tmp_path / "verify.pem").exists()
+    token = manager.create_token("W", "USDC", 0.001, 10, "/api/")
+    assert token.algorithm == "HS256"
+    assert manager.verify_signature(token) is True
+
+    fresh = TokenManager(str(tmp_path))
+    fresh.load_signing_key()
+    assert fresh.algorithm == "HS256"
+    assert fresh.verify_signature(token) is True
+
+
+def test_ed25519_refuses_hs256(tmp_path):
+    """Test rotating to Ed25519 removes the HS256 secret and refuses HS256 tokens."""
+    pytest.importorskip("cryptography")
+    (tmp_path / "wallet.conf").write_text("wallet_id=W\n")
+    manager = TokenManager(str(tmp_path))
+    manager.rotate_keys()
+    hs256 = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    assert manager.verify_signature(hs256) is True
+    secret = (tmp_path / "signing.key").read_text()
+
+    manager.rotate_keys(ed25519=True)
+    assert not (tmp_path / "signing.key").exists()
+    assert (tmp_path / "verify.pem").exists()
+
+    # An edge node that still holds the old secret
+    (tmp_path / "signing.key").write_text(secret)
+    edge = TokenManager(str(tmp_path))
+    edge.load_signing_key()
+    assert edge.verify_signature(hs256) is False
+    eddsa = manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/")
+    assert eddsa.algorithm == "EdDSA"
+    assert edge.verify_signature(eddsa) is True
@@ -0,0 +1,30 @@
+"""Tests for validation tracing."""
+from tollbot.tracing import Tracer
+
+
+def test_nested_traces():
+    """Test inner traced calls add stages to the outer trace."""
+    tracer = Tracer()
+    assert tracer.start("outer") is True
+    tracer.stage("a")
+    assert tracer.start("inner") is False
+    tracer.stage("b")
+    tracer.finish()
+    tracer.stage("ignored")
+
+    trace, = tracer.dump()
+    assert trace["name"] == "outer"
+    assert [stage for stage, _ in trace["stages"]] == ["a", "b"]
+    assert trace["total_ms"] >= sum(ms for _, ms in trace["stages"])
+
+
+def test_ring_buffer():
+    """Test only the newest traces are kept, oldest first."""
+    tracer = Tracer(capacity=3)
+    for i in range(5):
+        tracer.start(f"t{i}")
+        tracer.stage("work")
+        tracer.finish()
+
+    assert [trace["name"] for trace in tracer.dump()] == ["t2", "t3", "t4"]
+    assert tracer.summary()["work"]["count"] == 3
@@ -0,0 +1,24 @@
+"""Tests for tollbot request path normalization."""
+import json
+import os
+
+import pytest
+
+from tollbot.uri import normalize_path
+
+
+# Shared with payment_filter.lua, whose normalize_path must agree
+with open(os.path.join(os.path.dirname(__file__), "uri_vectors.json")) as f:
+    VECTORS = json.load(f)
+
+
+@pytest.mark.parametrize("uri,expected", VECTORS)
+def test_normalize_path(uri, expected):
+    """Test paths are decoded, collapsed and stripped of dot segments."""
+    assert normalize_path(uri) == expected
+
+
+def test_normalized_path_returned_as_is():
+    """Test canonical paths are not copied."""
+    path = "/api/models/" + "x" * 64
+    assert normalize_path(path) is path
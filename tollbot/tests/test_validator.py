@@ -2,8 +2,12 @@
 import pytest
 import os
 import tempfile
+import json
 
+from tollbot.payment.revocation import RevocationList
+from tollbot.payment.token import TokenManager
 from tollbot.payment.validator import PaymentValidator
+from tollbot.robots_parser import RobotsParser
 
 
 def test_init_validator():
@@ -61,3 +65,199 @@ def test_get_min_price_with_cache(tmp_path):
 
     price = validator._get_min_price("/api/data/something")
     assert price == 0.002
+
+
+def test_validate_request_encoded_token():
+    """Test validating an encoded token end to end."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manager = TokenManager(tmpdir)
+        manager.generate_keypair()
+        manager.save_signing_key()
+        token = manager.create_token("TEST_WALLET", "USDC", 0.001, 1, "/api/")
+
+        validator = PaymentValidator(tmpdir)
+        encoded = manager.encode_token(token)
+
+        assert validator.validate_request(encoded, "/api/data/") is True
+        assert validator.validate_request(encoded, "/api/data/") is False
+        assert validator.validate_request("fake_token", "/api/data/") is False
+
+
+def test_validate_request_unit_token():
+    """Test repeat presentations of a unit token use the verified cache."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manager = TokenManager(tmpdir)
+        manager.generate_keypair()
+        manager.save_signing_key()
+        token = manager.create_token("TEST_WALLET", "USDC", 0.001, 2, "/api/")
+        encoded = manager.encode_token(token)
+
+        validator = PaymentValidator(tmpdir)
+        assert validator.validate_request(encoded, "/api/a") is True
+        assert encoded in validator._verified
+
+        # A second presentation must not re-check the signature
+        validator.manager.sign_token = None
+        assert validator.validate_request(encoded, "/api/b") is True
+        assert validator.validate_request(encoded, "/api/c") is False
+        assert validator.validate_request(encoded, "/other/") is False
+
+
+def test_check_request_status():
+    """Test exhausted tokens get 402 and invalid ones 403."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manager = TokenManager(tmpdir)
+        manager.generate_keypair()
+        manager.save_signing_key()
+        token = manager.create_token("TEST_WALLET", "USDC", 0.001, 1, "/api/")
+        encoded = manager.encode_token(token)
+
+        validator = PaymentValidator(tmpdir)
+        assert validator.check_request(None, "/api/data/") == 402
+        assert validator.check_request(encoded, "/api/data/") == 200
+        assert validator.check_request(encoded, "/api/data/") == 402
+        assert validator.check_request("fake_token", "/api/data/") == 403
+
+
+def test_check_request_rate_limit():
+    """Test repeated rejections from one client are throttled."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "config.ini"), "w") as f:
+            f.write('{"rate_limit": 0.01, "rate_burst": 3}')
+
+        validator = PaymentValidator(tmpdir)
+        statuses = [
+            validator.check_request(None, "/api/data/", client_ip="10.0.0.1", user_agent="bot")
+            for _ in range(5)
+        ]
+        assert statuses == [402, 402, 402, 429, 429]
+
+        # Other clients, and requests without client details, are unaffected
+        assert validator.check_request(None, "/api/data/", client_ip="10.0.0.1") == 402
+        assert validator.check_request(None, "/api/data/") == 402
+
+
+def test_check_request_tracing():
+    """Test traced checks record the stages they went through."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "config.ini"), "w") as f:
+            f.write('{"trace_buffer": 2}')
+        manager = TokenManager(tmpdir)
+        manager.generate_keypair()
+        manager.save_signing_key()
+        encoded = manager.encode_token(manager.create_token("W", "USDC", 0.001, 5, "/api/"))
+
+        validator = PaymentValidator(tmpdir)
+        assert validator.tracer.capacity == 2
+        for _ in range(2):
+            assert validator.check_request(encoded, "/api/a", client_ip="10.0.0.1") == 200
+
+        first, second = validator.tracer.dump()
+        assert first["name"] == "validate_request"
+        assert [stage for stage, _ in first["stages"]] == [
+            "rate_limit", "price_lookup", "decode", "signature", "meter",
+        ]
+        assert [stage for stage, _ in second["stages"]] == ["rate_limit", "price_lookup", "meter"]
+        assert validator.tracer.summary()["meter"]["count"] == 2
+
+        validator.set_tracer(None)
+        assert validator.check_request(encoded, "/api/a") == 200
+        assert manager.tracer is None
+
+
+def test_check_request_prepaid_revoked(tmp_path):
+    """Test prepaid tokens are rejected once revoked.json lists them."""
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    token = manager.create_prepaid_token("TEST_WALLET", "USDC", 0.001, 1, "/api/")
+    encoded = manager.encode_token(token)
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator.check_request(encoded, "/api/data/") == 200
+    assert validator.check_request(encoded, "/api/data/") == 402
+
+    revoked = manager.create_prepaid_token("TEST_WALLET", "USDC", 0.001, 1, "/api/")
+    revocations = RevocationList()
+    revocations.revoke([revoked.serial])
+    revocations.save(str(tmp_path / "revoked.json"))
+    validator.reload_revocations()
+    assert validator.check_request(manager.encode_token(revoked), "/api/data/") == 403
+    assert validator.metrics.total("rejections") == 2
+
+
+def test_reload_keys(tmp_path):
+    """Test rotated keys are picked up and tokens of the old key dropped."""
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    old = manager.encode_token(manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator.check_request(old, "/api/data/") == 200
+    validator.reload_keys()
+    assert validator.check_request(old, "/api/data/") == 200
+
+    manager.generate_keypair()
+    manager.save_signing_key()
+    os.utime(tmp_path / "signing.key", (0, 0))
+    new = manager.encode_token(manager.create_token("TEST_WALLET", "USDC", 0.001, 10, "/api/"))
+    validator.reload_keys()
+    assert validator.check_request(old, "/api/data/") == 403
+    assert validator.check_request(new, "/api/data/") == 200
+
+
+def test_get_min_price_reloads(tmp_path):
+    """Test prices come from the cached table and follow its changes."""
+    parser = RobotsParser()
+    parser.parse("Disallow: /api/  # @price: 0.002 @unit: 100\n")
+    parser.save_cache(str(tmp_path / "robots_cache.json"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator._get_min_price("/api/x") == 0.002
+    assert validator._get_min_price("/api/x") == 0.002
+    assert validator.metrics.total("price_cache_hits") == 1
+
+    parser.parse("Disallow: /api/  # @price: 0.004 @unit: 100\n")
+    parser.save_cache(str(tmp_path / "robots_cache.json"))
+    validator._prices_checked = float("-inf")
+    assert validator._get_min_price("/api/x") == 0.004
+
+
+def test_check_request_normalizes_path(tmp_path):
+    """Test encoded, doubled and dot-segment paths are priced and scoped as decoded."""
+    parser = RobotsParser()
+    parser.parse("Disallow: /api/premium/  # @price: 0.01 @unit: 100\n")
+    parser.save_cache(str(tmp_path / "robots_cache.json"))
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    cheap = manager.encode_token(manager.create_token("W", "USDC", 0.001, 100, "/api/"))
+    scoped = manager.encode_token(manager.create_token("W", "USDC", 0.01, 100, "/api/premium/"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator.check_request(cheap, "/api/x") == 200
+    for path in ("/api//premium/x", "/api/%70remium/x", "/api/./premium/x"):
+        assert validator.check_request(cheap, path) == 403
+        assert validator.check_request(scoped, path) == 200
+    assert validator.check_request(scoped, "/api/premium/../../admin") == 403
+
+
+def test_check_request_audits_valid(tmp_path):
+    """Test accepted tokens are written to the audit log as valid."""
+    audit_dir = tmp_path / "audit"
+    (tmp_path / "config.ini").write_text(json.dumps({"audit_log_dir": str(audit_dir)}))
+    manager = TokenManager(str(tmp_path))
+    manager.generate_keypair()
+    manager.save_signing_key()
+    encoded = manager.encode_token(manager.create_token("TEST_WALLET", "USDC", 0.001, 1, "/api/"))
+
+    validator = PaymentValidator(str(tmp_path))
+    assert validator.check_request(encoded, "/api/data/", client_ip="10.0.0.1") == 200
+    validator.audit.close()
+
+    with open(audit_dir / "payments.log") as f:
+        logs = [json.loads(line) for line in f]
+    assert [(log["path"], log["wallet_id"], log["is_valid"]) for log in logs] == [
+        ("/api/data/", "TEST_WALLET", True),
+    ]